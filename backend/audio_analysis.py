@@ -0,0 +1,211 @@
+import os
+import subprocess
+import wave
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+ANALYSIS_SAMPLE_RATE = int(os.getenv("ANALYSIS_SAMPLE_RATE", "22050"))
+ANALYSIS_BLOCK_SECONDS = float(os.getenv("ANALYSIS_BLOCK_SECONDS", "4"))
+
+PITCH_CLASSES = ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"]
+# Krumhansl-Kessler key profiles, tonic first
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+def _pcm_to_float(raw: bytes, sample_width: int, channels: int) -> np.ndarray:
+    if sample_width == 1:
+        data = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        data = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768
+    elif sample_width == 3:
+        bytes3 = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        padded = np.zeros((len(bytes3), 4), dtype=np.uint8)
+        padded[:, 1:] = bytes3
+        data = padded.view("<i4").reshape(-1).astype(np.float32) / 2 ** 31
+    elif sample_width == 4:
+        data = np.frombuffer(raw, dtype="<i4").astype(np.float32) / 2 ** 31
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {sample_width}")
+    return data.reshape(-1, channels).mean(axis=1) if channels > 1 else data
+
+
+def _wav_blocks(path: Path, block_frames: int) -> Iterator[np.ndarray]:
+    with wave.open(str(path), "rb") as wav:
+        width, channels = wav.getsampwidth(), wav.getnchannels()
+        while True:
+            raw = wav.readframes(block_frames)
+            if not raw:
+                break
+            yield _pcm_to_float(raw, width, channels)
+
+
+def _ffmpeg_blocks(path: Path, block_frames: int, sample_rate: int) -> Iterator[np.ndarray]:
+    command = ["ffmpeg", "-v", "error", "-i", str(path), "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "-"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    received = 0
+    try:
+        while True:
+            raw = process.stdout.read(block_frames * 4)
+            if not raw:
+                break
+            received += len(raw)
+            yield np.frombuffer(raw[:len(raw) - len(raw) % 4], dtype="<f4")
+    finally:
+        if process.poll() is None:
+            process.kill()
+        stderr = process.stderr.read().decode("utf-8", "replace").strip()
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+    if received == 0:
+        raise RuntimeError(f"ffmpeg could not decode {path.name}: {stderr or process.returncode}")
+
+
+def open_audio_stream(file_path: str, block_seconds: float = ANALYSIS_BLOCK_SECONDS) -> Tuple[int, Iterator[np.ndarray]]:
+    """Returns (sample_rate, generator of mono float32 blocks) without loading the file into memory.
+
+    PCM WAV is read directly; anything else is decoded by an ffmpeg pipe at ANALYSIS_SAMPLE_RATE.
+    """
+    path = Path(file_path)
+    if path.suffix.lower() == ".wav":
+        try:
+            with wave.open(str(path), "rb") as wav:
+                sample_rate = wav.getframerate()
+            return sample_rate, _wav_blocks(path, int(block_seconds * sample_rate))
+        except (wave.Error, EOFError):
+            pass  # not plain PCM, let ffmpeg handle it
+    sample_rate = ANALYSIS_SAMPLE_RATE
+    return sample_rate, _ffmpeg_blocks(path, int(block_seconds * sample_rate), sample_rate)
+
+
+class StreamingAnalyzer:
+    """measures tempo and key from audio fed in blocks of any size
+    a short-time fourier transform runs over each block with the tail carried to the next
+    spectral flux gives an onset envelope whose autocorrelation is accumulated in place
+    chroma energy is summed per pitch class and matched against key profiles
+    state is a few fixed size arrays so memory does not grow with song length
+    """
+    def __init__(self, sample_rate: int, n_fft: int = 2048, hop: int = 512,
+                 min_bpm: float = 60.0, max_bpm: float = 200.0):
+        self.sample_rate = sample_rate
+        self.n_fft = n_fft
+        self.hop = hop
+        self.frame_rate = sample_rate / hop
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.window = np.hanning(n_fft).astype(np.float32)
+        self.max_lag = int(np.ceil(60 * self.frame_rate / min_bpm)) + 1
+        # Local mean over ~0.4 s removes the envelope's DC so the autocorrelation shows periodicity
+        self.smooth = max(1, int(0.4 * self.frame_rate))
+
+        freqs = np.fft.rfftfreq(n_fft, 1 / sample_rate)
+        in_range = (freqs >= 55) & (freqs <= 2000)
+        pitch_class = np.zeros(len(freqs), dtype=int)
+        pitch_class[in_range] = np.round(69 + 12 * np.log2(freqs[in_range] / 440)).astype(int) % 12
+        self.chroma_map = np.zeros((len(freqs), 12), dtype=np.float32)
+        self.chroma_map[np.nonzero(in_range)[0], pitch_class[in_range]] = 1
+
+        self._leftover = np.zeros(0, dtype=np.float32)
+        self._previous_spectrum: Optional[np.ndarray] = None
+        self._raw_history = np.zeros(0, dtype=np.float32)
+        self._onset_history = np.zeros(0, dtype=np.float32)
+        self._autocorrelation = np.zeros(self.max_lag + 1)
+        self._chroma = np.zeros(12)
+        self.frames = 0
+        self.samples = 0
+
+    def feed(self, samples: np.ndarray):
+        self.samples += len(samples)
+        buffer = np.concatenate([self._leftover, samples.astype(np.float32, copy=False)])
+        if len(buffer) < self.n_fft:
+            self._leftover = buffer
+            return
+        count = 1 + (len(buffer) - self.n_fft) // self.hop
+        frames = np.lib.stride_tricks.sliding_window_view(buffer, self.n_fft)[::self.hop][:count]
+        self._leftover = buffer[count * self.hop:]
+        magnitude = np.abs(np.fft.rfft(frames * self.window, axis=1))
+        self._chroma += (magnitude.sum(axis=0) @ self.chroma_map)
+
+        compressed = np.log1p(100 * magnitude)
+        previous = compressed[:1] if self._previous_spectrum is None else self._previous_spectrum[None, :]
+        flux = np.maximum(np.diff(compressed, axis=0, prepend=previous), 0).sum(axis=1)
+        self._previous_spectrum = compressed[-1]
+        self._accumulate_onsets(flux.astype(np.float32))
+        self.frames += count
+
+    def _accumulate_onsets(self, raw: np.ndarray):
+        raw_all = np.concatenate([self._raw_history, raw])
+        sums = np.concatenate([[0.0], np.cumsum(raw_all, dtype=np.float64)])
+        ends = np.arange(len(self._raw_history), len(raw_all)) + 1
+        starts = np.maximum(0, ends - self.smooth)
+        onsets = np.maximum(raw - (sums[ends] - sums[starts]) / (ends - starts), 0)
+        self._raw_history = raw_all[-(self.smooth - 1):] if self.smooth > 1 else raw_all[:0]
+
+        history = self._onset_history
+        onset_all = np.concatenate([history, onsets])
+        offset = len(history)
+        for lag in range(1, self.max_lag + 1):
+            first = max(0, lag - offset)
+            if first >= len(onsets):
+                break
+            self._autocorrelation[lag] += float(np.dot(onsets[first:], onset_all[offset + first - lag:offset + len(onsets) - lag]))
+        self._onset_history = onset_all[-self.max_lag:]
+
+    def tempo(self) -> float:
+        lags = np.arange(1, self.max_lag + 1)
+        bpms = 60 * self.frame_rate / lags
+        valid = (bpms >= self.min_bpm) & (bpms <= self.max_bpm)
+        if not valid.any() or not self._autocorrelation[1:].any():
+            return 0.0
+        # Prefer tempos near 120 BPM, one octave either side, like a listener tapping along
+        weight = np.exp(-0.5 * np.log2(bpms / 120) ** 2)
+        score = np.where(valid, self._autocorrelation[1:] * weight, -np.inf)
+        best = int(np.argmax(score))
+        lag = float(lags[best])
+        if 0 < best < len(score) - 1 and np.isfinite(score[best - 1]) and np.isfinite(score[best + 1]):
+            left, centre, right = score[best - 1], score[best], score[best + 1]
+            denominator = left - 2 * centre + right
+            if denominator:
+                lag += 0.5 * (left - right) / denominator
+        return 60 * self.frame_rate / lag
+
+    def key(self) -> Tuple[str, str, float]:
+        if not self._chroma.any():
+            return "", "", 0.0
+        chroma = self._chroma / self._chroma.max()
+        best = ("", "", -1.0)
+        for scale, profile in (("major", MAJOR_PROFILE), ("minor", MINOR_PROFILE)):
+            for tonic in range(12):
+                strength = float(np.corrcoef(chroma, np.roll(profile, tonic))[0, 1])
+                if strength > best[2]:
+                    best = (PITCH_CLASSES[tonic], scale, strength)
+        return best
+
+    def result(self) -> Dict[str, object]:
+        key, scale, strength = self.key()
+        return {
+            "bpm": round(float(self.tempo()), 2),
+            "key": f"{key} {scale}",
+            "key_strength": round(strength, 2),
+            "duration": round(self.samples / self.sample_rate, 2),
+            "analyzer": "numpy",
+        }
+
+
+def analyze_audio_streaming(file_path: str) -> dict:
+    """Measures BPM and key over the whole file in constant memory, with the same fields as the Essentia analysis."""
+    try:
+        sample_rate, blocks = open_audio_stream(file_path)
+        analyzer = StreamingAnalyzer(sample_rate)
+        for block in blocks:
+            analyzer.feed(block)
+        if analyzer.samples < sample_rate * 2:
+            return {"error": "Audio file is too short for analysis."}
+        print(f"Streaming analysis complete for {file_path}")
+        return analyzer.result()
+    except Exception as e:
+        print(f"Could not analyze audio with the streaming analyzer: {e}")
+        return {"error": str(e)}
@@ -0,0 +1,88 @@
+"""Compares the streaming NumPy analyzer with Essentia on real audio files.
+
+Each analyzer runs in a fresh process so wall time and peak memory are measured
+independently. Usage: python benchmark_analysis.py song1.mp3 song2.wav ...
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+from typing import Dict, List, Optional
+
+try:
+    from .audio_analysis import PITCH_CLASSES, analyze_audio_streaming
+    from .stem_separation import analyze_audio_with_essentia, es
+except ImportError:
+    from audio_analysis import PITCH_CLASSES, analyze_audio_streaming
+    from stem_separation import analyze_audio_with_essentia, es
+
+ANALYZERS = {"numpy": analyze_audio_streaming, "essentia": analyze_audio_with_essentia}
+
+
+def _measure(name: str, file_path: str, results):
+    started = time.perf_counter()
+    result = ANALYZERS[name](file_path)
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    # ru_maxrss is in KB on Linux
+    result["peak_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    results.put(result)
+
+
+def run_isolated(name: str, file_path: str) -> Dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_measure, args=(name, file_path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def bpm_agrees(a: float, b: float, tolerance: float = 0.04) -> bool:
+    """Same tempo within tolerance, also accepting half and double time."""
+    if not a or not b:
+        return False
+    return any(abs(a * factor - b) <= tolerance * b for factor in (0.5, 1.0, 2.0))
+
+
+def key_agreement(a: str, b: str) -> str:
+    """exact, relative (e.g. C major / A minor) or none."""
+    if not a or not b or len(a.split()) != 2 or len(b.split()) != 2:
+        return "none"
+    if a == b:
+        return "exact"
+    (tonic_a, scale_a), (tonic_b, scale_b) = a.split(), b.split()
+    if scale_a == scale_b or tonic_a not in PITCH_CLASSES or tonic_b not in PITCH_CLASSES:
+        return "none"
+    major, minor = (tonic_a, tonic_b) if scale_a == "major" else (tonic_b, tonic_a)
+    return "relative" if (PITCH_CLASSES.index(major) - 3) % 12 == PITCH_CLASSES.index(minor) else "none"
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+    names = ["numpy", "essentia"] if es else ["numpy"]
+    if not es:
+        print("Essentia is not installed; timing the NumPy analyzer only.")
+
+    totals = {"bpm": 0, "key": 0, "compared": 0}
+    for file_path in args.files:
+        results = {name: run_isolated(name, file_path) for name in names}
+        for name, result in results.items():
+            print(f"{file_path} [{name}] bpm={result.get('bpm')} key={result.get('key')} "
+                  f"time={result['seconds']}s peak={result['peak_mb']} MB {result.get('error', '')}")
+        if len(results) == 2 and not any("error" in r for r in results.values()):
+            totals["compared"] += 1
+            totals["bpm"] += bpm_agrees(results["numpy"]["bpm"], results["essentia"]["bpm"])
+            agreement = key_agreement(results["numpy"]["key"], results["essentia"]["key"])
+            totals["key"] += agreement != "none"
+            print(f"  speedup={results['essentia']['seconds'] / max(results['numpy']['seconds'], 1e-6):.2f}x "
+                  f"bpm_agrees={bpm_agrees(results['numpy']['bpm'], results['essentia']['bpm'])} key={agreement}")
+    if totals["compared"]:
+        print(f"Agreement over {totals['compared']} files: tempo {totals['bpm']}/{totals['compared']}, "
+              f"key {totals['key']}/{totals['compared']}")
+
+
+if __name__ == "__main__":
+    main()
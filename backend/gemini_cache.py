@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+GEMINI_CACHE_DIR = Path(os.getenv("GEMINI_CACHE_DIR", str(Path(__file__).parent / "gemini_cache")))
+GEMINI_CACHE_TTL_SECONDS = float(os.getenv("GEMINI_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+GEMINI_CACHE_MAX_MB = float(os.getenv("GEMINI_CACHE_MAX_MB", "64"))
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE_ENABLED", "1") == "1"
+
+
+def normalize_prompt(text: str) -> str:
+    """Collapses whitespace and case so trivially different prompts share an entry."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def response_cache_key(system_prompt: str, user_prompt: str, model_name: str) -> str:
+    raw = "\n".join([model_name, normalize_prompt(system_prompt), normalize_prompt(user_prompt)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """persistent cache of gemini text responses for prompts whose answer only depends on the prompt
+    each response is one json file on local disk so entries survive restarts
+    entries older than the ttl are treated as missing and removed
+    the directory is kept under max_bytes by evicting the least recently used files
+    """
+    def __init__(self, root: Path = GEMINI_CACHE_DIR, ttl_seconds: float = GEMINI_CACHE_TTL_SECONDS,
+                 max_bytes: int = int(GEMINI_CACHE_MAX_MB * 1024 * 1024), enabled: bool = GEMINI_CACHE_ENABLED):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.expired = 0
+        self.evictions = 0
+        # key -> size in bytes, least recently used first; file mtimes carry the order across restarts
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        for existing in sorted(self.root.glob("*.json"), key=lambda p: p.stat().st_mtime):
+            self._sizes[existing.stem] = existing.stat().st_size
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+                self._sizes.pop(key, None)
+            return None
+        if time.time() - entry.get("storedAt", 0) > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            with self._lock:
+                self.misses += 1
+                self.expired += 1
+                self._sizes.pop(key, None)
+            return None
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return entry["response"]
+
+    def put(self, key: str, response: Dict[str, Any]):
+        path = self._path(key)
+        body = json.dumps({"storedAt": time.time(), "response": response})
+        partial = path.with_name(f"{path.name}.{threading.get_ident()}.part")
+        partial.write_text(body, encoding="utf-8")
+        os.replace(partial, path)
+        evicted = []
+        with self._lock:
+            self._sizes[key] = len(body.encode("utf-8"))
+            self._sizes.move_to_end(key)
+            total = sum(self._sizes.values())
+            while total > self.max_bytes and len(self._sizes) > 1:
+                old_key, size = self._sizes.popitem(last=False)
+                total -= size
+                evicted.append(self._path(old_key))
+                self.evictions += 1
+        for old_path in evicted:
+            old_path.unlink(missing_ok=True)
+
+    async def generate(self, generate_fn, system_prompt: str, user_prompt: str, model_name: str,
+                       bypass: bool = False) -> Dict[str, Any]:
+        """Returns a cached response for this prompt, or awaits generate_fn and caches its answer unless it failed.
+
+        `bypass` skips the lookup but still stores the fresh answer, so it refreshes the entry.
+        """
+        cached = self.lookup(system_prompt, user_prompt, model_name, bypass)
+        if cached is not None:
+            return cached
+        response = await generate_fn(system_prompt, user_prompt, model_name=model_name)
+        self.store(system_prompt, user_prompt, model_name, response)
+        return response
+
+    def lookup(self, system_prompt: str, user_prompt: str, model_name: str,
+               bypass: bool = False) -> Optional[Dict[str, Any]]:
+        """The cached response for this prompt, or None when there is none or the caller bypasses the cache."""
+        if not self.enabled:
+            return None
+        if bypass:
+            with self._lock:
+                self.bypasses += 1
+            return None
+        return self.get(response_cache_key(system_prompt, user_prompt, model_name))
+
+    def store(self, system_prompt: str, user_prompt: str, model_name: str, response: Dict[str, Any]):
+        if self.enabled and "error" not in response:
+            self.put(response_cache_key(system_prompt, user_prompt, model_name), response)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._sizes),
+                "bytes": sum(self._sizes.values()),
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+def wants_fresh(cache_control: Optional[str]) -> bool:
+    """Whether a request's Cache-Control header asks to skip cached answers."""
+    return "no-cache" in {d.strip().lower() for d in (cache_control or "").split(",")}
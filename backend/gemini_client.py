@@ -1,10 +1,26 @@
-import os, json, tempfile
+import os, json, tempfile, hashlib, threading, time, asyncio, weakref
+from collections import OrderedDict
+from concurrent.futures import Future
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig, HarmCategory, HarmBlockThreshold
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Union, AsyncIterator
+
+try:
+    from .token_budget import PromptTier, TokenBudget
+except ImportError:
+    from token_budget import PromptTier, TokenBudget
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+# Uploaded files are deleted by Gemini after 48 hours; reuse stops this long before that
+GEMINI_FILE_TTL_SECONDS = float(os.getenv("GEMINI_FILE_TTL_SECONDS", str(47 * 3600)))
+GEMINI_FILE_EXPIRY_MARGIN_SECONDS = float(os.getenv("GEMINI_FILE_EXPIRY_MARGIN_SECONDS", "600"))
+GEMINI_UPLOAD_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_UPLOAD_CACHE_MAX_ENTRIES", "500"))
+# Calls in flight per model; more wait their turn instead of piling onto a slow backend
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_TEXT_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TEXT_TIMEOUT_SECONDS", "60"))
+GEMINI_ANALYSIS_TIMEOUT_SECONDS = float(os.getenv("GEMINI_ANALYSIS_TIMEOUT_SECONDS", "180"))
+
 PROMPT_BASE = """You are a music analysis AI expert for guitarists. Your goal is to provide the most accurate and commonly accepted chord progression for a given song, complete with lyrics, broken down by musical section.
 
 **Analysis Process:**
@@ -41,6 +57,9 @@ PROMPT_BASE = """You are a music analysis AI expert for guitarists. Your goal is
 }
 """
 
+# Used for the retry after a token-limit error
+FALLBACK_SYSTEM_PROMPT = "You are a helpful assistant. Respond concisely."
+
 # Simple patterns to detect token-limit related errors
 TOKEN_ERROR_PATTERNS = (
     "maximum token",
@@ -70,20 +89,146 @@ def _truncate(txt: Optional[str], max_len: int) -> str:
     return txt[:max_len]
 
 
-def generate_text_from_prompt(system_prompt: str, user_prompt: str, model_name: str) -> Dict[str, Any]:
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _expires_at(handle: Any) -> float:
+    """When Gemini will delete an uploaded file, from its handle when it says so."""
+    expiration = getattr(handle, "expiration_time", None)
+    if expiration is not None and hasattr(expiration, "timestamp"):
+        return expiration.timestamp()
+    return time.time() + GEMINI_FILE_TTL_SECONDS
+
+
+class UploadCache:
+    """remembers gemini file handles by a hash of the uploaded audio
+    asking about the same excerpt again reuses the remote file until shortly before it expires
+    concurrent requests for the same audio share one upload
+    handles the model rejects are dropped so the next request uploads afresh
+    """
+    def __init__(self, max_entries: int = GEMINI_UPLOAD_CACHE_MAX_ENTRIES,
+                 margin_seconds: float = GEMINI_FILE_EXPIRY_MARGIN_SECONDS):
+        self.max_entries = max_entries
+        self.margin_seconds = margin_seconds
+        self.hits = 0
+        self.uploads = 0
+        self.refreshes = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, local_path: str) -> Any:
+        """Returns a live remote handle for the file at `local_path`, uploading it only when needed."""
+        digest = file_digest(local_path)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                handle, expires_at = entry
+                if expires_at - self.margin_seconds > time.time():
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return handle
+                del self._entries[digest]
+                self.refreshes += 1
+            future = self._inflight.get(digest)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[digest] = future
+            else:
+                self.hits += 1  # rides on an upload already in flight
+        if owner:
+            try:
+                handle = genai.upload_file(local_path)
+                with self._lock:
+                    self.uploads += 1
+                    self._entries[digest] = (handle, _expires_at(handle))
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                future.set_result(handle)
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(digest, None)
+        return future.result()
+
+    def invalidate(self, handle: Any):
+        with self._lock:
+            for digest, (cached, _) in list(self._entries.items()):
+                if cached is handle:
+                    del self._entries[digest]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.uploads
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "uploads": self.uploads,
+                "refreshes": self.refreshes,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+upload_cache = UploadCache()
+
+# Richest first; a request starts at the tier the budget picks and only moves down
+ANALYSIS_TIERS = (
+    PromptTier("full", PROMPT_BASE, 8192),
+    PromptTier("simple", (
+        "You are a music analysis assistant. "
+        "Return a concise JSON with keys: tuning, key, difficulty, sections (max 2), and notes. "
+        "Each section has name and a chords string with minimal lines."
+    ), 2048),
+    PromptTier("brief", "Output a very short JSON: include at most one section and keep notes under 200 characters.", 1024),
+)
+analysis_budget = TokenBudget()
+
+# One semaphore per model for each event loop, since asyncio primitives cannot be shared between loops
+_model_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+
+
+def _model_slot(model_name: str) -> asyncio.Semaphore:
+    slots = _model_slots.setdefault(asyncio.get_running_loop(), {})
+    if model_name not in slots:
+        slots[model_name] = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    return slots[model_name]
+
+
+async def _generate(model, model_name: str, contents, timeout: float, **kwargs):
+    """One native async model call, waiting for a free slot for the model. `timeout` covers the wait
+    for the slot as well as the call, so it bounds the caller's latency however long the queue is."""
+    async def call():
+        async with _model_slot(model_name):
+            return await model.generate_content_async(contents, **kwargs)
+
+    return await asyncio.wait_for(call(), timeout)
+
+
+async def generate_text_from_prompt(system_prompt: str, user_prompt: str, model_name: str,
+                                    timeout: float = GEMINI_TEXT_TIMEOUT_SECONDS) -> Dict[str, Any]:
     model = genai.GenerativeModel(model_name)
     try:
         full_prompt = f"{system_prompt}\n\n{user_prompt}"
         cfg = GenerationConfig(max_output_tokens=2048)
-        resp = model.generate_content(full_prompt, generation_config=cfg)
+        resp = await _generate(model, model_name, full_prompt, timeout, generation_config=cfg)
         return {"text": resp.text or ""}
+    except asyncio.TimeoutError:
+        print(f"Gemini text generation timed out after {timeout:.0f}s")
+        return {"error": "The AI took too long to respond.", "error_code": "TIMEOUT",
+                "text": "Sorry, the AI took too long to respond. Please try again."}
     except Exception as e:
         if _looks_like_token_error(e):
             try:
-                simple_system = "You are a helpful assistant. Respond concisely."
                 simple_user = _truncate(user_prompt, 2000)
-                resp2 = model.generate_content(
-                    f"{simple_system}\n\n{simple_user}",
+                resp2 = await _generate(
+                    model, model_name, f"{FALLBACK_SYSTEM_PROMPT}\n\n{simple_user}", timeout,
                     generation_config=GenerationConfig(max_output_tokens=768),
                 )
                 return {"text": resp2.text or ""}
@@ -93,26 +238,98 @@ def generate_text_from_prompt(system_prompt: str, user_prompt: str, model_name:
         print(f"Error during Gemini text generation: {e}")
         return {"error": str(e), "text": "Sorry, an error occurred while contacting the AI."}
 
-def analyze_guitar_file(local_audio_path: str,
-                        model_name: str,
-                        user_prompt: Optional[str] = None,
-                        extra_context_json: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+async def _stream(model, model_name: str, contents, timeout: float, **kwargs) -> AsyncIterator[str]:
+    """Text chunks of one streamed model call. Holds a slot for the model until the stream ends,
+    and `timeout` bounds the wait for the slot plus the whole stream rather than each chunk."""
+    deadline = time.monotonic() + timeout
+    slot = _model_slot(model_name)
+    await asyncio.wait_for(slot.acquire(), timeout)
+    try:
+        response = await asyncio.wait_for(model.generate_content_async(contents, stream=True, **kwargs),
+                                          max(0.0, deadline - time.monotonic()))
+        chunks = response.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                return
+            try:
+                text = chunk.text
+            except ValueError:
+                text = ""  # a chunk with no text parts, e.g. only a finish reason
+            if text:
+                yield text
+    finally:
+        slot.release()
+
+
+async def stream_text_from_prompt(system_prompt: str, user_prompt: str, model_name: str,
+                                  timeout: float = GEMINI_TEXT_TIMEOUT_SECONDS) -> AsyncIterator[Dict[str, Any]]:
+    """Streams an answer as {"delta": text} events, ending with {"done": True, "text": full answer}
+    or an error event shaped like generate_text_from_prompt's errors.
+
+    A token-limit error retries once with the short fallback prompt, like generate_text_from_prompt;
+    if text was already sent, a {"reset": True} event tells the client to discard it first.
+    """
     model = genai.GenerativeModel(model_name)
+    attempts = [
+        (f"{system_prompt}\n\n{user_prompt}", 2048),
+        (f"{FALLBACK_SYSTEM_PROMPT}\n\n{_truncate(user_prompt, 2000)}", 768),
+    ]
+    for attempt, (prompt, max_tokens) in enumerate(attempts):
+        sent = []
+        try:
+            async for text in _stream(model, model_name, prompt, timeout,
+                                      generation_config=GenerationConfig(max_output_tokens=max_tokens)):
+                sent.append(text)
+                yield {"delta": text}
+            yield {"done": True, "text": "".join(sent)}
+            return
+        except asyncio.TimeoutError:
+            print(f"Gemini text stream timed out after {timeout:.0f}s")
+            yield {"error": "The AI took too long to respond.", "error_code": "TIMEOUT",
+                   "text": "Sorry, the AI took too long to respond. Please try again."}
+            return
+        except Exception as e:
+            if attempt == 0 and _looks_like_token_error(e):
+                if sent:
+                    yield {"reset": True}
+                continue
+            if attempt > 0:
+                print(f"Token fallback also failed: {e}")
+                yield {"error": str(e), "error_code": "TOKEN_LIMIT", "text": "Sorry, the request was too large to process. Try shortening it."}
+                return
+            print(f"Error during Gemini text streaming: {e}")
+            yield {"error": str(e), "text": "Sorry, an error occurred while contacting the AI."}
+            return
+
 
-    uploaded = genai.upload_file(local_audio_path)
+async def analyze_guitar_file(local_audio_path: str,
+                              model_name: str,
+                              user_prompt: Optional[str] = None,
+                              extra_context_json: Optional[Dict[str, Any]] = None,
+                              timeout: float = GEMINI_ANALYSIS_TIMEOUT_SECONDS,
+                              audio_seconds: Optional[float] = None,
+                              song_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """Analyzes the audio with the richest prompt tier the budget predicts will fit, falling back to cheaper tiers.
+
+    `audio_seconds` is the length of the file sent and `song_seconds` the length of the whole song; without
+    them the budget only counts the prompt and uses the shared history for unknown lengths.
+    """
+    model = genai.GenerativeModel(model_name)
 
-    parts = []
-    parts.append({"text": PROMPT_BASE})
+    # Hashing and uploading block, so they run on a worker thread
+    uploaded = await asyncio.to_thread(upload_cache.get, local_audio_path)
+
+    # Every tier carries the user's request and the song's context; only the instructions get simpler
+    request_parts = []
     if user_prompt:
-        parts.append({"text": f"User request: {user_prompt}"})
+        request_parts.append({"text": f"User request: {user_prompt}"})
     if extra_context_json:
         context_text = json.dumps(extra_context_json)
-        parts.append({"text": f"Supplemental JSON Data:\n{context_text}"})
+        request_parts.append({"text": f"Supplemental JSON Data:\n{context_text}"})
+    tier_parts = [[{"text": tier.prompt}] + request_parts for tier in ANALYSIS_TIERS]
 
-    parts.append(uploaded)
-    
-    config = GenerationConfig(max_output_tokens=8192)
-    
     safety_settings = {
         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -120,53 +337,47 @@ def analyze_guitar_file(local_audio_path: str,
         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
     }
 
-    try:
-        resp = model.generate_content(parts, generation_config=config, safety_settings=safety_settings)
-    except Exception as e:
-        if _looks_like_token_error(e):
-            try:
-                # Simpler prompt and smaller output budget
-                simple_prompt = {
-                    "text": (
-                        "You are a music analysis assistant. "
-                        "Return a concise JSON with keys: tuning, key, difficulty, sections (max 2), and notes. "
-                        "Each section has name and a chords string with minimal lines."
-                    )
-                }
-                parts_simple = [simple_prompt, uploaded]
-                resp = model.generate_content(
-                    parts_simple,
-                    generation_config=GenerationConfig(max_output_tokens=2048),
-                    safety_settings=safety_settings,
-                )
-            except Exception as e2:
-                print(f"Gemini token-limit fallback failed: {e2}")
+    first = analysis_budget.choose(ANALYSIS_TIERS, audio_seconds or 0.0, song_seconds,
+                                   [sum(len(part["text"]) for part in parts) for parts in tier_parts])
+    for index in range(first, len(ANALYSIS_TIERS)):
+        tier = ANALYSIS_TIERS[index]
+        last = index == len(ANALYSIS_TIERS) - 1
+        try:
+            resp = await _generate(model, model_name, tier_parts[index] + [uploaded], timeout,
+                                   generation_config=GenerationConfig(max_output_tokens=tier.max_output_tokens),
+                                   safety_settings=safety_settings)
+        except asyncio.TimeoutError:
+            print(f"Gemini analysis timed out after {timeout:.0f}s")
+            return {"error": "The analysis took too long. Please try again.", "error_code": "TIMEOUT"}
+        except Exception as e:
+            if not _looks_like_token_error(e):
+                print(f"Gemini analysis error: {e}")
+                # The remote file may be gone or unusable; do not hand it out again
+                upload_cache.invalidate(uploaded)
+                return {"error": str(e)}
+            print(f"Gemini '{tier.name}' analysis hit a token limit: {e}")
+            if last:
+                analysis_budget.record_fallback(index - first + 1)
                 return {"error": "The request was too large for the model to process. Try a shorter clip or simpler request.", "error_code": "TOKEN_LIMIT"}
-        else:
-            print(f"Gemini analysis error: {e}")
-            return {"error": str(e)}
+            continue
 
-    if not resp.candidates or resp.candidates[0].finish_reason.name != "STOP":
         reason = resp.candidates[0].finish_reason.name if resp.candidates else "NO_RESPONSE"
         if reason == "MAX_TOKENS":
-            try:
-                brief_prompt = {
-                    "text": (
-                        "Output a very short JSON: include at most one section and keep notes under 200 characters."
-                    )
-                }
-                resp = model.generate_content(
-                    [brief_prompt, uploaded],
-                    generation_config=GenerationConfig(max_output_tokens=1024),
-                    safety_settings=safety_settings,
-                )
-            except Exception as e3:
-                print(f"MAX_TOKENS fallback failed: {e3}")
+            analysis_budget.record(tier, song_seconds, None, truncated=True)
+            if last:
+                analysis_budget.record_fallback(index - first + 1)
                 return {"error": f"Analysis terminated due to output length. Please try again.", "error_code": "TOKEN_LIMIT"}
-        else:
+            continue
+        if reason != "STOP":
             print(f"Gemini analysis terminated with reason: {reason}")
             return {"error": f"Analysis terminated unexpectedly. Reason: {reason}. This can be intermittent, please try again."}
 
+        usage = getattr(resp, "usage_metadata", None)
+        analysis_budget.record(tier, song_seconds, getattr(usage, "candidates_token_count", None))
+        if index > first:
+            analysis_budget.record_fallback(index - first)
+        break
+
     text = resp.text or ""
 
     try:
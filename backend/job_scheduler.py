@@ -0,0 +1,247 @@
+import heapq
+import itertools
+import os
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class JobCancelled(BaseException):
+    """Raised inside a job once it has been cancelled.
+
+    Derives from BaseException (like asyncio.CancelledError) so the broad
+    `except Exception` handlers in the pipeline do not swallow it.
+    """
+
+
+class CancelToken:
+    """cancellation flag shared between the scheduler and a running job
+    the job checks it between stages and registers any child process on it
+    cancelling kills that process so demucs stops straight away
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._process: Optional[subprocess.Popen] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            process = self._process
+        if process is not None and process.poll() is None:
+            print(f"Killing separation process {process.pid}")
+            process.kill()
+
+    def attach_process(self, process: subprocess.Popen):
+        with self._lock:
+            self._process = process
+        if self.cancelled:
+            process.kill()
+
+    def detach_process(self):
+        with self._lock:
+            self._process = None
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+
+class SeparationJob:
+    """one queued unit of separation work
+    tracks priority owner and lifecycle state for queue reporting
+    """
+    def __init__(self, task_id: str, fn: Callable, args: Tuple, kwargs: Dict[str, Any],
+                 priority: int, owner: Optional[str], on_discard: Optional[Callable]):
+        self.task_id = task_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.owner = owner
+        self.on_discard = on_discard
+        self.token = CancelToken()
+        self.state = "queued"
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.finished = threading.Event()
+
+
+class QueueFull(Exception):
+    pass
+
+
+def default_concurrency(cpus_per_job: float, ram_per_job_gb: float) -> int:
+    """Derives how many separations fit on this machine from its cores and physical RAM."""
+    cpu_slots = int((os.cpu_count() or 1) // max(cpus_per_job, 1))
+    try:
+        total_ram_gb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+        ram_slots = int(total_ram_gb // max(ram_per_job_gb, 0.5))
+    except (ValueError, OSError, AttributeError):
+        ram_slots = cpu_slots
+    return max(1, min(cpu_slots, ram_slots))
+
+
+class SeparationScheduler:
+    """bounded priority queue of separation jobs
+    a fixed number of worker threads pull jobs so bursts wait instead of thrashing
+    lower priority numbers run first and equal priorities run in arrival order
+    queued jobs can be dropped and running ones cancelled through their token
+    """
+    def __init__(self, max_concurrent: int = 1, max_queued: int = 100, history_size: int = 500,
+                 ram_per_job_mb: Optional[float] = None):
+        self.max_concurrent = max(1, max_concurrent)
+        # What each job is budgeted, so separations size themselves to their share
+        self.ram_per_job_mb = ram_per_job_mb
+        self.max_queued = max_queued
+        self.history_size = history_size
+        self._heap: List[Tuple[int, int, SeparationJob]] = []
+        self._jobs: Dict[str, SeparationJob] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._shutdown = False
+
+    @classmethod
+    def from_env(cls) -> "SeparationScheduler":
+        cpus_per_job = float(os.getenv("SEPARATION_CPUS_PER_JOB", "2"))
+        ram_per_job_gb = float(os.getenv("SEPARATION_RAM_PER_JOB_GB", "4"))
+        configured = os.getenv("SEPARATION_MAX_CONCURRENT")
+        max_concurrent = int(configured) if configured else default_concurrency(cpus_per_job, ram_per_job_gb)
+        return cls(max_concurrent=max_concurrent, max_queued=int(os.getenv("SEPARATION_MAX_QUEUED", "100")),
+                   ram_per_job_mb=ram_per_job_gb * 1024)
+
+    def _ensure_workers(self):
+        self._workers = [w for w in self._workers if w.is_alive()]
+        while len(self._workers) < self.max_concurrent:
+            worker = threading.Thread(target=self._worker_loop, name=f"separation-worker-{len(self._workers)}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, task_id: str, fn: Callable, args: Tuple = (), kwargs: Optional[Dict[str, Any]] = None,
+               priority: int = 0, owner: Optional[str] = None, on_discard: Optional[Callable] = None) -> int:
+        """Queues a job and returns its 1-based queue position. The job receives `cancel_token` as a keyword."""
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Scheduler is shut down.")
+            if self._queued_count() >= self.max_queued:
+                raise QueueFull(f"Separation queue is full ({self.max_queued} jobs waiting).")
+            job = SeparationJob(task_id, fn, args, dict(kwargs or {}), priority, owner, on_discard)
+            self._jobs[task_id] = job
+            heapq.heappush(self._heap, (priority, next(self._seq), job))
+            self._ensure_workers()
+            self._cond.notify()
+            return self._position_locked(job)
+
+    def _queued_count(self) -> int:
+        return sum(1 for _, _, job in self._heap if job.state == "queued")
+
+    def _position_locked(self, job: SeparationJob) -> Optional[int]:
+        if job.state != "queued":
+            return None
+        ahead = [entry for entry in sorted(self._heap) if entry[2].state == "queued"]
+        for index, (_, _, queued) in enumerate(ahead):
+            if queued is job:
+                return index + 1
+        return None
+
+    def position(self, task_id: str) -> Optional[int]:
+        """1-based position among waiting jobs, or None if the job is not waiting."""
+        with self._cond:
+            job = self._jobs.get(task_id)
+            return self._position_locked(job) if job else None
+
+    def get(self, task_id: str) -> Optional[SeparationJob]:
+        with self._cond:
+            return self._jobs.get(task_id)
+
+    def snapshot(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            job = self._jobs.get(task_id)
+            if job is None:
+                return None
+            return {
+                "taskId": job.task_id,
+                "state": job.state,
+                "position": self._position_locked(job),
+                "priority": job.priority,
+                "error": job.error,
+            }
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            running = sum(1 for job in self._jobs.values() if job.state == "running")
+            return {"maxConcurrent": self.max_concurrent, "running": running, "queued": self._queued_count()}
+
+    def cancel(self, task_id: str, owner: Optional[str] = None) -> bool:
+        """Drops a waiting job or stops a running one. Returns False if there was nothing to cancel."""
+        with self._cond:
+            job = self._jobs.get(task_id)
+            if job is None or job.state not in ("queued", "running"):
+                return False
+            if owner is not None and job.owner is not None and job.owner != owner:
+                return False
+            was_queued = job.state == "queued"
+            job.state = "cancelled"
+            job.token.cancel()
+        if was_queued:
+            print(f"[{task_id}] Removed from separation queue.")
+            self._finish(job)
+            if job.on_discard:
+                job.on_discard()
+        else:
+            print(f"[{task_id}] Cancellation requested for running separation.")
+        return True
+
+    def wait(self, task_id: str, timeout: Optional[float] = None) -> bool:
+        job = self.get(task_id)
+        return job.finished.wait(timeout) if job else True
+
+    def _finish(self, job: SeparationJob):
+        job.finished_at = time.time()
+        job.finished.set()
+        with self._cond:
+            done = [j for j in self._jobs.values() if j.finished.is_set()]
+            for old in sorted(done, key=lambda j: j.finished_at)[:max(0, len(done) - self.history_size)]:
+                self._jobs.pop(old.task_id, None)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not self._heap:
+                    self._cond.wait()
+                if self._shutdown:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                if job.state != "queued":
+                    continue
+                job.state = "running"
+                job.started_at = time.time()
+            try:
+                job.fn(*job.args, cancel_token=job.token, **job.kwargs)
+                job.state = "cancelled" if job.token.cancelled else "done"
+            except JobCancelled:
+                job.state = "cancelled"
+                print(f"[{job.task_id}] Separation cancelled.")
+            except Exception as e:
+                job.state = "failed"
+                job.error = str(e)
+                print(f"[{job.task_id}] Separation job failed: {e}")
+            finally:
+                self._finish(job)
+
+    def shutdown(self):
+        """Stops accepting work, drops queued jobs and cancels running ones."""
+        with self._cond:
+            self._shutdown = True
+            pending = [job for job in self._jobs.values() if job.state in ("queued", "running")]
+            self._cond.notify_all()
+        for job in pending:
+            self.cancel(job.task_id)
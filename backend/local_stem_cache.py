@@ -0,0 +1,266 @@
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+STEM_CACHE_DIR = Path(os.getenv("STEM_CACHE_DIR", str(Path(__file__).parent / "stem_cache")))
+STEM_CACHE_MAX_MB = float(os.getenv("STEM_CACHE_MAX_MB", "2048"))
+# Stems are immutable once published, so they are re-checked against S3 at most this often;
+# manifests change in place and are checked on every read
+STEM_CACHE_VERIFY_SECONDS = float(os.getenv("STEM_CACHE_VERIFY_SECONDS", "60"))
+# The multipart part size stems are published with, so ETags of files found on disk can be recomputed
+STEM_UPLOAD_CHUNK_BYTES = int(os.getenv("STEM_UPLOAD_CHUNK_MB", "8")) * 1024 * 1024
+
+
+def s3_etag(path: Path, chunk_size: Optional[int] = None, threshold: Optional[int] = None) -> str:
+    """The ETag S3 gives this file when uploaded with the given multipart chunk size and threshold."""
+    size = path.stat().st_size
+    with open(path, "rb") as f:
+        if not chunk_size or size < (threshold or chunk_size):
+            digest = hashlib.md5()
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+            return digest.hexdigest()
+        parts = [hashlib.md5(block).digest() for block in iter(lambda: f.read(chunk_size), b"")]
+    return f"{hashlib.md5(b''.join(parts)).hexdigest()}-{len(parts)}"
+
+
+class _Entry:
+    def __init__(self, path: Path, size: int, etag: Optional[str]):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.verified_at = time.time()
+        self.pins = 0
+
+
+class LocalStemCache:
+    """size bounded on disk cache of published stems and manifests
+    separation fills it as it uploads so the server never downloads what it just produced
+    readers get a memory mapped view or a pinned path instead of a copy in python bytes
+    entries are checked against the s3 etag and refetched when the object changed
+    least recently used entries are evicted once max_bytes is exceeded unless pinned
+    the directory may be shared by several workers, so files already on disk are indexed rather than removed
+    """
+    def __init__(self, root: Path = STEM_CACHE_DIR, max_bytes: int = int(STEM_CACHE_MAX_MB * 1024 * 1024),
+                 verify_seconds: float = STEM_CACHE_VERIFY_SECONDS, chunk_size: int = STEM_UPLOAD_CHUNK_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.verify_seconds = verify_seconds
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        # Local file name -> entry, least recently used first; file mtimes carry the order across restarts
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        existing = [p for p in self.root.glob("*/*") if p.is_file() and not p.name.endswith(".part")]
+        for path in sorted(existing, key=lambda p: p.stat().st_mtime):
+            # The ETag is recomputed when the entry is first verified, which every recovered entry must be
+            entry = _Entry(path, path.stat().st_size, None)
+            entry.verified_at = 0.0
+            self._entries[path.name] = entry
+        with self._lock:
+            evicted = self._evict_locked()
+        for old_path in evicted:
+            old_path.unlink(missing_ok=True)
+
+    def _name(self, key: str) -> str:
+        return f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}{Path(key).suffix}"
+
+    def _local_path(self, key: str) -> Path:
+        name = self._name(key)
+        return self.root / name[:2] / name
+
+    def _partial_path(self, target: Path) -> Path:
+        # Other worker processes may be filling the same directory
+        return target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.part")
+
+    def _key_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(name, threading.Lock())
+
+    def _evict_locked(self, keep: Optional[str] = None) -> list:
+        """Drops least recently used unpinned entries until the cache fits, returning their paths to delete."""
+        evicted = []
+        total = sum(e.size for e in self._entries.values())
+        for old_name in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            candidate = self._entries[old_name]
+            if old_name == keep or candidate.pins:
+                continue
+            del self._entries[old_name]
+            self._key_locks.pop(old_name, None)
+            total -= candidate.size
+            evicted.append(candidate.path)
+            self.evictions += 1
+        return evicted
+
+    def _add(self, key: str, path: Path, etag: Optional[str], pin: bool = False):
+        name = self._name(key)
+        with self._lock:
+            self._entries.pop(name, None)
+            entry = _Entry(path, path.stat().st_size, etag)
+            entry.pins = 1 if pin else 0
+            self._entries[name] = entry
+            evicted = self._evict_locked(keep=name)
+        for old_path in evicted:
+            old_path.unlink(missing_ok=True)
+
+    def put_file(self, key: str, source: Path, chunk_size: Optional[int] = None, threshold: Optional[int] = None):
+        """Copies a file just uploaded to `key`, recording the ETag S3 will report for it."""
+        target = self._local_path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        partial = self._partial_path(target)
+        partial.unlink(missing_ok=True)
+        try:
+            # A hard link costs no copy and survives the separation output directory being removed
+            os.link(source, partial)
+        except OSError:
+            shutil.copyfile(source, partial)
+        os.replace(partial, target)
+        self._add(key, target, s3_etag(target, chunk_size, threshold))
+
+    def put_bytes(self, key: str, data: bytes):
+        """Stores an object just written with put_object, such as a manifest."""
+        target = self._local_path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        partial = self._partial_path(target)
+        partial.write_bytes(data)
+        os.replace(partial, target)
+        self._add(key, target, hashlib.md5(data).hexdigest())
+
+    def contains(self, key: str) -> bool:
+        """Whether a local copy of `key` exists, without checking it against S3."""
+        with self._lock:
+            return self._name(key) in self._entries
+
+    def invalidate(self, key: str):
+        name = self._name(key)
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            self._key_locks.pop(name, None)
+        if entry is not None and not entry.pins:
+            entry.path.unlink(missing_ok=True)
+
+    def _acquire(self, s3_client, bucket: str, key: str) -> _Entry:
+        """Makes sure a verified local copy exists and returns its entry already pinned."""
+        name = self._name(key)
+        with self._key_lock(name):
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    # Pinned before checking, so nothing evicts it in between
+                    entry.pins += 1
+            if entry is not None and not entry.path.exists():
+                # Another worker sharing the directory evicted it
+                with self._lock:
+                    entry.pins -= 1
+                    if self._entries.get(name) is entry:
+                        del self._entries[name]
+                entry = None
+            if entry is not None:
+                fresh = not key.endswith(".json") and time.time() - entry.verified_at <= self.verify_seconds
+                try:
+                    if not fresh:
+                        remote = s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+                        if entry.etag is None:
+                            entry.etag = s3_etag(entry.path, self.chunk_size if "-" in remote else None)
+                        fresh = remote == entry.etag
+                        if fresh:
+                            entry.verified_at = time.time()
+                except BaseException:
+                    with self._lock:
+                        entry.pins -= 1
+                    raise
+                if fresh:
+                    os.utime(entry.path)
+                    with self._lock:
+                        if self._entries.get(name) is entry:
+                            self._entries.move_to_end(name)
+                        self.hits += 1
+                    return entry
+                with self._lock:
+                    entry.pins -= 1
+                    self.stale += 1
+                print(f"Local copy of {key} is stale (ETag changed); fetching it again.")
+
+            target = self._local_path(key)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            partial = self._partial_path(target)
+            try:
+                s3_client.download_file(bucket, key, str(partial))
+                os.replace(partial, target)
+                etag = s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+            except BaseException:
+                # Keys that were never cached, such as missing objects, keep no lock behind
+                with self._lock:
+                    if name not in self._entries:
+                        self._key_locks.pop(name, None)
+                raise
+            with self._lock:
+                self.misses += 1
+            self._add(key, target, etag, pin=True)
+            with self._lock:
+                return self._entries[name]
+
+    @contextmanager
+    def pinned(self, s3_client, bucket: str, key: str) -> Iterator[Path]:
+        """Yields a local path for `key` that will not be evicted until the block exits."""
+        entry = self._acquire(s3_client, bucket, key)
+        try:
+            yield entry.path
+        finally:
+            with self._lock:
+                entry.pins -= 1
+
+    @contextmanager
+    def mapped(self, s3_client, bucket: str, key: str) -> Iterator[mmap.mmap]:
+        """Yields a read-only memory map of `key`. Views into it must be released before the block exits."""
+        with self.pinned(s3_client, bucket, key) as path:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    yield b""  # empty files cannot be mapped
+                    return
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    yield view
+                finally:
+                    view.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e.size for e in self._entries.values()),
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+_stem_cache: Optional[LocalStemCache] = None
+_stem_cache_lock = threading.Lock()
+
+
+def get_stem_cache() -> LocalStemCache:
+    """Shared cache for this process, created on first use."""
+    global _stem_cache
+    with _stem_cache_lock:
+        if _stem_cache is None:
+            _stem_cache = LocalStemCache()
+        return _stem_cache
@@ -0,0 +1,335 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+import wave
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+try:
+    from .local_stem_cache import get_stem_cache
+except ImportError:
+    from local_stem_cache import get_stem_cache
+
+LOOP_CACHE_DIR = Path(os.getenv("LOOP_CACHE_DIR", str(Path(__file__).parent / "rendered_loops")))
+LOOP_CACHE_MAX_ENTRIES = int(os.getenv("LOOP_CACHE_MAX_ENTRIES", "200"))
+LOOP_RENDER_WORKERS = int(os.getenv("LOOP_RENDER_WORKERS", "2"))
+LOOP_PRERENDER_SPEEDS = [float(s) for s in os.getenv("LOOP_PRERENDER_SPEEDS", "0.5,0.75").split(",") if s.strip()]
+# Background renders waiting or running at once; saves beyond this are not pre-rendered
+LOOP_PRERENDER_MAX_QUEUED = int(os.getenv("LOOP_PRERENDER_MAX_QUEUED", "32"))
+MIN_SPEED, MAX_SPEED = 0.25, 2.0
+MAX_GAIN = 2.0
+MAX_LOOP_SECONDS = float(os.getenv("MAX_LOOP_SECONDS", "120"))
+# Seekable, lossless renditions are preferred as render sources
+SOURCE_RENDITIONS = ("wav", "flac", "mp3", "opus", "aac")
+# Output frames the phase vocoder synthesises at once; bounds its memory whatever the loop length and speed
+STRETCH_BLOCK_FRAMES = int(os.getenv("STRETCH_BLOCK_FRAMES", "256"))
+
+
+def read_region(path: str, start: float, end: float, sample_rate: int = 44100) -> Tuple[np.ndarray, int]:
+    """Reads start..end seconds as (samples, 2) float32. PCM WAV is seeked directly, anything else goes through ffmpeg."""
+    if path.lower().endswith(".wav"):
+        try:
+            with wave.open(path, "rb") as wav:
+                rate, channels, width = wav.getframerate(), wav.getnchannels(), wav.getsampwidth()
+                if width == 2:
+                    wav.setpos(min(int(start * rate), wav.getnframes()))
+                    raw = wav.readframes(max(0, int((end - start) * rate)))
+                    audio = np.frombuffer(raw, dtype="<i2").astype(np.float32).reshape(-1, channels) / 32768
+                    return (np.repeat(audio, 2, axis=1) if channels == 1 else audio[:, :2]), rate
+        except (wave.Error, EOFError):
+            pass
+    command = ["ffmpeg", "-v", "error", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", path,
+               "-f", "f32le", "-ac", "2", "-ar", str(sample_rate), "-"]
+    result = subprocess.run(command, capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype="<f4").reshape(-1, 2), sample_rate
+
+
+def stretch_blocks(audio: np.ndarray, speed: float, n_fft: int = 2048, hop: int = 512,
+                   block_frames: int = STRETCH_BLOCK_FRAMES) -> Iterator[np.ndarray]:
+    """Changes tempo by `speed` (0.5 is half speed) without changing pitch, using a phase vocoder.
+
+    Output frames are synthesised `block_frames` at a time, each block vectorised over its frames, so
+    memory stays bounded however long the loop or slow the speed. The phase accumulator and the
+    overlap-add tail carry over between blocks, and finished samples are yielded as float32 chunks.
+    """
+    if abs(speed - 1.0) < 1e-6 or len(audio) < n_fft:
+        yield audio
+        return
+    window = np.hanning(n_fft).astype(np.float32)
+    padded = np.pad(audio, ((n_fft // 2, n_fft), (0, 0)))
+    frames = np.lib.stride_tricks.sliding_window_view(padded, n_fft, axis=0)[::hop]  # (frames, channels, n_fft)
+    steps = np.arange(0, frames.shape[0] - 1, speed)
+    expected = 2 * np.pi * hop * np.arange(n_fft // 2 + 1) / n_fft
+    channels = audio.shape[1]
+    phase = None
+    tail, tail_norm = np.zeros((n_fft, channels)), np.zeros(n_fft)
+    skip, remaining = n_fft // 2, int(round(len(audio) / speed))
+
+    def emit(samples: np.ndarray, norm: np.ndarray) -> Optional[np.ndarray]:
+        nonlocal skip, remaining
+        samples = (samples / np.maximum(norm, 1e-3)[:, None])[skip:skip + remaining]
+        skip = max(0, skip - len(norm))
+        remaining -= len(samples)
+        return samples.astype(np.float32) if len(samples) else None
+
+    for first in range(0, len(steps), block_frames):
+        block = steps[first:first + block_frames]
+        index = block.astype(int)
+        low = index[0]
+        spectrum = np.fft.rfft(frames[low:index[-1] + 2] * window, axis=2)
+        left, right = spectrum[index - low], spectrum[index - low + 1]
+        alpha = (block - index)[:, None, None]
+        magnitude = (1 - alpha) * np.abs(left) + alpha * np.abs(right)
+
+        deviation = np.angle(right) - np.angle(left) - expected
+        deviation -= 2 * np.pi * np.round(deviation / (2 * np.pi))
+        advance = expected + deviation
+        if phase is None:
+            phase = np.angle(spectrum[0])
+        # Each output frame takes the phase accumulated over all earlier frames, including earlier blocks
+        block_phase = phase[None] + np.cumsum(advance, axis=0) - advance
+        phase = block_phase[-1] + advance[-1]
+        stretched = np.fft.irfft(magnitude * np.exp(1j * block_phase), n=n_fft, axis=2) * window
+
+        done = len(block) * hop
+        output = np.zeros((done + n_fft, channels))
+        norm = np.zeros(done + n_fft)
+        output[:n_fft] += tail
+        norm[:n_fft] += tail_norm
+        positions = (np.arange(len(block)) * hop)[:, None] + np.arange(n_fft)
+        for channel in range(channels):
+            np.add.at(output[:, channel], positions, stretched[:, channel])
+        np.add.at(norm, positions, np.broadcast_to(window ** 2, positions.shape))
+        # Later blocks only overlap the last n_fft samples, so everything before them is final
+        tail, tail_norm = output[done:], norm[done:]
+        chunk = emit(output[:done], norm[:done])
+        if chunk is not None:
+            yield chunk
+    chunk = emit(tail, tail_norm)
+    if chunk is not None:
+        yield chunk
+
+
+def time_stretch(audio: np.ndarray, speed: float, n_fft: int = 2048, hop: int = 512) -> np.ndarray:
+    """The whole output of stretch_blocks as one array."""
+    return np.concatenate(list(stretch_blocks(audio, speed, n_fft, hop)))
+
+
+def render_loop(guitar_path: str, backing_path: str, start: float, end: float, speed: float,
+                guitar_gain: float, backing_gain: float, out_path: str) -> str:
+    """Mixes the two stems over start..end at the given gains and tempo and writes a 16-bit WAV.
+    Runs inside the render process pool."""
+    guitar, rate = read_region(guitar_path, start, end)
+    backing, _ = read_region(backing_path, start, end, rate)
+    length = min(len(guitar), len(backing))
+    mix = guitar[:length] * guitar_gain + backing[:length] * backing_gain
+    with wave.open(out_path, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        for chunk in stretch_blocks(mix, speed):
+            wav.writeframes((np.clip(chunk, -1, 1) * 32767).astype("<i2").tobytes())
+    return out_path
+
+
+def loop_cache_key(username: str, task_id: str, bookmark: Dict[str, Any], speed: float,
+                   guitar_gain: float, backing_gain: float) -> str:
+    # The range rather than the bookmark id, so editing a bookmark never serves a stale render
+    raw = (f"{username}/{task_id}|{float(bookmark['start']):.3f}|{float(bookmark['end']):.3f}|"
+           f"{speed:.3f}|{guitar_gain:.3f}|{backing_gain:.3f}")
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LoopRenderer:
+    """renders bookmarked practice loops at a chosen speed and stem balance on the server
+    time stretching runs in a process pool so it never holds the request threads
+    finished clips are kept on disk and evicted least recently used first
+    concurrent requests for the same clip share one render
+    pre-rendering is bounded and skips clips already cached or queued
+    """
+    def __init__(self, cache_dir: Path = LOOP_CACHE_DIR, max_entries: int = LOOP_CACHE_MAX_ENTRIES,
+                 workers: int = LOOP_RENDER_WORKERS, max_prerender_queued: int = LOOP_PRERENDER_MAX_QUEUED):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.evictions = 0
+        self.max_prerender_queued = max_prerender_queued
+        self.prerender_skipped = 0
+        self.prerender_dropped = 0
+        self._entries: "OrderedDict[str, Path]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._prerender_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="loop-prerender")
+        self._prerender_queued: Set[str] = set()
+        for existing in sorted(self.cache_dir.glob("*.wav"), key=lambda p: p.stat().st_mtime):
+            self._entries[existing.stem] = existing
+
+    def _process_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _pin_sources(self, s3_client, bucket: str, username: str, task_id: str, stack: ExitStack) -> Tuple[str, str]:
+        """Local copies of the guitar and backing stems from the stem cache, held until `stack` closes."""
+        cache = get_stem_cache()
+        with cache.mapped(s3_client, bucket, f"stems/{username}/{task_id}/manifest.json") as view:
+            manifest = json.loads(view[:])
+        paths = []
+        for stem in ("guitar", "backingTrack"):
+            options = manifest.get("renditions", {}).get(stem, {})
+            url = next((options[name] for name in SOURCE_RENDITIONS if name in options), None)
+            url = url or manifest.get("stems", {}).get(stem)
+            if not url:
+                raise LookupError(f"The project has no {stem} stem.")
+            key = urllib.parse.unquote(urllib.parse.urlparse(url).path.lstrip("/"))
+            paths.append(str(stack.enter_context(cache.pinned(s3_client, bucket, key))))
+        return paths[0], paths[1]
+
+    def _render(self, key: str, s3_client, bucket: str, username: str, task_id: str,
+                bookmark: Dict[str, Any], speed: float, guitar_gain: float, backing_gain: float) -> Path:
+        work_dir = Path(tempfile.mkdtemp(prefix="loop-"))
+        try:
+            with ExitStack() as stack:
+                guitar, backing = self._pin_sources(s3_client, bucket, username, task_id, stack)
+                partial = str(work_dir / f"{key}.wav")
+                args = (guitar, backing, float(bookmark["start"]), float(bookmark["end"]), speed,
+                        guitar_gain, backing_gain, partial)
+                pool = self._process_pool()
+                pool.submit(render_loop, *args).result() if pool else render_loop(*args)
+            target = self.cache_dir / f"{key}.wav"
+            shutil.move(partial, target)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        evicted = []
+        with self._lock:
+            self.renders += 1
+            self._entries[key] = target
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+                self.evictions += 1
+        for path in evicted:
+            path.unlink(missing_ok=True)
+        return target
+
+    def render(self, s3_client, bucket: str, username: str, task_id: str, bookmark: Dict[str, Any],
+               speed: float = 1.0, guitar_gain: float = 1.0, backing_gain: float = 1.0) -> Tuple[Path, bool]:
+        """Returns (path to the rendered WAV, whether it came from the cache). Blocks until rendered."""
+        key = loop_cache_key(username, task_id, bookmark, speed, guitar_gain, backing_gain)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached.exists():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached, True
+            self.misses += 1
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if owner:
+            try:
+                future.set_result(self._render(key, s3_client, bucket, username, task_id, bookmark,
+                                               speed, guitar_gain, backing_gain))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        return future.result(), False
+
+    def open(self, s3_client, bucket: str, username: str, task_id: str, bookmark: Dict[str, Any],
+             speed: float = 1.0, guitar_gain: float = 1.0, backing_gain: float = 1.0) -> Tuple[BinaryIO, bool]:
+        """Like render, but returns the clip opened for reading. An open handle keeps the data readable
+        if the entry is evicted or replaced while a response is still streaming it."""
+        for _ in range(3):
+            path, cached = self.render(s3_client, bucket, username, task_id, bookmark, speed, guitar_gain, backing_gain)
+            try:
+                return open(path, "rb"), cached
+            except FileNotFoundError:
+                # Evicted between rendering and opening, so render it again
+                continue
+        raise FileNotFoundError(f"Loop clip for task {task_id} kept being evicted before it could be opened.")
+
+    def prerender(self, s3_client, bucket: str, username: str, task_id: str, bookmarks: List[Dict[str, Any]],
+                  speeds: List[float] = None) -> List[Future]:
+        """Queues background renders of every bookmark at the common practice speeds.
+
+        Clips already cached, rendering or queued are skipped, and once max_prerender_queued renders are
+        pending the rest are dropped; they are rendered on first request instead.
+        """
+        futures = []
+        for bookmark in bookmarks:
+            if float(bookmark["end"]) - float(bookmark["start"]) > MAX_LOOP_SECONDS:
+                continue
+            for speed in (speeds if speeds is not None else LOOP_PRERENDER_SPEEDS):
+                key = loop_cache_key(username, task_id, bookmark, speed, 1.0, 1.0)
+                with self._lock:
+                    if key in self._entries or key in self._inflight or key in self._prerender_queued:
+                        self.prerender_skipped += 1
+                        continue
+                    if len(self._prerender_queued) >= self.max_prerender_queued:
+                        self.prerender_dropped += 1
+                        continue
+                    self._prerender_queued.add(key)
+                try:
+                    futures.append(self._prerender_pool.submit(
+                        self._prerender_one, key, s3_client, bucket, username, task_id, bookmark, speed))
+                except RuntimeError:
+                    # The pool is shutting down
+                    with self._lock:
+                        self._prerender_queued.discard(key)
+        return futures
+
+    def _prerender_one(self, key, s3_client, bucket, username, task_id, bookmark, speed):
+        try:
+            self.render(s3_client, bucket, username, task_id, bookmark, speed)
+        except Exception as e:
+            print(f"Pre-rendering loop {bookmark.get('id')} at {speed}x for task {task_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._prerender_queued.discard(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "renders": self.renders,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "prerenderQueued": len(self._prerender_queued),
+                "prerenderSkipped": self.prerender_skipped,
+                "prerenderDropped": self.prerender_dropped,
+            }
+
+    def shutdown(self):
+        self._prerender_pool.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
@@ -1,54 +1,157 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Form, Body, Depends, Request
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Body, Depends, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pathlib import Path
 import os
 import uuid
 import json
+import hashlib
+import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
 
 import boto3
+from botocore.config import Config
 from passlib.context import CryptContext
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import shutil
 from fastapi import Query
 try:
-    from .gemini_client import analyze_guitar_file, generate_text_from_prompt
+    from .gemini_client import analysis_budget, analyze_guitar_file, generate_text_from_prompt, stream_text_from_prompt, upload_cache
 except ImportError:
-    from gemini_client import analyze_guitar_file, generate_text_from_prompt
-import requests
-import tempfile
-import urllib.parse
-import subprocess
+    from gemini_client import analysis_budget, analyze_guitar_file, generate_text_from_prompt, stream_text_from_prompt, upload_cache
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 
 try:
-    from .stem_separation import DemucsSeparator
+    from .gemini_cache import ResponseCache, response_cache_key, wants_fresh
+except ImportError:
+    from gemini_cache import ResponseCache, response_cache_key, wants_fresh
+
+try:
+    from .single_flight import AsyncSingleFlight, SingleFlight, fingerprint
+except ImportError:
+    from single_flight import AsyncSingleFlight, SingleFlight, fingerprint
+
+try:
+    from .song_identification import BATCH_SYSTEM_PROMPT, UNKNOWN_ARTIST, batch_user_prompt, identify_locally, parse_batch_response
+except ImportError:
+    from song_identification import BATCH_SYSTEM_PROMPT, UNKNOWN_ARTIST, batch_user_prompt, identify_locally, parse_batch_response
+
+try:
+    from .job_scheduler import CancelToken, QueueFull, SeparationScheduler
+except ImportError:
+    from job_scheduler import CancelToken, QueueFull, SeparationScheduler
+
+try:
+    from .separation_cache import SeparationCache, make_cache_key
+except ImportError:
+    from separation_cache import SeparationCache, make_cache_key
+
+try:
+    from .task_status import TERMINAL_STATES, TaskStatusRegistry, sse_event
+except ImportError:
+    from task_status import TERMINAL_STATES, TaskStatusRegistry, sse_event
+
+try:
+    from .loop_rendering import MAX_GAIN, MAX_LOOP_SECONDS, MAX_SPEED, MIN_SPEED, LoopRenderer
+except ImportError:
+    from loop_rendering import MAX_GAIN, MAX_LOOP_SECONDS, MAX_SPEED, MIN_SPEED, LoopRenderer
+
+try:
+    from .local_stem_cache import get_stem_cache
+except ImportError:
+    from local_stem_cache import get_stem_cache
+
+try:
+    from .stem_mixing import SIX_STEM_SOURCES, StemMixer
+except ImportError:
+    from stem_mixing import SIX_STEM_SOURCES, StemMixer
+
+try:
+    from .stem_activity import ActivityMap, densest_windows
+except ImportError:
+    from stem_activity import ActivityMap, densest_windows
+
+try:
+    from .stem_excerpts import EXCERPT_SECONDS, ExcerptExtractor, excerpt_sources
+except ImportError:
+    from stem_excerpts import EXCERPT_SECONDS, ExcerptExtractor, excerpt_sources
+
+try:
+    from .waveform_peaks import decode_pyramid, peak_window
+except ImportError:
+    from waveform_peaks import decode_pyramid, peak_window
+
+try:
+    from .stem_separation import (
+        DemucsSeparator, SEPARATION_ENGINE, SEPARATION_STREAMING, get_engine, shutdown_analysis_pool
+    )
 except ImportError: 
-    from stem_separation import DemucsSeparator
+    from stem_separation import (
+        DemucsSeparator, SEPARATION_ENGINE, SEPARATION_STREAMING, get_engine, shutdown_analysis_pool
+    )
 
 
 # Hashes using bcrypt algorithm
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-# Initialize S3
+# Initialize S3 with a connection pool large enough for parallel multipart stem uploads
 s3_client = boto3.client(
     's3',
     aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
+    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+    config=Config(max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50")))
 )
 BUCKET_NAME = os.getenv("AWS_S3_BUCKET_NAME")
 AWS_REGION = os.getenv("AWS_REGION", "eu-west-2")
 TEMP_UPLOAD_DIR = Path(__file__).parent / "temp_uploads"
 TEMP_UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Bounded worker pool for separations, sized from SEPARATION_MAX_CONCURRENT or the CPU/RAM budget
+separation_scheduler = SeparationScheduler.from_env()
+SEPARATION_CACHE_ENABLED = os.getenv("SEPARATION_CACHE_ENABLED", "1") != "0"
+separation_cache = SeparationCache(max_entries=int(os.getenv("SEPARATION_CACHE_MAX_ENTRIES", "500")))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+task_statuses = TaskStatusRegistry()
+SSE_POLL_SECONDS = 0.5
+SSE_HEARTBEAT_SECONDS = 15
+# With the worker on the same machine as the API, separate straight from the uploaded temp file.
+# The original is archived to S3 alongside separation ("concurrent"), after it ("deferred") or not at all ("off").
+SEPARATION_LOCAL_HANDOFF = os.getenv("SEPARATION_LOCAL_HANDOFF", "1") == "1"
+UPLOAD_ARCHIVE_MODE = os.getenv("UPLOAD_ARCHIVE_MODE", "concurrent")
+archive_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload-archive")
+loop_renderer = LoopRenderer()
+stem_mixer = StemMixer()
+excerpt_extractor = ExcerptExtractor()
+response_cache = ResponseCache()
+# Identical requests in flight at the same time share one model call or one separation
+ai_flights = AsyncSingleFlight()
+separation_flights = SingleFlight()
+# Filenames per model call for bulk identification; each retry round halves it
+IDENTIFY_BATCH_SIZE = int(os.getenv("IDENTIFY_BATCH_SIZE", "40"))
+IDENTIFY_BATCH_RETRIES = int(os.getenv("IDENTIFY_BATCH_RETRIES", "2"))
+IDENTIFY_BATCH_MAX_ITEMS = int(os.getenv("IDENTIFY_BATCH_MAX_ITEMS", "1000"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_separation_engine()
+    yield
+    separation_scheduler.shutdown()
+    archive_executor.shutdown(wait=True)
+    shutdown_analysis_pool()
+    loop_renderer.shutdown()
+
 
 app = FastAPI(
     title="SongAssist API",
     description="An API for separating audio stems using Demucs.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -57,10 +160,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Loop-Cache", "X-Peaks-Level", "X-Peaks-Levels", "X-Peaks-Sample-Rate", "X-Peaks-Samples-Per-Bin",
+                    "X-Peaks-Start-Bin", "X-Peaks-Bins"],
 )
 
+SEPARATION_MODEL = "htdemucs_6s"
+
 def get_separator():
-    return DemucsSeparator(s3_client=s3_client, model="htdemucs_6s")
+    engine = get_engine(SEPARATION_MODEL) if SEPARATION_ENGINE == "inprocess" else None
+    return DemucsSeparator(s3_client=s3_client, model=SEPARATION_MODEL, engine=engine,
+                           streaming=SEPARATION_STREAMING and engine is not None,
+                           concurrent_jobs=separation_scheduler.max_concurrent,
+                           ram_per_job_mb=separation_scheduler.ram_per_job_mb)
+
+def warm_separation_engine():
+    """Loads the resident Demucs model in the background so the first upload does not pay for it."""
+    if SEPARATION_ENGINE != "inprocess" or os.getenv("DEMUCS_WARMUP", "1") == "0":
+        return
+    engine = get_engine(SEPARATION_MODEL)
+
+    def _warm():
+        try:
+            engine.warm_up()
+        except Exception:
+            pass  # state and error are kept on the engine for /health
+
+    threading.Thread(target=_warm, name="demucs-warmup", daemon=True).start()
 
 class Bookmark(BaseModel):
     """a saved slice of audio you want to loop or revisit
@@ -87,6 +212,13 @@ class IdentifyRequest(BaseModel):
     """
     rawFileName: str
 
+class IdentifyBatchRequest(BaseModel):
+    """request body for identifying a whole folder of uploads at once
+    carries the raw file names in the order the client wants results back
+    duplicates are identified once
+    """
+    rawFileNames: List[str]
+
 class AnalysisRequest(BaseModel):
     """request body to get a friendly initial ai analysis
     send the song title and optional artist
@@ -135,29 +267,120 @@ def get_password_hash(password: str) -> str:
     """Generates a bcrypt hash"""
     return pwd_context.hash(password)
 
-def upload_and_separate(temp_file_path: str, object_key: str, task_id: str, username: str, original_filename: str, separator: DemucsSeparator):
+def s3_base_url() -> str:
+    return f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com"
+
+def is_missing_object(e: Exception) -> bool:
+    """Whether an S3 error means the object does not exist, as opposed to access or throttling errors."""
+    if isinstance(e, s3_client.exceptions.NoSuchKey):
+        return True
+    return (isinstance(e, s3_client.exceptions.ClientError)
+            and e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"))
+
+def archive_upload(temp_file_path: str, object_key: str, task_id: str):
+    """Copies the original upload to S3 for safekeeping; nothing in the pipeline waits on it."""
+    try:
+        s3_client.upload_file(temp_file_path, BUCKET_NAME, object_key)
+        print(f"[{task_id}] Archived original upload to {object_key}.")
+    except Exception as e:
+        print(f"[{task_id}] Could not archive original upload: {e}")
+
+def remove_temp_file(temp_file_path: str):
+    print(f"Cleaning up temporary file {temp_file_path}.")
+    if os.path.exists(temp_file_path):
+        os.remove(temp_file_path)
+
+def reuse_cached_separation(cache_key: str, task_id: str, username: str, original_filename: str) -> Optional[Dict[str, Any]]:
+    """Copies a cached separation into this task's project and marks the task done, or returns None on a miss."""
+    entry = separation_cache.lookup(s3_client, BUCKET_NAME, cache_key)
+    if not entry:
+        return None
+    manifest = separation_cache.materialize(
+        s3_client, BUCKET_NAME, cache_key, entry, f"stems/{username}/{task_id}/", s3_base_url(), original_filename
+    )
+    if manifest:
+        print(f"[{task_id}] Reused a separation of the same audio without running Demucs.")
+        task_statuses.update(task_id, "done", cached=True,
+                             manifestUrl=f"{s3_base_url()}/stems/{username}/{task_id}/manifest.json")
+    return manifest
+
+def upload_and_separate(temp_file_path: str, object_key: str, task_id: str, username: str, original_filename: str, separator: DemucsSeparator,
+                        cancel_token: Optional[CancelToken] = None, cache_key: Optional[str] = None):
     """
-    Background task that first uploads the file to S3, then starts separation
+    Scheduled job that separates the upload, handing the local file straight to the separator
+    when SEPARATION_LOCAL_HANDOFF is on and going through S3 otherwise
     """
+    archive: Optional[Future] = None
     try:
-        print(f"[{task_id}] Background task: Uploading {temp_file_path} to S3 bucket {BUCKET_NAME}...")
-        s3_client.upload_file(temp_file_path, BUCKET_NAME, object_key)
-        print(f"[{task_id}] Background task: S3 upload complete.")
-
-        separator.separate_audio_stems(
-            BUCKET_NAME,
-            object_key,
-            task_id,
-            username,
-            original_filename
-        )
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        if SEPARATION_LOCAL_HANDOFF:
+            local_input_path = temp_file_path
+            if UPLOAD_ARCHIVE_MODE == "concurrent":
+                archive = archive_executor.submit(archive_upload, temp_file_path, object_key, task_id)
+        else:
+            local_input_path = None
+            task_statuses.update(task_id, "uploading")
+            print(f"[{task_id}] Background task: Uploading {temp_file_path} to S3 bucket {BUCKET_NAME}...")
+            s3_client.upload_file(temp_file_path, BUCKET_NAME, object_key)
+            print(f"[{task_id}] Background task: S3 upload complete.")
+
+        def separate():
+            manifest = separator.separate_audio_stems(
+                BUCKET_NAME,
+                object_key,
+                task_id,
+                username,
+                original_filename,
+                cancel_token=cancel_token,
+                report=task_statuses.reporter(task_id),
+                local_input_path=local_input_path
+            )
+            if manifest and cache_key and SEPARATION_CACHE_ENABLED:
+                separation_cache.store(s3_client, BUCKET_NAME, cache_key, f"stems/{username}/{task_id}/", s3_base_url(), manifest)
+                print(f"[{task_id}] Stored separation in cache.")
+            return manifest
+
+        if cache_key and SEPARATION_CACHE_ENABLED:
+            # The same audio may have finished separating since submission, or be separating right now
+            manifest = reuse_cached_separation(cache_key, task_id, username, original_filename)
+            if manifest is None:
+                waited = []
+
+                def on_wait():
+                    waited.append(True)
+                    task_statuses.update(task_id, "separating", shared=True)
+
+                try:
+                    result, shared = separation_flights.do("separation", cache_key, separate, on_wait=on_wait)
+                except BaseException as e:
+                    if not waited:
+                        raise
+                    # Another upload's run failing or being cancelled says nothing about this job
+                    print(f"[{task_id}] Shared separation did not finish ({e!r}); separating this upload itself.")
+                    result, shared = None, True
+                if shared:
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    manifest = reuse_cached_separation(cache_key, task_id, username, original_filename)
+                    if manifest is None:
+                        manifest = separate()
+                else:
+                    manifest = result
+        else:
+            manifest = separate()
+        if manifest and SEPARATION_LOCAL_HANDOFF and UPLOAD_ARCHIVE_MODE == "deferred":
+            archive = archive_executor.submit(archive_upload, temp_file_path, object_key, task_id)
     except Exception as e:
         print(f"--- AN ERROR OCCURRED IN BACKGROUND TASK for task {task_id} ---")
         print(f"Error: {str(e)}")
+        task_statuses.update(task_id, "failed", error=str(e))
     finally:
-        print(f"[{task_id}] Background task: Cleaning up temporary file {temp_file_path}.")
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        # An in-flight archive still reads the file, so it is removed once that upload finishes
+        if archive is not None:
+            archive.add_done_callback(lambda _: remove_temp_file(temp_file_path))
+        else:
+            remove_temp_file(temp_file_path)
 
 @app.post("/register/", summary="Register a new user", status_code=201)
 def register_user(username: str = Body(...), password: str = Body(...)):
@@ -217,6 +440,14 @@ def login_user(username: str = Body(...), password: str = Body(...)):
 def read_root():
     return {"message": "Welcome to SongAssist API! The server is running."}
 
+@app.get("/health", summary="Readiness of the API and separation engine")
+def health():
+    if SEPARATION_ENGINE != "inprocess":
+        return {"status": "ok", "engine": {"mode": "subprocess", "state": "ready"}}
+    engine_status = {"mode": "inprocess", **get_engine(SEPARATION_MODEL).status()}
+    status_code = 200 if engine_status["state"] == "ready" else 503
+    return JSONResponse(status_code=status_code, content={"status": "ok" if status_code == 200 else "warming", "engine": engine_status})
+
 @app.get("/project/{username}/{task_id}/manifest")
 def get_project_manifest(username: str, task_id: str):
     manifest_key = f"stems/{username}/{task_id}/manifest.json"
@@ -232,6 +463,140 @@ def get_project_manifest(username: str, task_id: str):
         print(f"Error fetching manifest for user '{username}', task '{task_id}': {e}")
         raise HTTPException(status_code=500, detail="Could not fetch project manifest.")
 
+@app.get("/project/{username}/{task_id}/progressive")
+def get_progressive_manifest(username: str, task_id: str):
+    """Time ranges of the stems already separated, published while a progressive separation runs."""
+    progressive_key = f"stems/{username}/{task_id}/progressive.json"
+    try:
+        obj = s3_client.get_object(Bucket=BUCKET_NAME, Key=progressive_key)
+        return JSONResponse(content=json.loads(obj['Body'].read().decode('utf-8')))
+    except s3_client.exceptions.NoSuchKey:
+        raise HTTPException(status_code=404, detail="No segments available yet.")
+    except Exception as e:
+        print(f"Error fetching progressive manifest for user '{username}', task '{task_id}': {e}")
+        raise HTTPException(status_code=500, detail="Could not fetch progressive manifest.")
+
+@app.get("/project/{username}/{task_id}/peaks/{stem}")
+def get_waveform_peaks(username: str, task_id: str, stem: str, start: float = 0.0, end: Optional[float] = None,
+                       width: Optional[int] = None, level: Optional[int] = None):
+    """Min/max waveform peaks for one stem between start and end seconds, as interleaved int8 pairs.
+
+    Pass the view width in pixels to get the coarsest zoom level with at least one bin per pixel,
+    or an explicit level (0 is finest). The level and bin geometry are returned in headers.
+    """
+    stem_file = "no_guitar" if stem == "backingTrack" else stem
+    peaks_key = f"stems/{username}/{task_id}/{stem_file}.peaks"
+    try:
+        # Decoded straight from the mapped file; only the requested window is copied out
+        with get_stem_cache().mapped(s3_client, BUCKET_NAME, peaks_key) as view:
+            pyramid = decode_pyramid(view)
+            chosen_level, first_bin, window = peak_window(pyramid, start, end, width, level)
+            content = window.tobytes()
+            headers = {
+                "X-Peaks-Level": str(chosen_level),
+                "X-Peaks-Levels": str(len(pyramid.levels)),
+                "X-Peaks-Sample-Rate": str(pyramid.sample_rate),
+                "X-Peaks-Samples-Per-Bin": str(pyramid.bin_samples(chosen_level)),
+                "X-Peaks-Start-Bin": str(first_bin),
+                "X-Peaks-Bins": str(len(window)),
+            }
+            del pyramid, window
+    except Exception as e:
+        if is_missing_object(e):
+            raise HTTPException(status_code=404, detail="Waveform peaks not available for this stem.")
+        print(f"Error fetching waveform peaks for user '{username}', task '{task_id}', stem '{stem}': {e}")
+        raise HTTPException(status_code=500, detail="Could not fetch waveform peaks.")
+    return Response(content=content, media_type="application/octet-stream", headers=headers)
+
+@app.get("/project/{username}/{task_id}/loops/{bookmark_id}")
+def render_bookmark_loop(username: str, task_id: str, bookmark_id: int, speed: float = 1.0,
+                         guitar_gain: float = 1.0, backing_gain: float = 1.0):
+    """Renders a bookmarked region at the given speed and stem gains as a WAV, pitch unchanged."""
+    if not MIN_SPEED <= speed <= MAX_SPEED:
+        raise HTTPException(status_code=400, detail=f"Speed must be between {MIN_SPEED} and {MAX_SPEED}.")
+    if not (0 <= guitar_gain <= MAX_GAIN and 0 <= backing_gain <= MAX_GAIN):
+        raise HTTPException(status_code=400, detail=f"Gains must be between 0 and {MAX_GAIN}.")
+    try:
+        obj = s3_client.get_object(Bucket=BUCKET_NAME, Key=f"stems/{username}/{task_id}/bookmarks.json")
+        bookmarks = json.loads(obj['Body'].read().decode('utf-8'))
+    except s3_client.exceptions.NoSuchKey:
+        raise HTTPException(status_code=404, detail="Project has no bookmarks.")
+    bookmark = next((b for b in bookmarks if b.get("id") == bookmark_id), None)
+    if bookmark is None:
+        raise HTTPException(status_code=404, detail="Bookmark not found.")
+    if not 0 <= bookmark["start"] < bookmark["end"] or bookmark["end"] - bookmark["start"] > MAX_LOOP_SECONDS:
+        raise HTTPException(status_code=400, detail=f"Loops must be between 0 and {MAX_LOOP_SECONDS:.0f} seconds long.")
+
+    try:
+        # Streamed from an open handle, so evicting the clip mid-response cannot cut it short
+        clip, cached = loop_renderer.open(s3_client, BUCKET_NAME, username, task_id, bookmark,
+                                          speed, guitar_gain, backing_gain)
+    except (LookupError, s3_client.exceptions.NoSuchKey) as e:
+        raise HTTPException(status_code=404, detail=f"Stems not available for this project: {e}")
+    except Exception as e:
+        print(f"Error rendering loop {bookmark_id} for user '{username}', task '{task_id}': {e}")
+        raise HTTPException(status_code=500, detail="Could not render loop.")
+    def chunks():
+        with clip:
+            yield from iter(lambda: clip.read(UPLOAD_CHUNK_SIZE), b"")
+
+    return StreamingResponse(chunks(), media_type="audio/wav", headers={
+        "X-Loop-Cache": "hit" if cached else "miss",
+        "Content-Length": str(os.fstat(clip.fileno()).st_size),
+    })
+
+@app.get("/project/{username}/{task_id}/mix")
+def get_stem_mix(username: str, task_id: str, stems: Optional[str] = None, without: Optional[str] = None):
+    """URL of a mix of the project's six-stem sources, e.g. stems=drums,bass or without=guitar.
+
+    The first request for a mix sums the sources and publishes it; later requests reuse it.
+    """
+    if bool(stems) == bool(without):
+        raise HTTPException(status_code=400, detail="Pass either 'stems' or 'without'.")
+    chosen = [name.strip() for name in (stems or without).split(",") if name.strip()]
+    if without:
+        chosen = [name for name in SIX_STEM_SOURCES if name not in chosen]
+    try:
+        url, cached = stem_mixer.mix(s3_client, BUCKET_NAME, s3_base_url(), username, task_id, chosen)
+    except s3_client.exceptions.NoSuchKey:
+        raise HTTPException(status_code=404, detail="Project manifest not found.")
+    except LookupError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Error mixing stems for user '{username}', task '{task_id}': {e}")
+        raise HTTPException(status_code=500, detail="Could not build the mix.")
+    return {"stems": chosen, "url": url, "cached": cached}
+
+@app.get("/gemini/cache/stats")
+def get_gemini_cache_stats():
+    return response_cache.stats()
+
+@app.get("/coalescing/stats")
+def get_coalescing_stats():
+    return {"ai": ai_flights.stats(), "separation": separation_flights.stats()}
+
+@app.get("/gemini/budget/stats")
+def get_gemini_budget_stats():
+    return analysis_budget.stats()
+
+@app.get("/gemini/uploads/stats")
+def get_gemini_upload_stats():
+    return upload_cache.stats()
+
+@app.get("/excerpts/cache/stats")
+def get_excerpt_cache_stats():
+    return excerpt_extractor.stats()
+
+@app.get("/stems/cache/stats")
+def get_stem_cache_stats():
+    return get_stem_cache().stats()
+
+@app.get("/loops/cache/stats")
+def get_loop_cache_stats():
+    return loop_renderer.stats()
+
 @app.get("/project/{username}/{task_id}/bookmarks") 
 def get_project_bookmarks(username: str, task_id: str): 
     bookmarks_key = f"stems/{username}/{task_id}/bookmarks.json" 
@@ -245,15 +610,28 @@ def get_project_bookmarks(username: str, task_id: str):
         print(f"Error fetching bookmarks for user '{username}', task '{task_id}': {e}") 
         raise HTTPException(status_code=500, detail="Could not fetch project bookmarks.") 
 
+async def generate_once(name: str, system_prompt: str, user_prompt: str, model_name: str,
+                        cache_control: Optional[str] = None, cached: bool = True) -> Dict[str, Any]:
+    """Answers the prompt through the response cache (when `cached`) with identical concurrent prompts sharing one call."""
+    bypass = wants_fresh(cache_control)
+    key = fingerprint(name, response_cache_key(system_prompt, user_prompt, model_name), cached, bypass)
+    if cached:
+        make_call = lambda: response_cache.generate(generate_text_from_prompt, system_prompt, user_prompt,
+                                                    model_name, bypass=bypass)
+    else:
+        make_call = lambda: generate_text_from_prompt(system_prompt, user_prompt, model_name=model_name)
+    result, _ = await ai_flights.do(name, key, make_call)
+    return result
+
 @app.post("/gemini/identify-from-filename")
-def identify_song(req_body: IdentifyRequest):
+async def identify_song(req_body: IdentifyRequest, cache_control: Optional[str] = Header(None)):
     system_prompt = """You are a music expert. Your task is to identify a song title and artist from a raw audio filename.
     The filename might contain track numbers, garbage text, or underscores. Clean it up and provide the most likely song title and artist.
     Respond ONLY with a JSON object in the format: {"songTitle": "...", "artist": "..."}.
     If you cannot determine the artist, use "Unknown Artist".
     """
     user_prompt = f"Filename: \"{req_body.rawFileName}\""
-    response_data = generate_text_from_prompt(system_prompt, user_prompt, model_name="gemini-2.5-flash")
+    response_data = await generate_once("identify", system_prompt, user_prompt, "gemini-2.5-flash", cache_control)
     try:
         json_text = response_data.get("text", "{}")
         if "```json" in json_text:
@@ -263,18 +641,64 @@ def identify_song(req_body: IdentifyRequest):
     except (json.JSONDecodeError, IndexError):
         return {"songTitle": req_body.rawFileName, "artist": "Unknown Artist"}
 
+async def identify_batch_chunk(raw_file_names: List[str], cache_control: Optional[str]) -> Dict[int, Dict[str, str]]:
+    response_data = await generate_once("identify-batch", BATCH_SYSTEM_PROMPT, batch_user_prompt(raw_file_names),
+                                        "gemini-2.5-flash", cache_control)
+    if "error" in response_data:
+        return {}
+    return parse_batch_response(response_data.get("text", ""), len(raw_file_names))
+
+@app.post("/gemini/identify-batch")
+async def identify_songs_batch(req_body: IdentifyBatchRequest, cache_control: Optional[str] = Header(None)):
+    if len(req_body.rawFileNames) > IDENTIFY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Identify at most {IDENTIFY_BATCH_MAX_ITEMS} files per request.")
+    found: Dict[str, Dict[str, str]] = {}
+    sources: Dict[str, str] = {}
+    pending = []
+    for name in dict.fromkeys(req_body.rawFileNames):
+        local = identify_locally(name)
+        if local:
+            found[name], sources[name] = local, "local"
+        else:
+            pending.append(name)
+
+    for attempt in range(IDENTIFY_BATCH_RETRIES + 1):
+        if not pending:
+            break
+        # Retries use smaller batches and skip the response cache so an answer that left items out is not replayed
+        size = max(1, IDENTIFY_BATCH_SIZE >> attempt)
+        chunks = [pending[i:i + size] for i in range(0, len(pending), size)]
+        answers = await asyncio.gather(*[
+            identify_batch_chunk(chunk, cache_control if attempt == 0 else "no-cache") for chunk in chunks
+        ])
+        for chunk, answer in zip(chunks, answers):
+            for index, identification in answer.items():
+                found[chunk[index]], sources[chunk[index]] = identification, "model"
+        pending = [name for name in pending if name not in found]
+
+    results = [
+        {"rawFileName": name, **found.get(name, {"songTitle": name, "artist": UNKNOWN_ARTIST}),
+         "source": sources.get(name, "fallback")}
+        for name in req_body.rawFileNames
+    ]
+    return {
+        "results": results,
+        "local": sum(r["source"] == "local" for r in results),
+        "model": sum(r["source"] == "model" for r in results),
+        "unresolved": sum(r["source"] == "fallback" for r in results),
+    }
+
 @app.post("/gemini/initial-analysis")
-def get_initial_analysis(req_body: AnalysisRequest):
+async def get_initial_analysis(req_body: AnalysisRequest, cache_control: Optional[str] = Header(None)):
     system_prompt = """You are a helpful and encouraging guitar practice assistant.
     A user has just loaded a song. Provide a brief, welcoming analysis (2-3 sentences).
     Mention the song's key characteristics, what makes it interesting to learn on guitar, and one or two key techniques to listen for.
     Keep it concise and positive.
     """
     user_prompt = f"The song is \"{req_body.songTitle}\" by {req_body.artist or 'an unknown artist'}."
-    return generate_text_from_prompt(system_prompt, user_prompt, model_name="gemini-2.5-flash")
+    return await generate_once("initial-analysis", system_prompt, user_prompt, "gemini-2.5-flash", cache_control)
 
-@app.post("/gemini/playing-advice")
-def get_playing_advice(req_body: AdviceRequest):
+def advice_prompts(req_body: AdviceRequest):
     system_prompt = """You are a helpful and encouraging guitar practice assistant. The user is asking for advice about playing a specific song.
     Use the provided context to give a clear, actionable, and encouraging response.
     Focus on techniques, practice strategies, or music theory but only if it is relevant to their question.
@@ -286,11 +710,9 @@ def get_playing_advice(req_body: AdviceRequest):
     if req_body.difficulty:
         context_parts.append(f"They perceive the difficulty as {req_body.difficulty}/10.")
     context_parts.append(f"\nUser's question: \"{req_body.section}\"")
-    user_prompt = "\n".join(context_parts)
-    return generate_text_from_prompt(system_prompt, user_prompt, model_name="gemini-2.5-flash")
+    return system_prompt, "\n".join(context_parts)
 
-@app.post("/gemini/generate-tabs")
-def generate_tabs(req_body: TabsRequest):
+def tabs_prompts(req_body: TabsRequest):
     system_prompt = """You are an expert guitar tab generator.
     Your task is to create a simple, text-based (ASCII) guitar tab for the main riff or a key section of the requested song.
     Do not tab out the entire song. Focus on one or two iconic parts.
@@ -298,89 +720,159 @@ def generate_tabs(req_body: TabsRequest):
     Your output should be formatted as plain text suitable for a `<pre>` tag. Use markdown for code blocks.
     """
     user_prompt = f"Please generate tabs for \"{req_body.songTitle}\" by {req_body.artist or 'an unknown artist'}."
-    return generate_text_from_prompt(system_prompt, user_prompt, model_name="gemini-2.5-flash")
+    return system_prompt, user_prompt
 
+def stream_gemini_text(system_prompt: str, user_prompt: str, model_name: str,
+                       cache: Optional[ResponseCache] = None, bypass: bool = False) -> StreamingResponse:
+    """
+    Forwards the answer as server-sent events while the model writes it:
+    delta events carry new text, reset discards text sent before a fallback retry, and done or error ends the stream
+    """
+    async def events():
+        cached = cache.lookup(system_prompt, user_prompt, model_name, bypass) if cache is not None else None
+        if cached is not None:
+            yield sse_event({"delta": cached.get("text", "")}, event="delta")
+            yield sse_event({"done": True, **cached}, event="done")
+            return
+        async for event in stream_text_from_prompt(system_prompt, user_prompt, model_name):
+            if "done" in event and cache is not None:
+                cache.store(system_prompt, user_prompt, model_name, {"text": event["text"]})
+            kind = next(name for name in ("delta", "reset", "done", "error") if name in event)
+            yield sse_event(event, event=kind)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-@app.post("/gemini/analyze-stem")
-def analyze_stem_with_gemini(req: StemAnalysisRequest):
+@app.post("/gemini/playing-advice")
+async def get_playing_advice(req_body: AdviceRequest):
+    system_prompt, user_prompt = advice_prompts(req_body)
+    return await generate_once("playing-advice", system_prompt, user_prompt, "gemini-2.5-flash", cached=False)
+
+@app.post("/gemini/playing-advice/stream")
+async def stream_playing_advice(req_body: AdviceRequest):
+    system_prompt, user_prompt = advice_prompts(req_body)
+    return stream_gemini_text(system_prompt, user_prompt, "gemini-2.5-flash")
+
+@app.post("/gemini/generate-tabs")
+async def generate_tabs(req_body: TabsRequest, cache_control: Optional[str] = Header(None)):
+    system_prompt, user_prompt = tabs_prompts(req_body)
+    return await generate_once("generate-tabs", system_prompt, user_prompt, "gemini-2.5-flash", cache_control)
+
+@app.post("/gemini/generate-tabs/stream")
+async def stream_tabs(req_body: TabsRequest, cache_control: Optional[str] = Header(None)):
+    system_prompt, user_prompt = tabs_prompts(req_body)
+    # Shares entries with /gemini/generate-tabs, so a cached answer arrives as one delta
+    return stream_gemini_text(system_prompt, user_prompt, "gemini-2.5-flash",
+                              cache=response_cache, bypass=wants_fresh(cache_control))
+
+
+def prepare_stem_excerpt(req: StemAnalysisRequest):
+    """Reads the manifest and cuts the excerpt to analyze. Blocking, so the endpoint runs it on a worker thread.
+
+    The excerpt comes back pinned; the caller releases it once the file has been read.
+    """
     manifest_key = f"stems/{req.username}/{req.task_id}/manifest.json"
     try:
-        obj = s3_client.get_object(Bucket=BUCKET_NAME, Key=manifest_key)
-        manifest = json.loads(obj["Body"].read().decode("utf-8"))
-    except s3_client.exceptions.NoSuchKey:
-        raise HTTPException(status_code=404, detail="Project manifest not found.")
-    stems = manifest.get("stems", {})
-    guitar_url = stems.get("guitar") or stems.get("Guitar")
-    if not guitar_url:
+        with get_stem_cache().mapped(s3_client, BUCKET_NAME, manifest_key) as view:
+            manifest = json.loads(view[:])
+    except (s3_client.exceptions.NoSuchKey, s3_client.exceptions.ClientError) as e:
+        if is_missing_object(e):
+            raise HTTPException(status_code=404, detail="Project manifest not found.")
+        raise HTTPException(status_code=502, detail=f"Failed to fetch project manifest: {e}")
+    sources = excerpt_sources(manifest, "guitar")
+    if not sources:
         raise HTTPException(status_code=400, detail="Guitar stem not found in manifest.")
-    
-    local_audio_path = None
-    truncated_audio_path = None
-    try:
-        parsed_url = urllib.parse.urlparse(guitar_url)
-        file_extension = Path(parsed_url.path).suffix or ".mp3"
-        
-        with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as tmp:
-            local_audio_path = tmp.name
-            r = requests.get(guitar_url, timeout=60)
-            r.raise_for_status()
-            tmp.write(r.content)
-        
-        with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as tmp_out:
-            truncated_audio_path = tmp_out.name
 
-        ffmpeg_command = [
-            "ffmpeg", "-y", "-i", local_audio_path,
-            "-t", "90", truncated_audio_path
-        ]
-        subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
+    windows = [(0.0, EXCERPT_SECONDS)]
+    if manifest.get("activity", {}).get("guitar"):
+        # Send the stretch with the most guitar playing rather than an intro that may be silent
+        windows = densest_windows(ActivityMap.from_manifest(manifest["activity"]["guitar"]), EXCERPT_SECONDS)
 
+    try:
+        # Only the windows sent to the model are fetched, and each set of windows is cut once per stem
+        excerpt_path, _ = excerpt_extractor.excerpt(s3_client, BUCKET_NAME, sources, windows, pin=True)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Failed to fetch or process stem: {e}")
+    return manifest, excerpt_path, windows
+
+
+def manifest_duration(manifest: Dict[str, Any]) -> Optional[float]:
+    """Song length from the separation plan, the BPM/key analysis or the activity map, whichever the manifest has."""
+    if manifest.get("duration"):
+        return float(manifest["duration"])
+    if manifest.get("analysis", {}).get("duration"):
+        return float(manifest["analysis"]["duration"])
+    if manifest.get("activity", {}).get("guitar"):
+        activity = ActivityMap.from_manifest(manifest["activity"]["guitar"])
+        return len(activity.values) * activity.hop_seconds
+    return None
+
+
+def save_stem_analysis(req: StemAnalysisRequest, result: Dict[str, Any]):
+    manifest_key = f"stems/{req.username}/{req.task_id}/manifest.json"
+    result_key = f"stems/{req.username}/{req.task_id}/gemini_analysis.json"
+    s3_client.put_object(
+        Bucket=BUCKET_NAME, Key=result_key,
+        Body=json.dumps(result), ContentType="application/json", ACL="public-read"
+    )
     
+    manifest_obj = s3_client.get_object(Bucket=BUCKET_NAME, Key=manifest_key)
+    manifest_data = json.loads(manifest_obj['Body'].read().decode('utf-8'))
+    manifest_data['analysisUrl'] = f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{result_key}"
+    s3_client.put_object(
+        Bucket=BUCKET_NAME, Key=manifest_key,
+        Body=json.dumps(manifest_data), ContentType='application/json', ACL='public-read'
+    )
+
+
+@app.post("/gemini/analyze-stem")
+async def analyze_stem_with_gemini(req: StemAnalysisRequest):
+    # Double clicks and retries for the same task share one excerpt, upload and analysis
+    key = fingerprint(req.username, req.task_id, req.songTitle, req.artist, req.prompt)
+    response, _ = await ai_flights.do("analyze-stem", key, lambda: run_stem_analysis(req))
+    return response
+
+
+async def run_stem_analysis(req: StemAnalysisRequest):
+    manifest, excerpt_path, windows = await asyncio.to_thread(prepare_stem_excerpt, req)
 
     try:
         extra_context = {"songTitle": req.songTitle, "artist": req.artist}
+        if manifest.get("analysis"):
+            # Measured at upload time, so the model does not have to guess tempo and key
+            extra_context["measuredAnalysis"] = manifest["analysis"]
+        extra_context["excerptWindows"] = [{"start": start, "duration": duration} for start, duration in windows]
+        song_seconds = manifest_duration(manifest)
+        excerpt_seconds = sum(duration for _, duration in windows)
         
-        result = analyze_guitar_file(
-            truncated_audio_path,
-            model_name="gemini-2.5-flash",
-            user_prompt=req.prompt,
-            extra_context_json=extra_context
-        )
+        # Both lengths let the token budget pick a prompt tier that fits on the first call
+        try:
+            result = await analyze_guitar_file(
+                str(excerpt_path),
+                model_name="gemini-2.5-flash",
+                user_prompt=req.prompt,
+                extra_context_json=extra_context,
+                audio_seconds=min(excerpt_seconds, song_seconds) if song_seconds else excerpt_seconds,
+                song_seconds=song_seconds
+            )
+        finally:
+            # The excerpt has been uploaded, so it may be evicted again
+            excerpt_extractor.release(excerpt_path)
         
         if "error" in result:
             raise Exception(result["error"])
 
-        result_key = f"stems/{req.username}/{req.task_id}/gemini_analysis.json"
-        s3_client.put_object(
-            Bucket=BUCKET_NAME, Key=result_key,
-            Body=json.dumps(result), ContentType="application/json", ACL="public-read"
-        )
-        
-        manifest_obj = s3_client.get_object(Bucket=BUCKET_NAME, Key=manifest_key)
-        manifest_data = json.loads(manifest_obj['Body'].read().decode('utf-8'))
-        manifest_data['analysisUrl'] = f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{result_key}"
-        s3_client.put_object(
-            Bucket=BUCKET_NAME, Key=manifest_key,
-            Body=json.dumps(manifest_data), ContentType='application/json', ACL='public-read'
-        )
-        
+        await asyncio.to_thread(save_stem_analysis, req, result)
         return {"ok": True, "result": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Gemini analysis failed: {e}")
-    finally:
-        if local_audio_path and os.path.exists(local_audio_path):
-            os.remove(local_audio_path)
-        if truncated_audio_path and os.path.exists(truncated_audio_path):
-            os.remove(truncated_audio_path)
 
 
 @app.post("/separate/", status_code=202)
 def separate_audio(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     username: str = Form(...),
+    priority: int = Form(0),
     separator: DemucsSeparator = Depends(get_separator)
 ):
     if not file or not username:
@@ -393,36 +885,129 @@ def separate_audio(
         
         temp_file_path = str(TEMP_UPLOAD_DIR / f"{task_id}{file_extension}")
         
+        # Hash while streaming so identical audio can be served from the separation cache
+        hasher = hashlib.sha256()
         with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+            for chunk in iter(lambda: file.file.read(UPLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                buffer.write(chunk)
 
         object_key = f"uploads/{task_id}{file_extension}"
+        cache_key = make_cache_key(hasher.hexdigest(), separator.model, separator.cache_signature())
+
+        if SEPARATION_CACHE_ENABLED:
+            entry = separation_cache.lookup(s3_client, BUCKET_NAME, cache_key)
+            manifest = None
+            if entry:
+                manifest = separation_cache.materialize(
+                    s3_client, BUCKET_NAME, cache_key, entry, f"stems/{username}/{task_id}/", s3_base_url(), original_filename
+                )
+            if manifest:
+                os.remove(temp_file_path)
+                print(f"[{task_id}] Separation cache hit; reused stems without running Demucs.")
+                task_statuses.create(task_id, username, state="done", cached=True,
+                                     manifestUrl=f"{s3_base_url()}/stems/{username}/{task_id}/manifest.json")
+                return JSONResponse(status_code=202, content={
+                    "message": "Separation served from cache.",
+                    "filename": original_filename,
+                    "taskId": task_id,
+                    "queuePosition": None,
+                    "cached": True
+                })
 
-        # Pass original_filename to the background task
-        background_tasks.add_task(
-            upload_and_separate,
-            temp_file_path,
-            object_key,
-            task_id,
-            username,
-            original_filename,
-            separator
-        )
+        def discard_upload():
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+
+        task_statuses.create(task_id, username)
+        try:
+            position = separation_scheduler.submit(
+                task_id,
+                upload_and_separate,
+                args=(temp_file_path, object_key, task_id, username, original_filename, separator),
+                kwargs={"cache_key": cache_key},
+                priority=priority,
+                owner=username,
+                on_discard=discard_upload
+            )
+        except QueueFull as e:
+            discard_upload()
+            task_statuses.update(task_id, "failed", error=str(e))
+            raise HTTPException(status_code=503, detail=str(e))
         
         content = {
             "message": "Separation process started successfully.",
             "filename": original_filename,
-            "taskId": task_id 
+            "taskId": task_id,
+            "queuePosition": position,
+            "cached": False
         }
 
         return JSONResponse(status_code=202, content=content)
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     finally:
         if file:
             file.file.close()
 
+@app.get("/separate/{task_id}/queue", summary="Queue position of a separation job")
+def get_separation_queue_position(task_id: str):
+    job = separation_scheduler.snapshot(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No separation job with that ID.")
+    return {**job, **separation_scheduler.stats()}
+
+def get_task_snapshot(task_id: str) -> Optional[Dict[str, Any]]:
+    snapshot = task_statuses.snapshot(task_id)
+    if snapshot is not None:
+        snapshot["queuePosition"] = separation_scheduler.position(task_id)
+    return snapshot
+
+@app.get("/tasks/{task_id}", summary="Current state of a separation task with per-stage timings")
+def get_task_status(task_id: str):
+    snapshot = get_task_snapshot(task_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Unknown task.")
+    return snapshot
+
+@app.get("/tasks/{task_id}/events", summary="Server-Sent Events stream of task state changes")
+async def stream_task_status(task_id: str):
+    """
+    Pushes a status event on every state change (and queue movement) until the task finishes
+    """
+    snapshot = get_task_snapshot(task_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Unknown task.")
+
+    async def events():
+        current = snapshot
+        yield sse_event(current)
+        idle = 0.0
+        while current["state"] not in TERMINAL_STATES:
+            await asyncio.sleep(SSE_POLL_SECONDS)
+            latest = get_task_snapshot(task_id)
+            if latest is None:
+                break
+            if latest["version"] != current["version"] or latest["queuePosition"] != current["queuePosition"]:
+                current = latest
+                idle = 0.0
+                yield sse_event(current)
+                continue
+            idle += SSE_POLL_SECONDS
+            if idle >= SSE_HEARTBEAT_SECONDS:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/separate/cache/stats", summary="Separation cache hit/miss counters")
+def get_separation_cache_stats():
+    return {"enabled": SEPARATION_CACHE_ENABLED, **separation_cache.stats()}
+
 @app.put("/{username}/{task_id}/bookmarks", summary="Save or update bookmarks for a project", status_code=200)
 def save_project_bookmarks(username: str, task_id: str, bookmarks: List[Bookmark]):
     """
@@ -433,7 +1018,7 @@ def save_project_bookmarks(username: str, task_id: str, bookmarks: List[Bookmark
 
     bookmarks_key = f"stems/{username}/{task_id}/bookmarks.json"
     
-    bookmarks_data = json.dumps([b.dict() for b in bookmarks])
+    bookmarks_data = json.dumps([b.model_dump() for b in bookmarks])
 
     try:
         s3_client.put_object(
@@ -443,6 +1028,7 @@ def save_project_bookmarks(username: str, task_id: str, bookmarks: List[Bookmark
             ContentType='application/json',
             ACL='public-read'
         )
+        loop_renderer.prerender(s3_client, BUCKET_NAME, username, task_id, [b.model_dump() for b in bookmarks])
         return {"message": "Bookmarks saved successfully."}
     except Exception as e:
         print(f"Error saving bookmarks for user '{username}', task '{task_id}': {e}")
@@ -500,23 +1086,36 @@ def delete_project(username: str, task_id: str):
         raise HTTPException(status_code=400, detail="Username and Task ID are required.")
 
     prefix = f"stems/{username}/{task_id}/"
+    cancelled = separation_scheduler.cancel(task_id, owner=username)
+    if cancelled:
+        task_statuses.update(task_id, "cancelled")
     
     try:
-        response = s3_client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=prefix)
-        
-        if 'Contents' not in response:
+        objects_to_delete = []
+        page_args = {}
+        while True:
+            # Segmented streams can put more objects under one project than a single listing page holds
+            response = s3_client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=prefix, **page_args)
+            objects_to_delete.extend({'Key': obj['Key']} for obj in response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                break
+            page_args = {"ContinuationToken": response["NextContinuationToken"]}
+
+        if not objects_to_delete:
+            if cancelled:
+                return {"message": "Separation cancelled."}
             return {"message": "Project not found or already deleted."}
 
-        objects_to_delete = [{'Key': obj['Key']} for obj in response['Contents']]
-        
-        delete_response = s3_client.delete_objects(
-            Bucket=BUCKET_NAME,
-            Delete={'Objects': objects_to_delete}
-        )
-        
-        if 'Errors' in delete_response and len(delete_response['Errors']) > 0:
-            print(f"Errors deleting objects for project {task_id}: {delete_response['Errors']}")
-            raise HTTPException(status_code=500, detail="Error occurred during project deletion.")
+        # delete_objects takes at most 1000 keys per call
+        for start in range(0, len(objects_to_delete), 1000):
+            delete_response = s3_client.delete_objects(
+                Bucket=BUCKET_NAME,
+                Delete={'Objects': objects_to_delete[start:start + 1000]}
+            )
+            
+            if 'Errors' in delete_response and len(delete_response['Errors']) > 0:
+                print(f"Errors deleting objects for project {task_id}: {delete_response['Errors']}")
+                raise HTTPException(status_code=500, detail="Error occurred during project deletion.")
 
         return {"message": "Project deleted successfully."}
 
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# Project files that belong to the user rather than to the separation output
+PROJECT_ONLY_FILES = {"manifest.json", "progressive.json", "bookmarks.json", "user_analysis.md", "gemini_analysis.json"}
+USER_MANIFEST_FIELDS = ("originalFileName", "songTitle", "artist", "analysisUrl", "userAnalysisUrl")
+
+
+def make_cache_key(content_hash: str, model: str, options: str) -> str:
+    """Combines the audio hash with everything that changes the separation output."""
+    return hashlib.sha256(f"{content_hash}|{model}|{options}".encode("utf-8")).hexdigest()
+
+
+class SeparationCache:
+    """content addressed cache of finished separations kept in s3
+    stems for each (audio hash model options) key live under one cache prefix
+    a hit copies those objects into the new project with server side copies
+    entries are evicted least recently used first once max_entries is reached
+    the index is held in memory and mirrored to s3 so restarts keep it
+    """
+    def __init__(self, max_entries: int = 500, prefix: str = "cache/separations"):
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def index_key(self) -> str:
+        return f"{self.prefix}/index.json"
+
+    def _load(self, s3_client, bucket: str):
+        if self._loaded:
+            return
+        try:
+            obj = s3_client.get_object(Bucket=bucket, Key=self.index_key)
+            stored = json.loads(obj["Body"].read().decode("utf-8"))
+            for key, entry in sorted(stored.items(), key=lambda item: item[1].get("lastUsed", 0)):
+                self._entries[key] = entry
+        except s3_client.exceptions.NoSuchKey:
+            pass
+        except Exception as e:
+            print(f"Could not load separation cache index: {e}")
+        self._loaded = True
+
+    def _save(self, s3_client, bucket: str):
+        try:
+            s3_client.put_object(Bucket=bucket, Key=self.index_key,
+                                 Body=json.dumps(dict(self._entries)), ContentType="application/json")
+        except Exception as e:
+            print(f"Could not save separation cache index: {e}")
+
+    def lookup(self, s3_client, bucket: str, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._load(s3_client, bucket)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            return dict(entry)
+
+    def materialize(self, s3_client, bucket: str, key: str, entry: Dict[str, Any], project_prefix: str,
+                    base_url: str, original_filename: str) -> Optional[Dict[str, Any]]:
+        """Copies cached stems into a new project and writes its manifest. Returns None if the entry is stale."""
+        try:
+            for name in entry["files"]:
+                s3_client.copy_object(
+                    Bucket=bucket, Key=f"{project_prefix}{name}",
+                    CopySource={"Bucket": bucket, "Key": f"{self.prefix}/{key}/{name}"},
+                    ACL="public-read"
+                )
+        except Exception as e:
+            print(f"Separation cache entry {key} is unusable ({e}); dropping it.")
+            with self._lock:
+                self._entries.pop(key, None)
+                self.misses += 1
+                self._save(s3_client, bucket)
+            return None
+
+        manifest_text = json.dumps(entry["manifest"]).replace("{project_url}", f"{base_url}/{project_prefix}")
+        manifest = json.loads(manifest_text)
+        manifest["originalFileName"] = original_filename
+        s3_client.put_object(Bucket=bucket, Key=f"{project_prefix}manifest.json", Body=json.dumps(manifest),
+                             ContentType="application/json", ACL="public-read")
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries[key]["lastUsed"] = time.time()
+                self._entries.move_to_end(key)
+                self._save(s3_client, bucket)
+        return manifest
+
+    def store(self, s3_client, bucket: str, key: str, project_prefix: str, base_url: str, manifest: Dict[str, Any]):
+        """Copies a finished project's separation outputs into the cache and records them in the index."""
+        files: List[str] = []
+        page_args = {}
+        while True:
+            # Segmented streams put hundreds of objects under one project, more than a single listing page
+            listing = s3_client.list_objects_v2(Bucket=bucket, Prefix=project_prefix, **page_args)
+            files.extend(
+                obj["Key"][len(project_prefix):] for obj in listing.get("Contents", [])
+                if obj["Key"][len(project_prefix):] not in PROJECT_ONLY_FILES
+            )
+            if not listing.get("IsTruncated"):
+                break
+            page_args = {"ContinuationToken": listing["NextContinuationToken"]}
+        if not files:
+            return
+        for name in files:
+            s3_client.copy_object(
+                Bucket=bucket, Key=f"{self.prefix}/{key}/{name}",
+                CopySource={"Bucket": bucket, "Key": f"{project_prefix}{name}"}
+            )
+
+        template = {k: v for k, v in manifest.items() if k not in USER_MANIFEST_FIELDS}
+        template = json.loads(json.dumps(template).replace(f"{base_url}/{project_prefix}", "{project_url}"))
+        now = time.time()
+        with self._lock:
+            self._load(s3_client, bucket)
+            self._entries[key] = {"files": files, "manifest": template, "createdAt": now, "lastUsed": now}
+            self._entries.move_to_end(key)
+            self.stores += 1
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                old_key, old_entry = self._entries.popitem(last=False)
+                evicted.append((old_key, old_entry))
+                self.evictions += 1
+            self._save(s3_client, bucket)
+
+        for old_key, old_entry in evicted:
+            try:
+                keys = [{"Key": f"{self.prefix}/{old_key}/{name}"} for name in old_entry["files"]]
+                for start in range(0, len(keys), 1000):
+                    s3_client.delete_objects(Bucket=bucket, Delete={"Objects": keys[start:start + 1000]})
+            except Exception as e:
+                print(f"Could not delete evicted separation cache entry {old_key}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
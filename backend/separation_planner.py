@@ -0,0 +1,143 @@
+import json
+import os
+import subprocess
+from typing import NamedTuple, Optional, Tuple
+
+
+class AudioProbe(NamedTuple):
+    duration: float
+    sample_rate: int
+    channels: int
+
+
+class ModelProfile(NamedTuple):
+    """Rough memory footprint of one Demucs model, measured on CPU."""
+    max_segment: int            # longest segment the model accepts, in whole seconds
+    sources: int                # stems the model produces
+    base_mb: float              # weights plus framework overhead
+    mb_per_segment_second: float  # activations for one segment-second in one worker
+
+
+MODEL_PROFILES = {
+    "htdemucs": ModelProfile(max_segment=7, sources=4, base_mb=900, mb_per_segment_second=90),
+    "htdemucs_ft": ModelProfile(max_segment=7, sources=4, base_mb=1400, mb_per_segment_second=90),
+    "htdemucs_6s": ModelProfile(max_segment=7, sources=6, base_mb=1000, mb_per_segment_second=120),
+}
+DEFAULT_PROFILE = MODEL_PROFILES["htdemucs_6s"]
+MODEL_SAMPLE_RATE = 44100
+MIN_SEGMENT = 3
+# Largest 16-bit WAV stem we publish before switching to MP3; 71 MB is about 7 minutes of 44.1 kHz stereo
+MAX_WAV_STEM_MB = float(os.getenv("MAX_WAV_STEM_MB", "71"))
+
+
+class SeparationPlan(NamedTuple):
+    duration: float
+    segment: int
+    overlap: float
+    shifts: int
+    jobs: int
+    threads: int
+    output_format: str
+    estimated_mb: float
+    reason: str
+
+
+def probe_audio(file_path: str) -> Optional[AudioProbe]:
+    """Reads duration, sample rate and channel count with one ffprobe call, or None if it fails."""
+    command = [
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "format=duration:stream=sample_rate,channels", "-of", "json", file_path
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        info = json.loads(result.stdout)
+        stream = info["streams"][0]
+        return AudioProbe(float(info["format"]["duration"]), int(stream["sample_rate"]), int(stream["channels"]))
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError, KeyError, IndexError) as e:
+        print(f"Warning: Could not probe audio with ffprobe ({e}).")
+        return None
+
+
+def available_resources() -> Tuple[float, int]:
+    """Free RAM in MB and the cores this process may use."""
+    free_mb = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    free_mb = int(line.split()[1]) / 1024
+                    break
+    except OSError:
+        pass
+    if free_mb is None:
+        try:
+            free_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES") / 1024 ** 2
+        except (ValueError, OSError, AttributeError):
+            free_mb = 4096.0
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return free_mb, cores
+
+
+def job_share(free_mb: float, cores: int, concurrent_jobs: int = 1,
+              ram_per_job_mb: Optional[float] = None) -> Tuple[float, int]:
+    """The RAM and cores one job may plan with when the scheduler runs `concurrent_jobs` at once.
+
+    Cores are split evenly. RAM is capped at what the scheduler budgets per job, or else an even
+    split of what is free, since every running job reads the same free memory.
+    """
+    concurrent_jobs = max(1, concurrent_jobs)
+    if concurrent_jobs == 1:
+        return free_mb, cores
+    share_mb = ram_per_job_mb if ram_per_job_mb else free_mb / concurrent_jobs
+    return min(free_mb, share_mb), max(1, cores // concurrent_jobs)
+
+
+def plan_separation(model: str, probe: Optional[AudioProbe], free_mb: float, cores: int,
+                    file_size_bytes: Optional[int] = None) -> SeparationPlan:
+    """Chooses segment, overlap, shifts, worker count, threads and output format for one job.
+
+    Memory is the model base, the decoded input at its own rate and channel count, the whole-song
+    tensors at the model rate (float32, all sources) and activations for each parallel worker.
+    The plan takes the longest segment and the most workers that fit in 80% of free RAM.
+    `free_mb` and `cores` are this job's share, as given by job_share.
+    """
+    profile = MODEL_PROFILES.get(model, DEFAULT_PROFILE)
+    reasons = []
+    if probe is None:
+        # Without a probe assume a long track, estimated from size at a 128 kbps worst case
+        duration = (file_size_bytes * 8 / 128000) if file_size_bytes else 600.0
+        probe = AudioProbe(duration, MODEL_SAMPLE_RATE, 2)
+        reasons.append(f"probe failed, assuming {duration:.0f}s")
+
+    budget_mb = free_mb * 0.8
+    decoded_mb = probe.duration * probe.sample_rate * probe.channels * 4 / 1024 ** 2
+    song_mb = probe.duration * MODEL_SAMPLE_RATE * 2 * 4 * (profile.sources + 1) / 1024 ** 2
+    fixed_mb = profile.base_mb + decoded_mb + song_mb
+
+    segment = MIN_SEGMENT
+    for candidate in range(profile.max_segment, MIN_SEGMENT - 1, -1):
+        if fixed_mb + candidate * profile.mb_per_segment_second <= budget_mb:
+            segment = candidate
+            break
+    else:
+        reasons.append(f"only {free_mb:.0f} MB free, using minimum segment")
+    per_job_mb = segment * profile.mb_per_segment_second
+    jobs = int(max(1, min(cores, (budget_mb - fixed_mb) // per_job_mb if budget_mb > fixed_mb else 1)))
+    threads = max(1, cores // jobs)
+
+    # More shifts multiply model compute, so spare cores go to workers instead
+    shifts = 1
+    overlap = 0.25 if segment >= 6 else 0.35
+
+    # A 16-bit stereo WAV at the model rate is about 10 MB per minute
+    wav_mb = probe.duration * MODEL_SAMPLE_RATE * 2 * 2 / 1024 ** 2
+    output_format = "mp3" if wav_mb > MAX_WAV_STEM_MB else "wav"
+    if output_format == "mp3":
+        reasons.append(f"stems would be {wav_mb:.0f} MB as WAV")
+
+    estimated_mb = fixed_mb + jobs * per_job_mb
+    return SeparationPlan(round(probe.duration, 2), segment, overlap, shifts, jobs, threads,
+                          output_format, round(estimated_mb), "; ".join(reasons) or "defaults fit")
@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+def fingerprint(*parts: Any) -> str:
+    """Stable key for a request made of JSON-serialisable parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class _Counters:
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, shared: bool):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if shared:
+                self.coalesced[name] = self.coalesced.get(name, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                name: {
+                    "calls": calls,
+                    "coalesced": self.coalesced.get(name, 0),
+                    "coalescedRate": round(self.coalesced.get(name, 0) / calls, 3),
+                }
+                for name, calls in self.calls.items()
+            }
+
+
+class SingleFlight:
+    """runs one call per key at a time for blocking code
+    a caller arriving while the same key is in flight waits for that call and gets its result or exception
+    counts per name how many calls were answered by someone else's call
+    """
+    def __init__(self):
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._counters = _Counters()
+
+    def do(self, name: str, key: str, fn: Callable[[], Any],
+           on_wait: Optional[Callable[[], None]] = None) -> Tuple[Any, bool]:
+        """Returns (result, whether it came from a call another caller started).
+        `on_wait` runs before a caller starts waiting on someone else's call."""
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        self._counters.record(name, shared=not owner)
+        if not owner and on_wait is not None:
+            on_wait()
+        if owner:
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        return future.result(), not owner
+
+    def stats(self) -> Dict[str, Any]:
+        return self._counters.stats()
+
+
+class AsyncSingleFlight:
+    """runs one coroutine per key at a time on an event loop
+    the call runs as its own task so a caller that disconnects does not cancel it for the others
+    counts per name how many calls were answered by someone else's call
+    """
+    def __init__(self):
+        self._inflight: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._counters = _Counters()
+
+    async def do(self, name: str, key: str, make_call: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns (result, whether it came from a call another caller started)."""
+        # Tasks belong to one loop, so keys are per loop; on a single loop no lock is needed
+        slot = (id(asyncio.get_running_loop()), key)
+        task = self._inflight.get(slot)
+        owner = task is None
+        if owner:
+            task = asyncio.ensure_future(make_call())
+            self._inflight[slot] = task
+            task.add_done_callback(lambda _: self._inflight.pop(slot, None))
+        self._counters.record(name, shared=not owner)
+        return await asyncio.shield(task), not owner
+
+    def stats(self) -> Dict[str, Any]:
+        return self._counters.stats()
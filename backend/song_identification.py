@@ -0,0 +1,79 @@
+import json
+import re
+from typing import Dict, List, Optional
+
+UNKNOWN_ARTIST = "Unknown Artist"
+
+BATCH_SYSTEM_PROMPT = """You are a music expert. Your task is to identify the song title and artist for each raw audio filename in a list.
+    The filenames might contain track numbers, garbage text, or underscores. Clean them up and provide the most likely song title and artist.
+    The list is a JSON array of objects with an "index" and a "filename".
+    Respond ONLY with a JSON array holding one object per filename in the format: {"index": 0, "songTitle": "...", "artist": "..."}.
+    If you cannot determine the artist, use "Unknown Artist".
+    """
+
+_EXTENSION = re.compile(r"\.[A-Za-z0-9]{2,4}$")
+# Only a number with its own separator or zero padding is a track number; "3 Doors Down" and "50 Cent" are artists
+_TRACK_NUMBER = re.compile(r"^(?:\d{1,3}\s*[.)-]\s*|0\d{0,2}\s+)")
+# Anything that suggests the name needs cleaning up is left to the model
+_NOISE = re.compile(r"[_()\[\]{}|@#~]|https?:|www\.|\b(?:official|lyrics?|audio|video|remaster(?:ed)?|hq|hd|kbps)\b",
+                    re.IGNORECASE)
+
+
+def identify_locally(raw_file_name: str) -> Optional[Dict[str, str]]:
+    """Title and artist of an already clean "Artist - Title" filename, or None when the model should look at it."""
+    name = _TRACK_NUMBER.sub("", _EXTENSION.sub("", raw_file_name.strip()))
+    if _NOISE.search(name):
+        return None
+    parts = [part.strip() for part in name.split(" - ")]
+    if len(parts) != 2:
+        return None
+    artist, title = parts
+    if artist[:1].isdigit():
+        return None
+    for part in (artist, title):
+        # All lower case names still need proper capitalisation, so they are not obviously clean
+        if not re.search(r"[^\W\d_]", part) or part.islower() or len(part) > 100:
+            return None
+    return {"songTitle": title, "artist": artist}
+
+
+def batch_user_prompt(raw_file_names: List[str]) -> str:
+    return json.dumps([{"index": i, "filename": name} for i, name in enumerate(raw_file_names)], ensure_ascii=False)
+
+
+def parse_batch_response(text: str, count: int) -> Dict[int, Dict[str, str]]:
+    """Maps item index to its identification for every well formed item in a batch answer.
+
+    Items with a missing or out of range index or an empty title are dropped so the caller retries them;
+    when an index repeats the first answer wins.
+    """
+    if "```" in text:
+        text = re.sub(r"```(?:json)?", "", text)
+    items = None
+    start, end = text.find("["), text.rfind("]")
+    if 0 <= start < end:
+        try:
+            items = json.loads(text[start:end + 1])
+        except ValueError:
+            items = None
+    if not isinstance(items, list):
+        # A truncated or malformed array still carries whole objects worth keeping
+        items = []
+        for match in re.finditer(r"\{[^{}]*\}", text):
+            try:
+                items.append(json.loads(match.group(0)))
+            except ValueError:
+                continue
+
+    results: Dict[int, Dict[str, str]] = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index, title, artist = item.get("index"), item.get("songTitle"), item.get("artist")
+        if type(index) is not int or not 0 <= index < count or index in results:
+            continue
+        if not isinstance(title, str) or not title.strip():
+            continue
+        artist = artist.strip() if isinstance(artist, str) and artist.strip() else UNKNOWN_ARTIST
+        results[index] = {"songTitle": title.strip(), "artist": artist}
+    return results
@@ -0,0 +1,94 @@
+import base64
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+try:
+    from .audio_analysis import open_audio_stream
+except ImportError:
+    from audio_analysis import open_audio_stream
+
+ACTIVITY_HOP_SECONDS = float(os.getenv("ACTIVITY_HOP_SECONDS", "0.5"))
+ACTIVITY_FLOOR_DB = float(os.getenv("ACTIVITY_FLOOR_DB", "-60"))
+# How many separate dense windows share the excerpt's duration; 1 sends one continuous window
+EXCERPT_WINDOWS = int(os.getenv("EXCERPT_WINDOWS", "1"))
+_FRAME = 1024
+
+
+class ActivityMap(NamedTuple):
+    hop_seconds: float
+    values: np.ndarray  # one uint8 per hop, 0 for silence up to 255 for loud playing with many onsets
+
+    def to_manifest(self) -> Dict[str, Any]:
+        return {"hopSeconds": self.hop_seconds, "values": base64.b64encode(self.values.tobytes()).decode("ascii")}
+
+    @classmethod
+    def from_manifest(cls, entry: Dict[str, Any]) -> "ActivityMap":
+        values = np.frombuffer(base64.b64decode(entry["values"]), dtype=np.uint8)
+        return cls(float(entry["hopSeconds"]), values)
+
+
+def compute_activity(file_path: str, hop_seconds: float = ACTIVITY_HOP_SECONDS) -> ActivityMap:
+    """Streams the stem once and scores each hop by its loudness, weighted by how many note onsets it has.
+
+    Loudness is the RMS in dB above ACTIVITY_FLOOR_DB; onsets are the spectral flux of short frames
+    summed over the hop. Both are computed for a whole block of frames at a time.
+    """
+    sample_rate, blocks = open_audio_stream(file_path)
+    frames_per_hop = max(1, int(round(hop_seconds * sample_rate / _FRAME)))
+    hop = frames_per_hop * _FRAME
+    window = np.hanning(_FRAME).astype(np.float32)
+    leftover = np.zeros(0, dtype=np.float32)
+    previous: Optional[np.ndarray] = None
+    energy_parts, flux_parts = [], []
+    for block in blocks:
+        samples = np.concatenate([leftover, block])
+        whole = len(samples) - len(samples) % hop
+        leftover = samples[whole:]
+        if not whole:
+            continue
+        frames = samples[:whole].reshape(-1, _FRAME)
+        energy_parts.append((frames ** 2).mean(axis=1).reshape(-1, frames_per_hop).mean(axis=1))
+        spectrum = np.log1p(100 * np.abs(np.fft.rfft(frames * window, axis=1)))
+        first = spectrum[:1] if previous is None else previous[None, :]
+        flux = np.maximum(np.diff(spectrum, axis=0, prepend=first), 0).sum(axis=1)
+        flux_parts.append(flux.reshape(-1, frames_per_hop).sum(axis=1))
+        previous = spectrum[-1]
+    if len(leftover):
+        energy_parts.append(np.array([(leftover ** 2).mean()]))
+        flux_parts.append(np.zeros(1))
+    if not energy_parts:
+        return ActivityMap(hop / sample_rate, np.zeros(0, dtype=np.uint8))
+
+    decibels = 10 * np.log10(np.concatenate(energy_parts) + 1e-12)
+    loudness = np.clip((decibels - ACTIVITY_FLOOR_DB) / -ACTIVITY_FLOOR_DB, 0, 1)
+    flux = np.concatenate(flux_parts)
+    onsets = np.clip(flux / (np.percentile(flux, 95) + 1e-9), 0, 1)
+    activity = loudness * (0.5 + 0.5 * onsets)
+    return ActivityMap(hop / sample_rate, np.round(activity * 255).astype(np.uint8))
+
+
+def densest_windows(activity: ActivityMap, total_seconds: float,
+                    count: int = EXCERPT_WINDOWS) -> List[Tuple[float, float]]:
+    """Splits `total_seconds` into `count` non-overlapping windows with the most activity, in time order.
+
+    Returns [(start, duration)]; a song shorter than the budget is sent whole.
+    """
+    count = max(1, count)
+    values = activity.values.astype(np.float64)
+    span = max(1, int(round(total_seconds / count / activity.hop_seconds)))
+    if len(values) <= span * count:
+        return [(0.0, total_seconds)]
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    sums = cumulative[span:] - cumulative[:-span]  # activity of the window starting at each hop
+    available = np.ones(len(sums), dtype=bool)
+    chosen = []
+    for _ in range(count):
+        if not available.any():
+            break
+        best = int(np.argmax(np.where(available, sums, -1)))
+        chosen.append(best)
+        available[max(0, best - span + 1):best + span] = False
+    return [(round(start * activity.hop_seconds, 3), round(span * activity.hop_seconds, 3))
+            for start in sorted(chosen)]
@@ -0,0 +1,67 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+
+class Rendition(NamedTuple):
+    name: str
+    extension: str
+    content_type: str
+    ffmpeg_args: List[str]
+
+
+def renditions_from_env() -> List[Rendition]:
+    """Builds the encoding ladder from STEM_RENDITIONS, e.g. "flac,opus" or "flac,opus,aac"."""
+    opus_kbps = os.getenv("STEM_OPUS_BITRATE_KBPS", "128")
+    aac_kbps = os.getenv("STEM_AAC_BITRATE_KBPS", "160")
+    available = {
+        # lossless archival copy
+        "flac": Rendition("flac", "flac", "audio/flac", ["-c:a", "flac", "-compression_level", "5"]),
+        # compact streaming copies
+        "opus": Rendition("opus", "opus", "audio/ogg", ["-c:a", "libopus", "-b:a", f"{opus_kbps}k", "-vbr", "on"]),
+        "aac": Rendition("aac", "m4a", "audio/mp4", ["-c:a", "aac", "-b:a", f"{aac_kbps}k", "-movflags", "+faststart"]),
+    }
+    names = [n.strip() for n in os.getenv("STEM_RENDITIONS", "flac,opus").split(",") if n.strip()]
+    return [available[n] for n in names if n in available]
+
+
+def ladder_signature(renditions: List[Rendition]) -> str:
+    return ",".join(f"{r.name}:{' '.join(r.ffmpeg_args)}" for r in renditions)
+
+
+class StemEncoder:
+    """encodes separated stems into a ladder of renditions with ffmpeg
+    every (stem rendition) pair is its own single threaded ffmpeg process
+    and they run side by side so the ladder uses every core
+    a failed encode is logged and skipped so the source stems still publish
+    """
+    def __init__(self, renditions: List[Rendition] = None, max_workers: int = None):
+        self.renditions = renditions if renditions is not None else renditions_from_env()
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+    def _encode(self, source: Path, rendition: Rendition) -> Path:
+        target = source.with_suffix(f".{rendition.extension}")
+        command = ["ffmpeg", "-y", "-v", "error", "-i", str(source), "-threads", "1", *rendition.ffmpeg_args, str(target)]
+        subprocess.run(command, capture_output=True, text=True, check=True)
+        return target
+
+    def encode(self, stems: Dict[str, Path]) -> Dict[str, Dict[str, Path]]:
+        """Returns {stem: {rendition: encoded path}} for every encode that succeeded."""
+        if not self.renditions or not stems:
+            return {}
+        results: Dict[str, Dict[str, Path]] = {name: {} for name in stems}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stem-encode") as pool:
+            futures = {
+                (stem, rendition.name): pool.submit(self._encode, path, rendition)
+                for stem, path in stems.items() for rendition in self.renditions
+            }
+            for (stem, rendition_name), future in futures.items():
+                try:
+                    results[stem][rendition_name] = future.result()
+                except subprocess.CalledProcessError as e:
+                    print(f"Encoding {stem} as {rendition_name} failed: {(e.stderr or '').strip()}")
+                except Exception as e:
+                    print(f"Encoding {stem} as {rendition_name} failed: {e}")
+        return results
@@ -0,0 +1,310 @@
+import hashlib
+import math
+import os
+import struct
+import subprocess
+import sys
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import requests
+
+try:
+    from .local_stem_cache import get_stem_cache
+except ImportError:
+    from local_stem_cache import get_stem_cache
+
+EXCERPT_CACHE_DIR = Path(os.getenv("EXCERPT_CACHE_DIR", str(Path(__file__).parent / "stem_excerpts")))
+EXCERPT_CACHE_MAX_ENTRIES = int(os.getenv("EXCERPT_CACHE_MAX_ENTRIES", "100"))
+EXCERPT_SECONDS = float(os.getenv("EXCERPT_SECONDS", "90"))
+# The container ffmpeg writes the excerpt in, picked from the file extension
+EXCERPT_FORMAT = os.getenv("EXCERPT_FORMAT", "flac")
+EXCERPT_CHUNK_BYTES = 256 * 1024
+# Enough to hold the RIFF header and any metadata chunks written before the PCM data
+WAV_HEADER_BYTES = 64 * 1024
+
+# (format tag, bits per sample) -> ffmpeg raw sample format
+_PCM_FORMATS = {
+    (1, 8): "u8", (1, 16): "s16le", (1, 24): "s24le", (1, 32): "s32le",
+    (3, 32): "f32le", (3, 64): "f64le",
+}
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class PcmLayout(NamedTuple):
+    data_offset: int
+    data_size: int
+    sample_rate: int
+    channels: int
+    block_align: int
+    sample_format: str
+
+    def byte_range(self, start: float, duration: float) -> Tuple[int, int]:
+        """Inclusive byte range of the PCM frames covering start..start+duration seconds."""
+        first = self.data_offset + min(int(start * self.sample_rate) * self.block_align, self.data_size)
+        frames = int(math.ceil(duration * self.sample_rate))
+        last = min(first + frames * self.block_align, self.data_offset + self.data_size) - 1
+        return first, max(first, last)
+
+
+def parse_wav_header(header: bytes) -> Optional[PcmLayout]:
+    """Finds the PCM data chunk and its sample layout in the first bytes of a WAV file, or None."""
+    if len(header) < 12 or header[:4] not in (b"RIFF", b"RF64") or header[8:12] != b"WAVE":
+        return None
+    offset, fmt = 12, None
+    while offset + 8 <= len(header):
+        chunk_id, size = struct.unpack_from("<4sI", header, offset)
+        body = offset + 8
+        if chunk_id == b"fmt " and body + 16 <= len(header):
+            tag, channels, rate, _, block_align, bits = struct.unpack_from("<HHIIHH", header, body)
+            if tag == _WAVE_FORMAT_EXTENSIBLE and size >= 26 and body + 26 <= len(header):
+                tag = struct.unpack_from("<H", header, body + 24)[0]
+            fmt = (tag, channels, rate, block_align, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            tag, channels, rate, block_align, bits = fmt
+            sample_format = _PCM_FORMATS.get((tag, bits))
+            if sample_format is None or not block_align or not rate:
+                return None
+            if size in (0, 0xFFFFFFFF):
+                size = sys.maxsize  # streamed or RF64 files leave the size open; read to the end
+            return PcmLayout(body, size, rate, channels, block_align, sample_format)
+        offset = body + size + (size & 1)
+    return None
+
+
+def excerpt_cache_key(urls: List[str], windows: List[Tuple[float, float]]) -> str:
+    spans = ",".join(f"{start:.3f}+{duration:.3f}" for start, duration in windows)
+    raw = f"{'|'.join(urls)}|{spans}|{EXCERPT_FORMAT}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def trim_args(windows: List[Tuple[float, float]]) -> Tuple[List[str], List[str]]:
+    """ffmpeg (input, output) arguments keeping only `windows` of the input, joined end to end."""
+    if len(windows) == 1:
+        start, duration = windows[0]
+        return ["-ss", f"{start:.3f}", "-t", f"{duration:.3f}"], []
+    trims = "".join(f"[0:a]atrim=start={start:.3f}:duration={duration:.3f},asetpts=PTS-STARTPTS[w{i}];"
+                    for i, (start, duration) in enumerate(windows))
+    joined = "".join(f"[w{i}]" for i in range(len(windows)))
+    # As an input option -t closes the input at the last window's end instead of decoding the rest of the stem
+    end = max(start + duration for start, duration in windows)
+    return ["-t", f"{end:.3f}"], ["-filter_complex", f"{trims}{joined}concat=n={len(windows)}:v=0:a=1[out]",
+                                  "-map", "[out]"]
+
+
+def _chain(streams: Iterator[Iterator[bytes]]) -> Iterator[bytes]:
+    # yield from passes close() on to the stream being read, so its response is released early
+    for stream in streams:
+        yield from stream
+
+
+def _encode(command: List[str], chunks: Optional[Iterator[bytes]], out_path: Path):
+    """Runs ffmpeg into `out_path`, feeding it `chunks` on stdin until it has what it needs."""
+    process = subprocess.Popen(command + [str(out_path)], stdin=subprocess.PIPE if chunks is not None else None,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        if chunks is not None:
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                pass  # ffmpeg reached the end of the window and exited; stop fetching
+            finally:
+                chunks.close()
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr.decode(errors="replace"))
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+
+class ExcerptExtractor:
+    """cuts the short excerpt of a stem that is sent to gemini
+    stems already in the local stem cache are cut from disk with no download
+    pcm wav stems are fetched with one ranged get covering only the window
+    other formats are streamed into ffmpeg and the stream is closed once ffmpeg has the window
+    each (stem window) excerpt is encoded once and kept on disk least recently used first
+    excerpts pinned by a caller still reading them are never evicted
+    """
+    def __init__(self, cache_dir: Path = EXCERPT_CACHE_DIR, max_entries: int = EXCERPT_CACHE_MAX_ENTRIES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.bytes_fetched = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Path]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        # key -> callers holding the excerpt, counted from before it exists so a fresh one is never evicted
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        for existing in sorted(self.cache_dir.glob(f"*.{EXCERPT_FORMAT}"), key=lambda p: p.stat().st_mtime):
+            self._entries[existing.stem] = existing
+
+    def _reader(self, s3_client, bucket: str, url: str) -> Callable[..., Iterator[bytes]]:
+        """A function returning the chunks of bytes first..last of `url`, from S3 when it is in our bucket."""
+        parsed = urllib.parse.urlparse(url)
+        key = urllib.parse.unquote(parsed.path.lstrip("/")) if parsed.netloc.startswith(f"{bucket}.s3") else None
+
+        def read(first: int = 0, last: Optional[int] = None) -> Iterator[bytes]:
+            byte_range = f"bytes={first}-{'' if last is None else last}"
+            if key is not None:
+                body = s3_client.get_object(Bucket=bucket, Key=key, Range=byte_range)["Body"]
+                chunks, close = iter(lambda: body.read(EXCERPT_CHUNK_BYTES), b""), body.close
+            else:
+                response = requests.get(url, headers={"Range": byte_range}, stream=True, timeout=60)
+                response.raise_for_status()
+                chunks, close = response.iter_content(chunk_size=EXCERPT_CHUNK_BYTES), response.close
+            # A server that ignores Range sends the whole object, so stop at the end of the range regardless
+            remaining = None if last is None else last - first + 1
+            try:
+                for chunk in chunks:
+                    if remaining is not None:
+                        chunk = chunk[:remaining]
+                        remaining -= len(chunk)
+                    with self._lock:
+                        self.bytes_fetched += len(chunk)
+                    yield chunk
+                    if remaining == 0:
+                        break
+            finally:
+                close()
+        return read
+
+    def _cut(self, s3_client, bucket: str, urls: List[str], windows: List[Tuple[float, float]], out_path: Path):
+        window, trim = trim_args(windows)
+        output = [*trim, "-vn", "-y"]
+        cache = get_stem_cache()
+        for url in urls:
+            parsed = urllib.parse.urlparse(url)
+            key = urllib.parse.unquote(parsed.path.lstrip("/"))
+            if parsed.netloc.startswith(f"{bucket}.s3") and cache.contains(key):
+                with cache.pinned(s3_client, bucket, key) as path:
+                    _encode(["ffmpeg", "-v", "error", *window, "-i", str(path), *output], None, out_path)
+                return
+
+        for url in urls:
+            if not urllib.parse.urlparse(url).path.lower().endswith(".wav"):
+                continue
+            read = self._reader(s3_client, bucket, url)
+            layout = parse_wav_header(b"".join(read(0, WAV_HEADER_BYTES - 1)))
+            if layout is None:
+                continue
+            ranges = [layout.byte_range(start, duration) for start, duration in windows]
+            command = ["ffmpeg", "-v", "error", "-f", layout.sample_format, "-ar", str(layout.sample_rate),
+                       "-ac", str(layout.channels), "-i", "pipe:0", "-vn", "-y"]
+            # Raw PCM has no framing, so the windows are joined simply by sending their ranges back to back
+            _encode(command, _chain(read(first, last) for first, last in ranges), out_path)
+            return
+
+        # Compressed frames have no fixed byte offset, so read from the start and stop at the last window's end
+        read = self._reader(s3_client, bucket, urls[-1])
+        _encode(["ffmpeg", "-v", "error", *window, "-i", "pipe:0", *output], read(0), out_path)
+
+    def _extract(self, key: str, s3_client, bucket: str, urls: List[str], windows: List[Tuple[float, float]]) -> Path:
+        target = self.cache_dir / f"{key}.{EXCERPT_FORMAT}"
+        partial = self.cache_dir / f"{key}.{threading.get_ident()}.part.{EXCERPT_FORMAT}"
+        try:
+            self._cut(s3_client, bucket, urls, windows, partial)
+            os.replace(partial, target)
+        finally:
+            partial.unlink(missing_ok=True)
+        evicted = []
+        with self._lock:
+            self._entries[key] = target
+            self._entries.move_to_end(key)
+            for old_key in list(self._entries):
+                if len(self._entries) <= self.max_entries:
+                    break
+                if old_key == key or self._pins.get(old_key):
+                    continue
+                evicted.append(self._entries.pop(old_key))
+                self.evictions += 1
+        for path in evicted:
+            path.unlink(missing_ok=True)
+        return target
+
+    def excerpt(self, s3_client, bucket: str, urls: List[str],
+                windows: Optional[List[Tuple[float, float]]] = None, pin: bool = False) -> Tuple[Path, bool]:
+        """Returns (path to the excerpt, whether it came from the cache).
+
+        `urls` are renditions of one stem; a WAV among them is cut by byte range, otherwise the last is streamed.
+        `windows` are (start, duration) pairs in time order, joined into one excerpt; the default is the opening
+        EXCERPT_SECONDS. With `pin` the excerpt is kept on disk until it is handed to release.
+        """
+        windows = windows or [(0.0, EXCERPT_SECONDS)]
+        urls = [url for url in urls if url]
+        if not urls:
+            raise LookupError("No source for the excerpt.")
+        key = excerpt_cache_key(urls, windows)
+        with self._lock:
+            cached = self._entries.get(key)
+            if pin:
+                self._pins[key] = self._pins.get(key, 0) + 1
+            if cached is not None and cached.exists():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached, True
+            self.misses += 1
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if owner:
+            try:
+                future.set_result(self._extract(key, s3_client, bucket, urls, windows))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        try:
+            return future.result(), False
+        except BaseException:
+            if pin:
+                self.release(self.cache_dir / f"{key}.{EXCERPT_FORMAT}")
+            raise
+
+    def release(self, path: Path):
+        """Unpins an excerpt returned with pin=True, letting it be evicted again."""
+        key = Path(path).name[:-len(f".{EXCERPT_FORMAT}")]
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytesFetched": self.bytes_fetched,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+def excerpt_sources(manifest: Dict[str, Any], stem: str = "guitar") -> List[str]:
+    """Renditions of `stem` to cut an excerpt from, a PCM WAV first and the primary stem URL last."""
+    stems = manifest.get("stems", {})
+    primary = stems.get(stem) or stems.get(stem.capitalize())
+    wav = manifest.get("renditions", {}).get(stem, {}).get("wav")
+    return ([wav] if wav and wav != primary else []) + ([primary] if primary else [])
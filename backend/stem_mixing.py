@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib.parse
+import wave
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    from .local_stem_cache import get_stem_cache
+except ImportError:
+    from local_stem_cache import get_stem_cache
+
+# "two" keeps the guitar / no_guitar split, "six" also keeps every htdemucs_6s source for derived mixes
+SEPARATION_STEM_MODE = os.getenv("SEPARATION_STEM_MODE", "two")
+SIX_STEM_SOURCES = ("drums", "bass", "other", "vocals", "guitar", "piano")
+MIX_BLOCK_SECONDS = float(os.getenv("MIX_BLOCK_SECONDS", "10"))
+MIX_INDEX_MAX_ENTRIES = int(os.getenv("MIX_INDEX_MAX_ENTRIES", "1000"))
+
+
+def mix_stems(paths: List[Path], out_path: Path, gains: Optional[List[float]] = None) -> Path:
+    """Sums 16-bit PCM WAV stems block by block into one WAV, so memory stays bounded for long songs."""
+    readers = [wave.open(str(path), "rb") for path in paths]
+    try:
+        params = {(r.getnchannels(), r.getsampwidth(), r.getframerate()) for r in readers}
+        if len(params) != 1:
+            raise ValueError("Stems to mix must share channels, sample width and rate.")
+        channels, width, rate = params.pop()
+        if width != 2:
+            raise ValueError("Only 16-bit PCM stems can be mixed.")
+        weights = np.asarray(gains if gains is not None else [1.0] * len(readers), dtype=np.float32)[:, None, None]
+        block = int(MIX_BLOCK_SECONDS * rate)
+        with wave.open(str(out_path), "wb") as writer:
+            writer.setnchannels(channels)
+            writer.setsampwidth(2)
+            writer.setframerate(rate)
+            while True:
+                raws = [r.readframes(block) for r in readers]
+                length = min(len(raw) for raw in raws) // (2 * channels)
+                if length == 0:
+                    break
+                stack = np.stack([np.frombuffer(raw, dtype="<i2", count=length * channels).reshape(length, channels)
+                                  for raw in raws]).astype(np.float32)
+                mixed = np.clip((stack * weights).sum(axis=0), -32768, 32767)
+                writer.writeframes(mixed.astype("<i2").tobytes())
+    finally:
+        for reader in readers:
+            reader.close()
+    return out_path
+
+
+def mix_name(stems: List[str]) -> str:
+    """Canonical name for a set of sources, independent of the order they were asked for in."""
+    return "+".join(sorted(set(stems), key=SIX_STEM_SOURCES.index))
+
+
+def _key_from_url(url: str) -> str:
+    return urllib.parse.unquote(urllib.parse.urlparse(url).path.lstrip("/"))
+
+
+class StemMixer:
+    """derives any combination of six stem sources from one separation
+    a mix is the plain sum of the chosen source wavs done block by block in numpy
+    every mix is published once under the project and reused after that
+    concurrent requests for the same mix share one render
+    """
+    def __init__(self, max_entries: int = MIX_INDEX_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._known: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str, url: str):
+        with self._lock:
+            self._known[key] = url
+            self._known.move_to_end(key)
+            while len(self._known) > self.max_entries:
+                self._known.popitem(last=False)
+
+    def _render(self, s3_client, bucket: str, key: str, url: str, sources: Dict[str, str], stems: List[str]) -> str:
+        work_dir = Path(tempfile.mkdtemp(prefix="mix-"))
+        cache = get_stem_cache()
+        try:
+            with ExitStack() as stack:
+                local_paths = [stack.enter_context(cache.pinned(s3_client, bucket, _key_from_url(sources[name])))
+                               for name in stems]
+                mixed = mix_stems(local_paths, work_dir / "mix.wav")
+            s3_client.upload_file(str(mixed), bucket, key,
+                                  ExtraArgs={'ACL': 'public-read', 'ContentType': 'audio/wav'})
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return url
+
+    def mix(self, s3_client, bucket: str, base_url: str, username: str, task_id: str,
+            stems: List[str]) -> Tuple[str, bool]:
+        """Returns (url of the mix, whether it already existed). Raises LookupError or ValueError on bad requests."""
+        with get_stem_cache().mapped(s3_client, bucket, f"stems/{username}/{task_id}/manifest.json") as view:
+            manifest: Dict[str, Any] = json.loads(view[:])
+        sources = manifest.get("sources")
+        if not sources:
+            raise LookupError("This project was separated without individual sources.")
+        unknown = [name for name in stems if name not in sources]
+        if unknown or not stems:
+            raise ValueError(f"Choose stems from: {', '.join(sources)}.")
+
+        name = mix_name(stems)
+        if "+" not in name:
+            return sources[name], True
+        if set(stems) == set(sources) - {"guitar"} and manifest.get("stems", {}).get("backingTrack"):
+            return manifest["stems"]["backingTrack"], True
+
+        key = f"stems/{username}/{task_id}/mixes/{name}.wav"
+        url = f"{base_url}/{key}"
+        with self._lock:
+            if key in self._known:
+                self._known.move_to_end(key)
+                self.hits += 1
+                return url, True
+        if s3_client.list_objects_v2(Bucket=bucket, Prefix=key).get("KeyCount", 0):
+            self._remember(key, url)
+            with self._lock:
+                self.hits += 1
+            return url, True
+
+        with self._lock:
+            self.misses += 1
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if owner:
+            try:
+                future.set_result(self._render(s3_client, bucket, key, url, sources,
+                                               sorted(set(stems), key=SIX_STEM_SOURCES.index)))
+                self._remember(key, url)
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        return future.result(), False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "knownMixes": len(self._known),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,110 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+# "hls" packages every stem as fMP4 HLS segments next to the whole-file renditions, "off" skips it
+STEM_PACKAGING = os.getenv("STEM_PACKAGING", "hls")
+HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", "2"))
+HLS_AAC_BITRATE_KBPS = os.getenv("HLS_AAC_BITRATE_KBPS", "160")
+
+CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".mp4": "audio/mp4",
+    ".m4s": "audio/mp4",
+}
+
+
+class StreamSegment(NamedTuple):
+    path: Path
+    start: float
+    duration: float
+
+
+class PackagedStem(NamedTuple):
+    playlist: Path
+    init: Optional[Path]
+    segments: List[StreamSegment]
+
+    def files(self) -> List[Path]:
+        return [self.playlist] + ([self.init] if self.init else []) + [s.path for s in self.segments]
+
+
+def parse_playlist(playlist: Path) -> PackagedStem:
+    """Reads a VOD media playlist into its init section and timed segments."""
+    init, segments, start, duration = None, [], 0.0, None
+    for line in playlist.read_text().splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-MAP:"):
+            match = re.search(r'URI="([^"]+)"', line)
+            if match:
+                init = playlist.parent / match.group(1)
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",")[0])
+        elif line and not line.startswith("#") and duration is not None:
+            segments.append(StreamSegment(playlist.parent / line, round(start, 3), duration))
+            start += duration
+            duration = None
+    return PackagedStem(playlist, init, segments)
+
+
+class StemPackager:
+    """packages stems as hls with fragmented mp4 audio segments
+    each segment is a few seconds long and decodes on its own after the shared init section
+    so a player can start or seek anywhere after fetching one small segment
+    stems are packaged side by side with one single threaded ffmpeg each
+    a stem that fails to package is logged and skipped
+    """
+    def __init__(self, segment_seconds: float = HLS_SEGMENT_SECONDS, max_workers: int = None,
+                 enabled: bool = STEM_PACKAGING == "hls"):
+        self.segment_seconds = segment_seconds
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.enabled = enabled
+
+    def _package(self, stem_name: str, source: Path) -> PackagedStem:
+        out_dir = source.parent / "hls" / stem_name
+        out_dir.mkdir(parents=True, exist_ok=True)
+        playlist = out_dir / "index.m3u8"
+        command = [
+            "ffmpeg", "-y", "-v", "error", "-i", str(source), "-threads", "1",
+            "-c:a", "aac", "-b:a", f"{HLS_AAC_BITRATE_KBPS}k",
+            "-f", "hls", "-hls_time", str(self.segment_seconds), "-hls_playlist_type", "vod",
+            "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", "init.mp4",
+            "-hls_segment_filename", str(out_dir / "segment_%05d.m4s"), str(playlist)
+        ]
+        subprocess.run(command, capture_output=True, text=True, check=True)
+        return parse_playlist(playlist)
+
+    def package(self, stems: Dict[str, Path]) -> Dict[str, PackagedStem]:
+        """Returns {stem: packaged stem} for every stem that packaged successfully."""
+        if not self.enabled or not stems:
+            return {}
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stem-package") as pool:
+            futures = {stem: pool.submit(self._package, stem, path) for stem, path in stems.items()}
+            for stem, future in futures.items():
+                try:
+                    packaged = future.result()
+                    if packaged.segments:
+                        results[stem] = packaged
+                except subprocess.CalledProcessError as e:
+                    print(f"Packaging {stem} as HLS failed: {(e.stderr or '').strip()}")
+                except Exception as e:
+                    print(f"Packaging {stem} as HLS failed: {e}")
+        return results
+
+
+def stream_index(packaged: PackagedStem, base_url: str, segment_seconds: float) -> dict:
+    """Manifest entry for one packaged stem; `base_url` is where the stem's hls directory is published."""
+    return {
+        "type": "hls",
+        "playlist": f"{base_url}/{packaged.playlist.name}",
+        "init": f"{base_url}/{packaged.init.name}" if packaged.init else None,
+        "segmentSeconds": segment_seconds,
+        "segments": [
+            {"url": f"{base_url}/{s.path.name}", "start": s.start, "duration": s.duration}
+            for s in packaged.segments
+        ],
+    }
@@ -0,0 +1,68 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+
+
+class StemUpload(NamedTuple):
+    name: str
+    local_path: Path
+    key: str
+    content_type: str
+
+
+def transfer_config_from_env() -> TransferConfig:
+    """Multipart settings for stem uploads; WAV stems are tens of MB so parts are uploaded in parallel."""
+    chunk_mb = int(os.getenv("STEM_UPLOAD_CHUNK_MB", "8"))
+    return TransferConfig(
+        multipart_threshold=chunk_mb * MB,
+        multipart_chunksize=chunk_mb * MB,
+        max_concurrency=int(os.getenv("STEM_UPLOAD_CONCURRENCY", "8")),
+        use_threads=True,
+    )
+
+
+# Shared across jobs so concurrent separations do not each spin up their own upload threads
+_file_pool = ThreadPoolExecutor(max_workers=int(os.getenv("STEM_UPLOAD_PARALLEL_FILES", "4")),
+                                thread_name_prefix="stem-upload")
+
+
+class StemPublisher:
+    """uploads a batch of stem files to s3 at the same time
+    each file is a multipart upload using the tuned transfer config
+    returns bytes seconds and throughput for every stem
+    """
+    def __init__(self, s3_client, transfer_config: TransferConfig = None):
+        self.s3_client = s3_client
+        self.transfer_config = transfer_config or transfer_config_from_env()
+
+    def _upload_one(self, bucket_name: str, upload: StemUpload) -> Dict[str, float]:
+        size = upload.local_path.stat().st_size
+        started = time.perf_counter()
+        self.s3_client.upload_file(
+            str(upload.local_path), bucket_name, upload.key,
+            ExtraArgs={'ACL': 'public-read', 'ContentType': upload.content_type},
+            Config=self.transfer_config
+        )
+        seconds = max(time.perf_counter() - started, 1e-6)
+        return {"bytes": size, "seconds": round(seconds, 3), "mbps": round(size / MB / seconds, 2)}
+
+    def publish(self, bucket_name: str, uploads: List[StemUpload]) -> Dict[str, Dict[str, float]]:
+        """Uploads every file concurrently and waits for all of them. Re-raises the first failure."""
+        futures = {upload.name: _file_pool.submit(self._upload_one, bucket_name, upload) for upload in uploads}
+        stats, first_error = {}, None
+        for name, future in futures.items():
+            try:
+                stats[name] = future.result()
+                print(f"Uploaded stem '{name}': {stats[name]['bytes'] / MB:.1f} MB in "
+                      f"{stats[name]['seconds']}s ({stats[name]['mbps']} MB/s)")
+            except Exception as e:
+                first_error = first_error or e
+        if first_error is not None:
+            raise first_error
+        return stats
@@ -1,12 +1,68 @@
+import multiprocessing
 import os
 import shutil
 import subprocess
 import json
+import threading
+import time
+import wave
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Tuple
 import boto3
 import numpy as np
 import traceback
 
+try:
+    from .job_scheduler import CancelToken, JobCancelled
+except ImportError:
+    from job_scheduler import CancelToken, JobCancelled
+
+try:
+    from .stem_publishing import StemPublisher, StemUpload
+except ImportError:
+    from stem_publishing import StemPublisher, StemUpload
+
+try:
+    from .stem_encoding import StemEncoder, ladder_signature
+except ImportError:
+    from stem_encoding import StemEncoder, ladder_signature
+
+try:
+    from .separation_planner import SeparationPlan, available_resources, job_share, plan_separation, probe_audio
+except ImportError:
+    from separation_planner import SeparationPlan, available_resources, job_share, plan_separation, probe_audio
+
+try:
+    from .audio_analysis import analyze_audio_streaming
+except ImportError:
+    from audio_analysis import analyze_audio_streaming
+
+try:
+    from .stem_packaging import CONTENT_TYPES as STREAM_CONTENT_TYPES, StemPackager, stream_index
+except ImportError:
+    from stem_packaging import CONTENT_TYPES as STREAM_CONTENT_TYPES, StemPackager, stream_index
+
+try:
+    from .local_stem_cache import get_stem_cache
+except ImportError:
+    from local_stem_cache import get_stem_cache
+
+try:
+    from .stem_mixing import SEPARATION_STEM_MODE, SIX_STEM_SOURCES, mix_stems
+except ImportError:
+    from stem_mixing import SEPARATION_STEM_MODE, SIX_STEM_SOURCES, mix_stems
+
+try:
+    from .stem_activity import compute_activity
+except ImportError:
+    from stem_activity import compute_activity
+
+try:
+    from .waveform_peaks import PEAKS_CONTENT_TYPE, compute_peak_pyramid, encode_pyramid
+except ImportError:
+    from waveform_peaks import PEAKS_CONTENT_TYPE, compute_peak_pyramid, encode_pyramid
+
 try:
     import essentia.standard as es
     from essentia import Pool
@@ -14,7 +70,7 @@ except ImportError:
     es = None
     print("="*80)
     print("WARNING: The 'essentia' library could not be imported.")
-    print("Audio analysis (BPM, Key, Structure) will be skipped. Please ensure it is installed.")
+    print("Audio analysis (BPM, Key) will use the built-in streaming NumPy analyzer instead.")
     print("="*80)
 
 
@@ -23,6 +79,335 @@ OUTPUT_DIR = Path(__file__).parent / "separated_audio"
 INPUT_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# "subprocess" runs `python -m demucs.separate` per job, "inprocess" keeps the model loaded in the worker
+SEPARATION_ENGINE = os.getenv("SEPARATION_ENGINE", "subprocess")
+# Progressive mode publishes playable stem segments as each window finishes (needs the in-process engine)
+SEPARATION_STREAMING = os.getenv("SEPARATION_STREAMING", "0") == "1"
+PROGRESSIVE_WINDOW_SECONDS = float(os.getenv("PROGRESSIVE_WINDOW_SECONDS", "20"))
+PROGRESSIVE_OVERLAP_SECONDS = float(os.getenv("PROGRESSIVE_OVERLAP_SECONDS", "1"))
+# Rendition served under manifest["stems"]; empty keeps the raw Demucs output for older clients
+STEM_PRIMARY_RENDITION = os.getenv("STEM_PRIMARY_RENDITION", "")
+# BPM/key analysis runs in worker processes alongside separation; 0 workers turns it off
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "1"))
+ANALYSIS_TIMEOUT_SECONDS = float(os.getenv("ANALYSIS_TIMEOUT_SECONDS", "60"))
+# "auto" uses Essentia when it is installed and the streaming NumPy analyzer otherwise
+ANALYSIS_BACKEND = os.getenv("ANALYSIS_BACKEND", "auto")
+
+
+class DemucsEngine:
+    """keeps a demucs model resident in this worker process
+    the model is loaded once on warm up or on the first job
+    separation runs apply_model straight on tensors with no subprocess
+    exposes its readiness so the api can report it from a health check
+    """
+    def __init__(self, model: str, device: Optional[str] = None):
+        self.model_name = model
+        self.device = device or os.getenv("DEMUCS_DEVICE", "cpu")
+        self.state = "cold"
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.jobs_completed = 0
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+    def warm_up(self):
+        """Loads the model weights and runs a tiny dummy pass so the first real job starts hot."""
+        with self._load_lock:
+            if self._model is not None:
+                return self._model
+            self.state = "loading"
+            started = time.perf_counter()
+            try:
+                import torch
+                from demucs.apply import apply_model
+                from demucs.pretrained import get_model
+
+                model = get_model(self.model_name)
+                model.to(self.device)
+                model.eval()
+                dummy = torch.zeros(1, model.audio_channels, model.samplerate, device=self.device)
+                with torch.no_grad():
+                    apply_model(model, dummy, device=self.device, progress=False, num_workers=0)
+                self._model = model
+                self.load_seconds = round(time.perf_counter() - started, 2)
+                self.state = "ready"
+                self.error = None
+                print(f"Demucs engine '{self.model_name}' ready on {self.device} in {self.load_seconds}s")
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                print(f"Demucs engine '{self.model_name}' failed to load: {e}")
+                raise
+            return self._model
+
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def status(self) -> dict:
+        return {
+            "model": self.model_name,
+            "device": self.device,
+            "state": self.state,
+            "loadSeconds": self.load_seconds,
+            "jobsCompleted": self.jobs_completed,
+            "error": self.error,
+        }
+
+    def _load_normalized(self, input_path: Path):
+        from demucs.audio import AudioFile
+
+        model = self.warm_up()
+        wav = AudioFile(input_path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+        ref = wav.mean(0)
+        return model, (wav - ref.mean()) / ref.std(), ref.mean(), ref.std()
+
+    def _apply(self, model, mix, plan: Optional[SeparationPlan], cancel_token: Optional[CancelToken]):
+        import torch
+        from demucs.apply import apply_model
+
+        segment, overlap, shifts, jobs = (plan.segment, plan.overlap, plan.shifts, plan.jobs) if plan else (None, 0.25, 1, 0)
+        # one model instance cannot safely run two jobs at once
+        with self._run_lock, torch.no_grad():
+            if plan is not None:
+                torch.set_num_threads(plan.threads)
+            hook = None
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+                # apply_model calls forward once per segment, so this stops a cancelled job mid-song
+                hook = model.register_forward_pre_hook(lambda module, inputs: cancel_token.raise_if_cancelled())
+            try:
+                return apply_model(model, mix[None], device=self.device, segment=segment, shifts=shifts,
+                                   split=True, overlap=overlap, progress=False,
+                                   num_workers=jobs if jobs > 1 else 0)[0]
+            finally:
+                if hook is not None:
+                    hook.remove()
+
+    @staticmethod
+    def _two_stem_split(model, sources, two_stems: str):
+        stem = sources[model.sources.index(two_stems)]
+        return stem, sources.sum(0) - stem
+
+    def separate(self, input_path: Path, output_dir: Path, plan: Optional[SeparationPlan] = None,
+                 two_stems: str = "guitar", cancel_token: Optional[CancelToken] = None,
+                 keep_sources: bool = False) -> Path:
+        """Separates one file and writes {stem}.{ext} files in the same layout demucs.separate uses.
+
+        With keep_sources every model source is written as well, not just the two-stem split.
+        """
+        from demucs.audio import save_audio
+
+        output_extension = plan.output_format if plan else "wav"
+        model, wav, mean, std = self._load_normalized(input_path)
+        sources = self._apply(model, wav, plan, cancel_token) * std + mean
+
+        track_dir = output_dir / self.model_name / Path(input_path).stem
+        track_dir.mkdir(parents=True, exist_ok=True)
+        stem, rest = self._two_stem_split(model, sources, two_stems)
+        outputs = [(two_stems, stem), (f"no_{two_stems}", rest)]
+        if keep_sources:
+            outputs += [(name, sources[i]) for i, name in enumerate(model.sources) if name != two_stems]
+        for name, audio in outputs:
+            save_audio(audio.cpu(), str(track_dir / f"{name}.{output_extension}"), model.samplerate)
+
+        self.jobs_completed += 1
+        return track_dir
+
+    def separate_progressive(self, input_path: Path, output_dir: Path, on_chunk: Callable,
+                             window_seconds: float = 20.0, overlap_seconds: float = 1.0,
+                             plan: Optional[SeparationPlan] = None, two_stems: str = "guitar",
+                             cancel_token: Optional[CancelToken] = None, keep_sources: bool = False) -> Path:
+        """Separates the song window by window, calling on_chunk with each finished, crossfaded block.
+
+        The full-length {stem}.wav files are written incrementally so the usual upload step still works.
+        on_chunk only receives the two-stem split; other sources kept with keep_sources are just written.
+        """
+        model, wav, mean, std = self._load_normalized(input_path)
+        samplerate = model.samplerate
+        names = (two_stems, f"no_{two_stems}")
+        if keep_sources:
+            names += tuple(name for name in model.sources if name != two_stems)
+        track_dir = output_dir / self.model_name / Path(input_path).stem
+        track_dir.mkdir(parents=True, exist_ok=True)
+
+        def process(start: int, end: int) -> np.ndarray:
+            sources = self._apply(model, wav[:, start:end], plan, cancel_token) * std + mean
+            stem, rest = self._two_stem_split(model, sources, two_stems)
+            extra = [sources[model.sources.index(name)] for name in names[2:]]
+            return np.stack([stem.cpu().numpy(), rest.cpu().numpy()] + [audio.cpu().numpy() for audio in extra])
+
+        writers = {name: open_wav_writer(track_dir / f"{name}.wav", model.audio_channels, samplerate) for name in names}
+        try:
+            windows = overlap_add_windows(wav.shape[-1], int(window_seconds * samplerate),
+                                          int(overlap_seconds * samplerate), process)
+            for index, (start, end, block) in enumerate(windows):
+                for name, audio in zip(names, block):
+                    writers[name].writeframes(pcm16_bytes(audio))
+                on_chunk(index, start / samplerate, end / samplerate, dict(zip(names[:2], block[:2])), samplerate)
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        self.jobs_completed += 1
+        return track_dir
+
+
+def overlap_add_windows(total: int, window: int, overlap: int,
+                        process: Callable[[int, int], np.ndarray]) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """Runs process(start, end) over overlapping windows and yields finished blocks in order.
+
+    Each window's head is linearly crossfaded with the previous window's tail, and a block is
+    only yielded once no later window can touch it, so the yielded blocks tile [0, total).
+    """
+    if window <= overlap:
+        raise ValueError("window must be longer than overlap")
+    fade_in = (np.arange(overlap, dtype=np.float32) + 0.5) / max(overlap, 1)
+    fade_out = 1.0 - fade_in
+    pending = None
+    start = 0
+    while start < total:
+        end = min(start + window, total)
+        out = np.array(process(start, end), dtype=np.float32)
+        if pending is not None:
+            n = min(pending.shape[-1], out.shape[-1])
+            out[..., :n] = pending[..., :n] * fade_out[:n] + out[..., :n] * fade_in[:n]
+        if end >= total:
+            yield start, end, out
+            return
+        split = out.shape[-1] - overlap
+        pending = out[..., split:]
+        yield start, end - overlap, out[..., :split]
+        start = end - overlap
+
+
+def pcm16_bytes(audio: np.ndarray) -> bytes:
+    """Interleaves a (channels, samples) float array into little-endian 16-bit PCM."""
+    return (np.clip(audio, -1.0, 1.0).T * 32767).astype("<i2").tobytes()
+
+
+def open_wav_writer(path: Path, channels: int, samplerate: int):
+    writer = wave.open(str(path), "wb")
+    writer.setnchannels(channels)
+    writer.setsampwidth(2)
+    writer.setframerate(samplerate)
+    return writer
+
+
+_engines: Dict[str, DemucsEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(model: str) -> DemucsEngine:
+    """Returns the process-wide engine for a model, creating it on first use."""
+    with _engines_lock:
+        if model not in _engines:
+            _engines[model] = DemucsEngine(model)
+        return _engines[model]
+
+
+def convert_numpy_types(obj):
+    """Recursively converts numpy types in a dictionary to native Python types."""
+    if isinstance(obj, dict):
+        return {k: convert_numpy_types(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_numpy_types(i) for i in obj]
+    elif isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj
+
+
+def analyze_audio_with_essentia(file_path: str) -> dict:
+    """Measures BPM and key of an audio file. Runs inside the analysis process pool."""
+    if not es:
+        return {"error": "Essentia library not available."}
+    try:
+        loader = es.MonoLoader(filename=str(file_path), sampleRate=44100)
+        audio = loader()
+        sample_rate = 44100
+
+        if audio is None or len(audio) == 0:
+            print(f"Warning: Essentia's MonoLoader failed or returned empty audio for {file_path}.")
+            return {"error": "Audio file could not be loaded. It may be corrupt or in an unsupported format."}
+
+        duration = round(len(audio) / sample_rate, 2)
+        max_duration_seconds = 300
+        max_samples = int(max_duration_seconds * sample_rate)
+        if len(audio) > max_samples:
+            audio = audio[:max_samples]
+
+        if len(audio) < sample_rate * 2:
+            return {"error": "Audio file is too short for analysis."}
+        
+        rhythm_extractor = es.RhythmExtractor2013(method="multifeature")
+        bpm, _, _, _, _ = rhythm_extractor(audio)
+        
+        key_extractor = es.KeyExtractor()
+        key, scale, strength = key_extractor(audio)
+
+        analysis_data = {
+            "bpm": bpm,
+            "key": f"{key} {scale}",
+            "key_strength": strength,
+            "duration": duration,
+        }
+        
+        converted_data = convert_numpy_types(analysis_data)
+        
+        bpm_val = converted_data.get('bpm')
+        if isinstance(bpm_val, list) and bpm_val:
+            bpm_val = bpm_val[0]
+
+        strength_val = converted_data.get('key_strength')
+        if isinstance(strength_val, list) and strength_val:
+            strength_val = strength_val[0]
+
+        converted_data['bpm'] = round(float(bpm_val), 2) if bpm_val is not None else 0.0
+        converted_data['key_strength'] = round(float(strength_val), 2) if strength_val is not None else 0.0
+
+        print(f"Essentia analysis complete for {file_path}")
+        return converted_data
+    except Exception as e:
+        print(f"Could not analyze audio with Essentia: {e}")
+        return {"error": str(e)}
+
+
+def analyze_audio(file_path: str) -> dict:
+    """Runs the configured BPM/key analyzer. This is what the analysis process pool executes."""
+    if ANALYSIS_BACKEND == "numpy" or (ANALYSIS_BACKEND == "auto" and not es):
+        return analyze_audio_streaming(file_path)
+    return analyze_audio_with_essentia(file_path)
+
+
+_analysis_pool: Optional[ProcessPoolExecutor] = None
+_analysis_pool_lock = threading.Lock()
+
+
+def get_analysis_pool() -> Optional[ProcessPoolExecutor]:
+    """Shared process pool for audio analysis, created on first use. None when analysis is disabled."""
+    global _analysis_pool
+    if ANALYSIS_WORKERS <= 0:
+        return None
+    with _analysis_pool_lock:
+        if _analysis_pool is None:
+            # spawn rather than fork: the parent holds torch and S3 client threads
+            _analysis_pool = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return _analysis_pool
+
+
+def shutdown_analysis_pool():
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is not None:
+            _analysis_pool.shutdown(wait=False, cancel_futures=True)
+            _analysis_pool = None
+
+
 class DemucsSeparator:
     """separates songs into stems with Demucs
     holds the chosen model name and an s3 client
@@ -30,141 +415,350 @@ class DemucsSeparator:
     prepares a simple manifest for the frontend to use
     designed for long running background style work
     """
-    def __init__(self, s3_client, model: str = "htdemucs_s"):
+    def __init__(self, s3_client, model: str = "htdemucs_s", engine: Optional[DemucsEngine] = None,
+                 streaming: bool = False, stem_mode: str = SEPARATION_STEM_MODE, concurrent_jobs: int = 1,
+                 ram_per_job_mb: Optional[float] = None):
         self.model = model
         self.s3_client = s3_client
         self.aws_region = "eu-west-2"
+        self.engine = engine
+        self.streaming = streaming
+        self.publisher = StemPublisher(s3_client)
+        self.encoder = StemEncoder()
+        self.packager = StemPackager()
+        # Six-stem mode keeps every source so any mix can be derived later without another Demucs run
+        self.keep_sources = stem_mode == "six"
+        # Other separations run alongside this one, so it plans with its share of the machine
+        self.concurrent_jobs = concurrent_jobs
+        self.ram_per_job_mb = ram_per_job_mb
+
+    def cache_signature(self) -> str:
+        """Describes the options that shape the stems, so cached results are only reused for identical output."""
+        packaging = f"hls:{self.packager.segment_seconds}" if self.packager.enabled else "off"
+        stems = "six-stems" if self.keep_sources else "two-stems=guitar"
+        return (f"{stems};renditions={ladder_signature(self.encoder.renditions)};"
+                f"primary={STEM_PRIMARY_RENDITION};packaging={packaging}")
 
     def _convert_numpy_types(self, obj):
         """Recursively converts numpy types in a dictionary to native Python types."""
-        if isinstance(obj, dict):
-            return {k: self._convert_numpy_types(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [self._convert_numpy_types(i) for i in obj]
-        elif isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return obj
-    
+        return convert_numpy_types(obj)
+
     def analyze_audio_with_essentia(self, file_path: str) -> dict:
-        if not es:
-            return {"error": "Essentia library not available."}
+        return analyze_audio_with_essentia(file_path)
+
+    def start_analysis(self, local_input_path: Path) -> Optional[Future]:
+        """Starts BPM/key analysis of the original upload in the analysis process pool."""
+        pool = get_analysis_pool()
+        if pool is None:
+            return None
         try:
-            loader = es.MonoLoader(filename=str(file_path), sampleRate=44100)
-            audio = loader()
-            sample_rate = 44100
+            return pool.submit(analyze_audio, str(local_input_path))
+        except Exception as e:
+            print(f"Could not start audio analysis: {e}")
+            return None
 
-            if audio is None or len(audio) == 0:
-                print(f"Warning: Essentia's MonoLoader failed or returned empty audio for {file_path}.")
-                return {"error": "Audio file could not be loaded. It may be corrupt or in an unsupported format."}
+    def collect_analysis(self, future: Optional[Future]) -> Optional[dict]:
+        """Waits for the analysis started with the separation. Returns None if it failed or overran."""
+        if future is None:
+            return None
+        try:
+            result = future.result(timeout=ANALYSIS_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            future.cancel()
+            print(f"Audio analysis did not finish within {ANALYSIS_TIMEOUT_SECONDS}s; publishing without it.")
+            return None
+        except Exception as e:
+            print(f"Audio analysis failed: {e}")
+            return None
+        if not result or "error" in result:
+            print(f"Audio analysis skipped: {(result or {}).get('error')}")
+            return None
+        return result
 
-            max_duration_seconds = 300
-            max_samples = int(max_duration_seconds * sample_rate)
-            if len(audio) > max_samples:
-                audio = audio[:max_samples]
+    def build_peaks(self, stem_files: Dict[str, Path]) -> Dict[str, Path]:
+        """Writes a waveform peak pyramid next to each stem. A stem whose peaks fail is skipped."""
+        peaks = {}
+        for stem_name, path in stem_files.items():
+            try:
+                target = path.with_suffix(".peaks")
+                target.write_bytes(encode_pyramid(compute_peak_pyramid(str(path))))
+                peaks[stem_name] = target
+            except Exception as e:
+                print(f"Could not compute waveform peaks for {stem_name}: {e}")
+        return peaks
 
-            if len(audio) < sample_rate * 2:
-                return {"error": "Audio file is too short for analysis."}
-            
-            rhythm_extractor = es.RhythmExtractor2013(method="multifeature")
-            bpm, _, _, _, _ = rhythm_extractor(audio)
-            
-            key_extractor = es.KeyExtractor()
-            key, scale, strength = key_extractor(audio)
+    def build_activity(self, stem_files: Dict[str, Path]) -> Dict[str, dict]:
+        """Guitar activity envelope for picking the excerpt sent to Gemini, as stored in the manifest."""
+        if "guitar" not in stem_files:
+            return {}
+        try:
+            return {"guitar": compute_activity(str(stem_files["guitar"])).to_manifest()}
+        except Exception as e:
+            print(f"Could not compute guitar activity: {e}")
+            return {}
 
-            analysis_data = {
-                "bpm": bpm,
-                "key": f"{key} {scale}",
-                "key_strength": strength,
-            }
-            
-            converted_data = self._convert_numpy_types(analysis_data)
-            
-            bpm_val = converted_data.get('bpm')
-            if isinstance(bpm_val, list) and bpm_val:
-                bpm_val = bpm_val[0]
+    def source_files(self, local_stems_dir: Path) -> Dict[str, Path]:
+        """Six-stem sources on disk, also deriving no_guitar from them when Demucs wrote sources only."""
+        sources = {name: local_stems_dir / f"{name}.wav" for name in SIX_STEM_SOURCES
+                   if (local_stems_dir / f"{name}.wav").exists()}
+        backing = local_stems_dir / "no_guitar.wav"
+        if sources and not backing.exists():
+            mix_stems([path for name, path in sources.items() if name != "guitar"], backing)
+        return sources
 
-            strength_val = converted_data.get('key_strength')
-            if isinstance(strength_val, list) and strength_val:
-                strength_val = strength_val[0]
+    def _fill_local_cache(self, uploads: list, manifest_key: str, manifest_body: str):
+        """Keeps what was just published on this machine so server-side readers skip the download."""
+        cache = get_stem_cache()
+        config = self.publisher.transfer_config
+        try:
+            for upload in uploads:
+                if ".hls." not in upload.name:
+                    cache.put_file(upload.key, upload.local_path, config.multipart_chunksize, config.multipart_threshold)
+            cache.put_bytes(manifest_key, manifest_body.encode("utf-8"))
+        except Exception as e:
+            print(f"Could not fill the local stem cache: {e}")
 
-            converted_data['bpm'] = round(float(bpm_val), 2) if bpm_val is not None else 0.0
-            converted_data['key_strength'] = round(float(strength_val), 2) if strength_val is not None else 0.0
+    def plan_separation(self, local_input_path: Path) -> SeparationPlan:
+        """Sizes the separation for this song and this job's share of the resources free right now."""
+        free_mb, cores = job_share(*available_resources(), self.concurrent_jobs, self.ram_per_job_mb)
+        plan = plan_separation(self.model, probe_audio(str(local_input_path)), free_mb, cores,
+                               file_size_bytes=local_input_path.stat().st_size)
+        if self.keep_sources and plan.output_format != "wav":
+            # Mixes are summed from PCM sources
+            plan = plan._replace(output_format="wav", reason=f"{plan.reason}; six-stem mode keeps WAV")
+        print(f"Separation plan for {local_input_path.name}: segment={plan.segment}s overlap={plan.overlap} "
+              f"shifts={plan.shifts} jobs={plan.jobs} threads={plan.threads} format={plan.output_format} "
+              f"(~{plan.estimated_mb:.0f} MB of the {free_mb:.0f} MB this job may use; {plan.reason})")
+        return plan
 
-            print(f"Essentia analysis complete for {file_path}")
-            return converted_data
-        except Exception as e:
-            print(f"Could not analyze audio with Essentia: {e}")
-            return {"error": str(e)}
+    def _run_demucs(self, local_input_path: Path, plan: SeparationPlan, cancel_token: Optional[CancelToken] = None) -> str:
+        """Runs the separation with the resident engine or a demucs subprocess and returns the stem extension."""
+        if self.engine is not None:
+            print(f"Running in-process Demucs engine ({self.engine.state}) for {local_input_path.name}")
+            self.engine.separate(local_input_path, OUTPUT_DIR, plan, two_stems="guitar", cancel_token=cancel_token,
+                                 keep_sources=self.keep_sources)
+            print("--- Demucs Engine Finished Successfully ---")
+            return plan.output_format
 
-    def get_audio_duration(self, file_path: str) -> float:
-        """Gets the duration of an audio file in seconds using ffprobe."""
+        command = ["python", "-m", "demucs.separate", "-n", self.model,
+                   *([] if self.keep_sources else ["--two-stems", "guitar"]), "--segment", str(plan.segment), "--overlap", str(plan.overlap),
+                   "--shifts", str(plan.shifts), "-j", str(plan.jobs)]
+        if plan.output_format == "mp3":
+            command.append("--mp3")
+        command.extend(["--out", str(OUTPUT_DIR), "--filename", "{track}/{stem}.{ext}", str(local_input_path)])
+        print(f"Running command: {' '.join(command)}")
+        thread_env = {name: str(plan.threads) for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+        # Popen rather than run so a cancelled job can kill demucs mid-separation
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   env={**os.environ, **thread_env})
+        if cancel_token is not None:
+            cancel_token.attach_process(process)
         try:
-            command = [
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", file_path
-            ]
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
-            return float(result.stdout.strip())
-        except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
-            print(f"Warning: Could not determine audio duration using ffprobe ({e}).")
-            print("Defaulting to safe segmentation for this file.")
-            return 999.0
-
-    def separate_audio_stems(self, bucket_name: str, object_key: str, task_id: str, username: str, original_filename: str):
-        local_input_path = INPUT_DIR / Path(object_key).name
+            stdout, stderr = process.communicate()
+        finally:
+            if cancel_token is not None:
+                cancel_token.detach_process()
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, output=stdout, stderr=stderr)
+        print("--- Demucs Process Finished Successfully ---")
+        return plan.output_format
+
+    def _run_demucs_progressive(self, local_input_path: Path, plan: SeparationPlan, bucket_name: str,
+                                username: str, task_id: str, cancel_token: Optional[CancelToken] = None,
+                                report: Optional[Callable[..., None]] = None) -> list:
+        """Separates window by window, publishing each finished block as playable WAV segments.
+
+        progressive.json is rewritten after every block so clients can start playing the ranges
+        that are already available. Returns the list of published segments.
+        """
+        project_prefix = f"stems/{username}/{task_id}"
+        base_url = f"https://{bucket_name}.s3.{self.aws_region}.amazonaws.com"
+        segments_dir = OUTPUT_DIR / self.model / local_input_path.stem / "segments"
+        segments = []
+
+        def publish_chunk(index: int, start: float, end: float, blocks: dict, samplerate: int):
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            uploads = []
+            for stem_name, audio in blocks.items():
+                local_path = segments_dir / stem_name / f"{index:04d}.wav"
+                local_path.parent.mkdir(parents=True, exist_ok=True)
+                writer = open_wav_writer(local_path, audio.shape[0], samplerate)
+                writer.writeframes(pcm16_bytes(audio))
+                writer.close()
+                key = f"{project_prefix}/segments/{stem_name}/{index:04d}.wav"
+                uploads.append(StemUpload(stem_name, local_path, key, "audio/wav"))
+            self.publisher.publish(bucket_name, uploads)
+            urls = {("backingTrack" if u.name == "no_guitar" else u.name): f"{base_url}/{u.key}" for u in uploads}
+            segments.append({"index": index, "start": round(start, 3), "end": round(end, 3), "stems": urls})
+            self._put_progressive_manifest(bucket_name, project_prefix, "separating", plan.duration, segments)
+            if report is not None:
+                report("separating", availableUntil=round(end, 3))
+            print(f"[{task_id}] Published segment {index} ({start:.1f}s - {end:.1f}s)")
+
+        print(f"Running progressive Demucs engine for {local_input_path.name}")
+        self.engine.separate_progressive(local_input_path, OUTPUT_DIR, publish_chunk,
+                                         window_seconds=PROGRESSIVE_WINDOW_SECONDS,
+                                         overlap_seconds=PROGRESSIVE_OVERLAP_SECONDS, plan=plan,
+                                         two_stems="guitar", cancel_token=cancel_token,
+                                         keep_sources=self.keep_sources)
+        print("--- Progressive Demucs Engine Finished Successfully ---")
+        return segments
+
+    def _put_progressive_manifest(self, bucket_name: str, project_prefix: str, status: str, duration: float, segments: list):
+        progressive = {
+            "status": status,
+            "duration": duration,
+            "availableUntil": segments[-1]["end"] if segments else 0.0,
+            "segments": segments,
+        }
+        self.s3_client.put_object(Bucket=bucket_name, Key=f"{project_prefix}/progressive.json",
+                                  Body=json.dumps(progressive), ContentType='application/json', ACL='public-read')
+
+    def separate_audio_stems(self, bucket_name: str, object_key: str, task_id: str, username: str, original_filename: str,
+                             cancel_token: Optional[CancelToken] = None,
+                             report: Optional[Callable[..., None]] = None,
+                             local_input_path: Optional[str] = None) -> Optional[dict]:
+        """Downloads the upload, separates it and publishes the stems and manifest. Returns the manifest on success.
+
+        report(state, **details) is called on every stage transition, including failures.
+        When local_input_path points at the upload already on this machine it is used directly
+        instead of downloading object_key, and the caller stays responsible for deleting it.
+        """
+        owns_input = not (local_input_path and os.path.exists(local_input_path))
+        local_input_path = INPUT_DIR / Path(object_key).name if owns_input else Path(local_input_path)
+        report = report or (lambda state, **details: None)
         print(f"--- Background task for user '{username}' [ID: {task_id}] started ---")
+        analysis_future = None
 
         try:
-            print(f"Downloading {object_key} from S3 to {local_input_path}...")
-            self.s3_client.download_file(bucket_name, object_key, str(local_input_path))
-            print("Download complete.")
-            duration = self.get_audio_duration(str(local_input_path))
-            SEGMENTATION_THRESHOLD = 420 
-            command = ["python", "-m", "demucs.separate", "-n", self.model, "--two-stems", "guitar"]
-            if duration > SEGMENTATION_THRESHOLD:
-                print(f"Song duration ({duration:.0f}s) exceeds threshold. Using segmentation and MP3 output.")
-                command.extend(["--segment", "7", "--mp3"])
+            if owns_input:
+                report("downloading")
+                print(f"Downloading {object_key} from S3 to {local_input_path}...")
+                self.s3_client.download_file(bucket_name, object_key, str(local_input_path))
+                print("Download complete.")
             else:
-                print(f"Song duration ({duration:.0f}s) is within threshold. Using standard WAV processing.")
-            command.extend(["--out", str(OUTPUT_DIR), "--filename", "{track}/{stem}.{ext}", str(local_input_path)])
-            print(f"Running command: {' '.join(command)}")
-            subprocess.run(command, capture_output=True, text=True, check=True)
-            print("--- Demucs Process Finished Successfully ---")
+                print(f"Separating local upload {local_input_path} without an S3 round trip.")
+            analysis_future = self.start_analysis(local_input_path)
+            plan = self.plan_separation(local_input_path)
+            duration = plan.duration
+            report("separating", duration=duration, plan=plan._asdict())
+            segments = None
+            if self.streaming and self.engine is not None:
+                segments = self._run_demucs_progressive(local_input_path, plan, bucket_name, username, task_id,
+                                                        cancel_token, report)
+                output_extension = "wav"
+            else:
+                output_extension = self._run_demucs(local_input_path, plan, cancel_token)
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
             track_name = local_input_path.stem
             local_stems_dir = OUTPUT_DIR / self.model / track_name
             base_url = f"https://{bucket_name}.s3.{self.aws_region}.amazonaws.com"
             stem_urls = {}
-            output_extension = "mp3" if duration > SEGMENTATION_THRESHOLD else "wav"
             content_type = f"audio/{output_extension}"
+            source_files = self.source_files(local_stems_dir) if self.keep_sources else {}
+            stem_files = {
+                stem_name: local_stems_dir / f"{stem_name}.{output_extension}"
+                for stem_name in ["guitar", "no_guitar"]
+                if (local_stems_dir / f"{stem_name}.{output_extension}").exists()
+            }
+
+            report("encoding")
+            encoded = self.encoder.encode(stem_files)
+            peak_files = self.build_peaks(stem_files)
+            activity = self.build_activity(stem_files)
+            packaged = self.packager.package(stem_files)
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+
+            report("uploading_stems")
             print(f"Uploading stems from {local_stems_dir} to S3 for user '{username}'...")
-            # Upload guitar and no_guitar stems
-            for stem_name in ["guitar", "no_guitar"]:
-                local_file_path = local_stems_dir / f"{stem_name}.{output_extension}"
-                if local_file_path.exists():
-                    stem_key = f"stems/{username}/{task_id}/{stem_name}.{output_extension}"
-                    self.s3_client.upload_file(str(local_file_path), bucket_name, stem_key, ExtraArgs={'ACL': 'public-read', 'ContentType': content_type})
-                    stem_urls[stem_name] = f"{base_url}/{stem_key}"
-
-            if "no_guitar" in stem_urls:
-                stem_urls["backingTrack"] = stem_urls.pop("no_guitar")
-
-            manifest_content = {"stems": stem_urls, "originalFileName": original_filename}
+            # Upload guitar and no_guitar stems and all their renditions together
+            uploads = []
+            renditions = {}
+            peaks = {}
+            streams = {}
+            content_types = {r.name: r.content_type for r in self.encoder.renditions}
+            for stem_name, local_file_path in stem_files.items():
+                files = {output_extension: (local_file_path, content_type), **{
+                    name: (path, content_types[name]) for name, path in encoded.get(stem_name, {}).items()
+                }}
+                manifest_name = "backingTrack" if stem_name == "no_guitar" else stem_name
+                renditions[manifest_name] = {}
+                for rendition_name, (path, rendition_type) in files.items():
+                    stem_key = f"stems/{username}/{task_id}/{path.name}"
+                    uploads.append(StemUpload(f"{stem_name}.{rendition_name}", path, stem_key, rendition_type))
+                    renditions[manifest_name][rendition_name] = f"{base_url}/{stem_key}"
+                primary = STEM_PRIMARY_RENDITION if STEM_PRIMARY_RENDITION in renditions[manifest_name] else output_extension
+                stem_urls[manifest_name] = renditions[manifest_name][primary]
+                if stem_name in peak_files:
+                    peaks_key = f"stems/{username}/{task_id}/{peak_files[stem_name].name}"
+                    uploads.append(StemUpload(f"{stem_name}.peaks", peak_files[stem_name], peaks_key, PEAKS_CONTENT_TYPE))
+                    peaks[manifest_name] = f"{base_url}/{peaks_key}"
+                if stem_name in packaged:
+                    stream_prefix = f"stems/{username}/{task_id}/hls/{stem_name}"
+                    for path in packaged[stem_name].files():
+                        uploads.append(StemUpload(f"{stem_name}.hls.{path.name}", path, f"{stream_prefix}/{path.name}",
+                                                  STREAM_CONTENT_TYPES.get(path.suffix, "application/octet-stream")))
+                    streams[manifest_name] = stream_index(packaged[stem_name], f"{base_url}/{stream_prefix}",
+                                                          self.packager.segment_seconds)
+            sources = {}
+            for source_name, path in source_files.items():
+                if source_name in stem_files:
+                    sources[source_name] = renditions[source_name]["wav"]
+                    continue
+                source_key = f"stems/{username}/{task_id}/sources/{path.name}"
+                uploads.append(StemUpload(f"{source_name}.source", path, source_key, "audio/wav"))
+                sources[source_name] = f"{base_url}/{source_key}"
+            upload_stats = self.publisher.publish(bucket_name, uploads)
+            segment_uploads = [name for name in upload_stats if ".hls." in name]
+            report("uploading_stems", streamSegments=len(segment_uploads), stemUploads={
+                name: stats for name, stats in upload_stats.items() if name not in segment_uploads
+            })
+
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            manifest_content = {"stems": stem_urls, "renditions": renditions, "originalFileName": original_filename}
+            if duration:
+                manifest_content["duration"] = round(duration, 2)
+            if peaks:
+                manifest_content["peaks"] = peaks
+            if streams:
+                manifest_content["streams"] = streams
+            if activity:
+                manifest_content["activity"] = activity
+            if sources:
+                manifest_content["sources"] = sources
+            analysis = self.collect_analysis(analysis_future)
+            if analysis:
+                manifest_content["analysis"] = analysis
+            if segments:
+                manifest_content["segments"] = segments
+                self._put_progressive_manifest(bucket_name, f"stems/{username}/{task_id}", "complete", duration, segments)
             manifest_key = f"stems/{username}/{task_id}/manifest.json"
+            manifest_body = json.dumps(manifest_content)
             self.s3_client.put_object(Bucket=bucket_name, Key=manifest_key, 
-            Body=json.dumps(manifest_content), ContentType='application/json', ACL='public-read')
+            Body=manifest_body, ContentType='application/json', ACL='public-read')
+            self._fill_local_cache(uploads, manifest_key, manifest_body)
             
             print(f"Created and uploaded manifest file to S3: {manifest_key}")
+            report("done", manifestUrl=f"{base_url}/{manifest_key}")
+            return manifest_content
         except subprocess.CalledProcessError as e:
             print(f"--- DEMUCS FAILED ---\nStderr: {e.stderr}\nStdout: {e.stdout}")
+            stderr_lines = (e.stderr or "").strip().splitlines()
+            report("failed", error=f"Demucs failed: {stderr_lines[-1] if stderr_lines else e.returncode}")
         except Exception as e:
             print(f"--- AN UNEXPECTED ERROR OCCURRED for task {task_id} ---\nError: {str(e)}")
+            report("failed", error=str(e))
         finally:
+            if analysis_future is not None:
+                analysis_future.cancel()
             print("Cleaning up local temporary files...")
-            if os.path.exists(local_input_path):
+            if owns_input and os.path.exists(local_input_path):
                 os.remove(local_input_path)
                 print(f"Removed temporary input file: {local_input_path}")
             local_output_dir_to_clean = OUTPUT_DIR / self.model / local_input_path.stem
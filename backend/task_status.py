@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+STAGES = ("queued", "uploading", "downloading", "separating", "encoding", "uploading_stems", "done")
+TERMINAL_STATES = ("done", "failed", "cancelled")
+
+
+class TaskStatus:
+    """lifecycle of one separation task as seen by clients
+    records when each stage started so every stage carries its elapsed time
+    """
+    def __init__(self, task_id: str, username: Optional[str]):
+        self.task_id = task_id
+        self.username = username
+        self.created_at = time.time()
+        self.history: List[Dict[str, Any]] = []
+        self.details: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.version = 0
+
+    @property
+    def state(self) -> str:
+        return self.history[-1]["state"] if self.history else "queued"
+
+    @property
+    def finished(self) -> bool:
+        return self.state in TERMINAL_STATES
+
+
+class TaskStatusRegistry:
+    """in memory registry of task states with versioned snapshots
+    pipeline stages report transitions through a per task reporter
+    readers take snapshots and compare versions to push only real changes
+    keeps running averages of stage durations to estimate time remaining
+    """
+    def __init__(self, max_finished: int = 1000):
+        self.max_finished = max_finished
+        self._tasks: "OrderedDict[str, TaskStatus]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Separation time scales with song length, so it is tracked per second of audio
+        self._avg_stage_seconds: Dict[str, float] = {}
+        self._avg_separating_ratio: Optional[float] = None
+
+    def create(self, task_id: str, username: Optional[str] = None, state: str = "queued", **details) -> TaskStatus:
+        with self._lock:
+            status = TaskStatus(task_id, username)
+            self._tasks[task_id] = status
+            self._transition(status, state, details)
+            return status
+
+    def reporter(self, task_id: str) -> Callable[..., None]:
+        """Returns report(state, **details) bound to one task, for the pipeline to call."""
+        def report(state: str, **details):
+            self.update(task_id, state, **details)
+        return report
+
+    def update(self, task_id: str, state: str, **details):
+        with self._lock:
+            status = self._tasks.get(task_id)
+            if status is None:
+                status = TaskStatus(task_id, None)
+                self._tasks[task_id] = status
+            if status.finished:
+                return
+            self._transition(status, state, details)
+
+    def _transition(self, status: TaskStatus, state: str, details: Dict[str, Any]):
+        now = time.time()
+        error = details.pop("error", None)
+        status.details.update(details)
+        if state == "failed":
+            status.error = error or "Separation failed."
+        if not status.history or status.history[-1]["state"] != state:
+            if status.history:
+                previous = status.history[-1]
+                previous["finishedAt"] = now
+                self._record_duration(status, previous["state"], now - previous["startedAt"])
+            status.history.append({"state": state, "startedAt": now})
+            print(f"[{status.task_id}] Status: {state}")
+        status.version += 1
+        if status.finished:
+            self._tasks.move_to_end(status.task_id)
+            self._trim()
+
+    def _record_duration(self, status: TaskStatus, state: str, seconds: float):
+        if state == "separating" and status.details.get("duration"):
+            ratio = seconds / status.details["duration"]
+            prev = self._avg_separating_ratio
+            self._avg_separating_ratio = ratio if prev is None else 0.8 * prev + 0.2 * ratio
+        if state in STAGES:
+            prev = self._avg_stage_seconds.get(state)
+            self._avg_stage_seconds[state] = seconds if prev is None else 0.8 * prev + 0.2 * seconds
+
+    def _expected_seconds(self, status: TaskStatus, state: str) -> Optional[float]:
+        if state == "separating" and self._avg_separating_ratio is not None and status.details.get("duration"):
+            return self._avg_separating_ratio * status.details["duration"]
+        return self._avg_stage_seconds.get(state)
+
+    def _trim(self):
+        finished = [task_id for task_id, status in self._tasks.items() if status.finished]
+        for task_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._tasks[task_id]
+
+    def _snapshot_locked(self, status: TaskStatus) -> Dict[str, Any]:
+        now = time.time()
+        stages = [
+            {"state": entry["state"], "elapsed": round(entry.get("finishedAt", now) - entry["startedAt"], 2)}
+            for entry in status.history
+        ]
+        eta = None
+        if not status.finished:
+            current = status.state
+            expected = self._expected_seconds(status, current)
+            remaining = max(0.0, expected - stages[-1]["elapsed"]) if expected is not None else None
+            later = STAGES[STAGES.index(current) + 1:-1] if current in STAGES else ()
+            for stage in later:
+                # Stages no task has been through are not on the pipeline's path, such as the
+                # upload and download the local handoff skips, so they add nothing
+                stage_expected = self._expected_seconds(status, stage)
+                if remaining is not None and stage_expected is not None:
+                    remaining += stage_expected
+            eta = round(remaining, 1) if remaining is not None else None
+        finished_at = status.history[-1]["startedAt"] if status.finished else now
+        return {
+            "taskId": status.task_id,
+            "state": status.state,
+            "stages": stages,
+            "elapsed": round(finished_at - status.created_at, 2),
+            "eta": eta,
+            "error": status.error,
+            "details": dict(status.details),
+            "version": status.version,
+        }
+
+    def snapshot(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            status = self._tasks.get(task_id)
+            return self._snapshot_locked(status) if status else None
+
+
+def sse_event(snapshot: Dict[str, Any], event: str = "status") -> str:
+    return f"event: {event}\ndata: {json.dumps(snapshot)}\n\n"
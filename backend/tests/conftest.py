@@ -1,4 +1,5 @@
 import io
+import hashlib
 import json
 import os
 import types
@@ -17,6 +18,9 @@ class FakeS3Client:
 
     def __init__(self):
         self.storage = {} 
+        self.downloads = []
+        self.ranges = []
+        self.page_size = 1000
 
     # Simple helpers
     def _ensure_bytes(self, body):
@@ -38,13 +42,27 @@ class FakeS3Client:
         self.storage[Key] = self._ensure_bytes(Body)
         return {"ResponseMetadata": {"HTTPStatusCode": 200}}
 
-    def get_object(self, Bucket, Key):
+    def get_object(self, Bucket, Key, Range=None):
         if Key not in self.storage:
             raise self.exceptions.NoSuchKey()
-        return {"Body": io.BytesIO(self.storage[Key])}
-
-    def list_objects_v2(self, Bucket, Prefix="", Delimiter=None):
-        keys = [k for k in self.storage.keys() if k.startswith(Prefix)]
+        data = self.storage[Key]
+        if Range:
+            self.ranges.append((Key, Range))
+            first, last = Range[len("bytes="):].split("-")
+            data = data[int(first):int(last) + 1 if last else None]
+        return {"Body": io.BytesIO(data)}
+
+    def list_objects_v2(self, Bucket, Prefix="", Delimiter=None, ContinuationToken=None):
+        keys = sorted(k for k in self.storage.keys() if k.startswith(Prefix))
+        if not Delimiter:
+            # Pages like S3, with the token being the offset of the next page
+            offset = int(ContinuationToken or 0)
+            page = keys[offset:offset + self.page_size]
+            response = {"KeyCount": len(page), "Contents": [{"Key": k} for k in page],
+                        "IsTruncated": offset + self.page_size < len(keys)}
+            if response["IsTruncated"]:
+                response["NextContinuationToken"] = str(offset + self.page_size)
+            return response
         response = {"KeyCount": len(keys)}
         if Delimiter:
             children = set()
@@ -54,11 +72,11 @@ class FakeS3Client:
                     child = remainder.split("/", 1)[0]
                     children.add(child)
             response["CommonPrefixes"] = [{"Prefix": f"{Prefix}{c}/"} for c in sorted(children)]
-        else:
-            response["Contents"] = [{"Key": k} for k in keys]
         return response
 
     def delete_objects(self, Bucket, Delete):
+        if len(Delete.get("Objects", [])) > 1000:
+            raise self.exceptions.ClientError("MalformedXML")
         errs = []
         for obj in Delete.get("Objects", []):
             k = obj.get("Key")
@@ -71,13 +89,25 @@ class FakeS3Client:
             resp["Errors"] = errs
         return resp
 
-    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
         with open(Filename, "rb") as f:
             self.storage[Key] = f.read()
 
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        if CopySource["Key"] not in self.storage:
+            raise self.exceptions.NoSuchKey()
+        self.storage[Key] = self.storage[CopySource["Key"]]
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.storage:
+            raise self.exceptions.ClientError(404)
+        return {"ETag": f'"{hashlib.md5(self.storage[Key]).hexdigest()}"', "ContentLength": len(self.storage[Key])}
+
     def download_file(self, Bucket, Key, Filename):
         if Key not in self.storage:
             raise self.exceptions.NoSuchKey()
+        self.downloads.append(Key)
         os.makedirs(os.path.dirname(Filename), exist_ok=True)
         with open(Filename, "wb") as f:
             f.write(self.storage[Key])
@@ -89,10 +119,17 @@ def fake_s3():
 
 
 @pytest.fixture(autouse=True)
-def patch_s3_and_bucket(monkeypatch, fake_s3):
+def patch_s3_and_bucket(monkeypatch, fake_s3, tmp_path):
     import backend.main as main
     monkeypatch.setattr(main, "s3_client", fake_s3)
     monkeypatch.setattr(main, "BUCKET_NAME", "test-bucket")
+    monkeypatch.setattr(main, "TEMP_UPLOAD_DIR", tmp_path)
+    monkeypatch.setattr(main, "separation_cache", main.SeparationCache())
+    monkeypatch.setattr(main, "loop_renderer", main.LoopRenderer(cache_dir=tmp_path / "loops", workers=0))
+    monkeypatch.setattr(main, "excerpt_extractor", main.ExcerptExtractor(cache_dir=tmp_path / "excerpts"))
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(tmp_path / "gemini_cache"))
+    import backend.local_stem_cache as local_stem_cache
+    monkeypatch.setattr(local_stem_cache, "_stem_cache", local_stem_cache.LocalStemCache(tmp_path / "stem_cache"))
     yield
 
 
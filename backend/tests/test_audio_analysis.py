@@ -0,0 +1,78 @@
+import wave
+
+import numpy as np
+
+
+def _write_song(path, bpm, seconds, tonic, sample_rate=22050):
+    """Clicks on every beat over a chord voiced with major-key profile weights."""
+    from backend.audio_analysis import MAJOR_PROFILE
+
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    audio = np.zeros_like(t)
+    for pitch_class, amplitude in enumerate(np.roll(MAJOR_PROFILE, tonic)):
+        audio += amplitude / 6.35 * np.sin(2 * np.pi * 261.63 * 2 ** (pitch_class / 12) * t)
+    audio *= 0.05
+    noise = np.random.default_rng(0).normal(0, 0.5, 400) * np.exp(-np.arange(400) / 80)
+    for beat in (np.arange(0, seconds, 60 / bpm) * sample_rate).astype(int):
+        n = min(400, len(audio) - beat)
+        audio[beat:beat + n] += noise[:n]
+    stereo = np.repeat(np.clip(audio, -1, 1)[:, None], 2, axis=1)
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((stereo * 32767).astype("<i2").tobytes())
+
+
+def test_streaming_analyzer_finds_tempo_and_key(tmp_path):
+    from backend.audio_analysis import analyze_audio_streaming
+
+    song = tmp_path / "song.wav"
+    _write_song(song, bpm=128, seconds=30, tonic=9)
+    result = analyze_audio_streaming(str(song))
+
+    assert abs(result["bpm"] - 128) < 2
+    assert result["key"] == "A major"
+    assert result["key_strength"] > 0.8
+    assert result["duration"] == 30.0
+    assert result["analyzer"] == "numpy"
+
+
+def test_streaming_analyzer_state_is_independent_of_block_size(tmp_path):
+    from backend.audio_analysis import StreamingAnalyzer, open_audio_stream
+
+    song = tmp_path / "song.wav"
+    _write_song(song, bpm=100, seconds=20, tonic=2)
+    results = []
+    for block_seconds in (0.05, 1.0, 7.0):
+        sample_rate, blocks = open_audio_stream(str(song), block_seconds=block_seconds)
+        analyzer = StreamingAnalyzer(sample_rate)
+        for block in blocks:
+            analyzer.feed(block)
+            # Only fixed-size history is kept between blocks
+            assert len(analyzer._onset_history) <= analyzer.max_lag
+            assert len(analyzer._leftover) < analyzer.n_fft
+        results.append(analyzer.result())
+    assert all(r["key"] == "D major" for r in results)
+    assert max(r["bpm"] for r in results) - min(r["bpm"] for r in results) < 0.5
+
+
+def test_analyze_audio_falls_back_to_numpy_without_essentia(monkeypatch):
+    import backend.stem_separation as ss
+
+    monkeypatch.setattr(ss, "es", None)
+    monkeypatch.setattr(ss, "ANALYSIS_BACKEND", "auto")
+    monkeypatch.setattr(ss, "analyze_audio_streaming", lambda path: {"bpm": 90.0, "analyzer": "numpy"})
+    assert ss.analyze_audio("song.mp3")["analyzer"] == "numpy"
+
+
+def test_benchmark_agreement_rules():
+    from backend.benchmark_analysis import bpm_agrees, key_agreement
+
+    assert bpm_agrees(120.5, 120.0)
+    assert bpm_agrees(60.0, 120.0)
+    assert not bpm_agrees(100.0, 120.0)
+    assert key_agreement("A minor", "A minor") == "exact"
+    assert key_agreement("C major", "A minor") == "relative"
+    assert key_agreement("Eb major", "C minor") == "relative"
+    assert key_agreement("C major", "E minor") == "none"
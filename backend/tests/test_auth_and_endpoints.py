@@ -1,6 +1,8 @@
 import json
 from pathlib import Path
 
+import pytest
+
 
 def test_root(client):
     r = client.get("/")
@@ -109,6 +111,17 @@ def test_delete_project(client, fake_s3):
     assert not any(k.startswith(prefix) for k in fake_s3.storage)
 
 
+def test_delete_project_removes_more_objects_than_one_page(client, fake_s3):
+    prefix = "stems/sara/long/"
+    fake_s3.page_size = 100
+    for i in range(2345):
+        fake_s3.put_object(Bucket="test-bucket", Key=f"{prefix}hls/guitar/{i:05d}.ts", Body=b"x")
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/sara/other/manifest.json", Body=b"{}")
+
+    assert client.delete("/project/sara/long").status_code == 200
+    assert list(fake_s3.storage) == ["stems/sara/other/manifest.json"]
+
+
 def test_save_chord_analysis(client, fake_s3):
     username = "mike"
     task_id = "t42"
@@ -126,14 +139,14 @@ def test_save_chord_analysis(client, fake_s3):
     assert "userAnalysisUrl" in manifest
 
 
-def test_separate_audio_schedules_background(client, monkeypatch, fake_s3, tmp_path):
-    # Patch the background function to record it was called
+def test_separate_audio_schedules_job(client, monkeypatch, fake_s3, tmp_path):
+    # Patch the scheduled function to record it was called
     called = {"value": False}
 
     import backend.main as main
 
-    def fake_upload_and_separate(temp_file_path, object_key, task_id, username, original_filename, separator):
-        # Background job executed after response
+    def fake_upload_and_separate(temp_file_path, object_key, task_id, username, original_filename, separator, cancel_token=None, cache_key=None):
+        # Scheduled job executed on a worker thread
         called["value"] = True
         # Also store that an upload would have happened
         fake_s3.put_object(Bucket="test-bucket", Key=object_key, Body=b"data")
@@ -148,7 +161,91 @@ def test_separate_audio_schedules_background(client, monkeypatch, fake_s3, tmp_p
     js = r.json()
     assert js["filename"] == "song.mp3"
     assert "taskId" in js
+    assert js["queuePosition"] >= 1
 
-    # Background should have run, marking called True
+    # Worker should have run the job, marking called True
+    assert main.separation_scheduler.wait(js["taskId"], timeout=5)
     assert called["value"]
 
+
+def test_health_reports_engine_state(client, monkeypatch):
+    import backend.main as main
+
+    r = client.get("/health")
+    assert r.status_code == 200
+    assert r.json()["engine"]["mode"] == "subprocess"
+
+    monkeypatch.setattr(main, "SEPARATION_ENGINE", "inprocess")
+    r2 = client.get("/health")
+    assert r2.status_code == 503
+    assert r2.json()["engine"]["state"] == "cold"
+
+
+def test_upload_and_separate_archives_concurrently(monkeypatch, fake_s3, tmp_path):
+    import time
+    import backend.main as main
+
+    seen = {}
+
+    class FakeSeparator:
+        def separate_audio_stems(self, bucket, object_key, task_id, username, original_filename,
+                                 cancel_token=None, report=None, local_input_path=None):
+            seen["local_input_path"] = local_input_path
+            seen["readable"] = Path(local_input_path).read_bytes()
+            return None
+
+    monkeypatch.setattr(main, "SEPARATION_LOCAL_HANDOFF", True)
+    monkeypatch.setattr(main, "UPLOAD_ARCHIVE_MODE", "concurrent")
+    temp = tmp_path / "local.mp3"
+    temp.write_bytes(b"ORIGINAL")
+
+    main.upload_and_separate(str(temp), "uploads/local.mp3", "local", "amy", "local.mp3", FakeSeparator())
+
+    assert seen == {"local_input_path": str(temp), "readable": b"ORIGINAL"}
+    deadline = time.time() + 5
+    while temp.exists() and time.time() < deadline:
+        time.sleep(0.01)
+    assert fake_s3.storage["uploads/local.mp3"] == b"ORIGINAL"
+    assert not temp.exists()
+
+
+def test_coalesced_separation_survives_the_owner_being_cancelled(monkeypatch, fake_s3, tmp_path):
+    import backend.main as main
+    from backend.job_scheduler import CancelToken, JobCancelled
+
+    separated = []
+
+    class FakeSeparator:
+        def separate_audio_stems(self, bucket, object_key, task_id, username, original_filename,
+                                 cancel_token=None, report=None, local_input_path=None):
+            separated.append(task_id)
+            return None
+
+    class OwnerCancelled:
+        """stands in for a flight whose owner is cancelled while this job waits on it"""
+        def __init__(self, while_waiting=lambda: None):
+            self.while_waiting = while_waiting
+
+        def do(self, name, key, fn, on_wait=None):
+            on_wait()
+            self.while_waiting()
+            raise JobCancelled()
+
+    def run(task_id, token):
+        temp = tmp_path / f"{task_id}.mp3"
+        temp.write_bytes(b"SAME AUDIO")
+        main.task_statuses.create(task_id, "amy")
+        main.upload_and_separate(str(temp), f"uploads/{task_id}.mp3", task_id, "amy", "s.mp3",
+                                 FakeSeparator(), cancel_token=token, cache_key="same")
+
+    monkeypatch.setattr(main, "UPLOAD_ARCHIVE_MODE", "off")
+    monkeypatch.setattr(main, "separation_flights", OwnerCancelled())
+    run("b", CancelToken())
+    assert separated == ["b"]
+
+    # A waiter cancelled by its own user still stops
+    own = CancelToken()
+    monkeypatch.setattr(main, "separation_flights", OwnerCancelled(while_waiting=own.cancel))
+    with pytest.raises(JobCancelled):
+        run("c", own)
+    assert separated == ["b"]
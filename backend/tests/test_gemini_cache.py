@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+
+def _counting_generate(calls, text="An answer"):
+    async def generate(system_prompt, user_prompt, model_name):
+        calls.append((system_prompt, user_prompt, model_name))
+        return {"text": f"{text} {len(calls)}"}
+    return generate
+
+
+def test_repeated_prompts_are_served_from_disk_and_bypass_refreshes(client, monkeypatch):
+    import backend.main as main
+
+    calls = []
+    monkeypatch.setattr(main, "generate_text_from_prompt", _counting_generate(calls))
+    body = {"songTitle": "Wonderwall", "artist": "Oasis"}
+
+    first = client.post("/gemini/generate-tabs", json=body).json()
+    # Case and spacing differences in the song details still share the entry
+    again = client.post("/gemini/generate-tabs", json={"songTitle": "WONDERWALL", "artist": "oasis"}).json()
+    assert first == again and len(calls) == 1
+
+    fresh = client.post("/gemini/generate-tabs", json=body, headers={"Cache-Control": "no-cache"}).json()
+    assert fresh != first and len(calls) == 2
+    assert client.post("/gemini/generate-tabs", json=body).json() == fresh
+
+    client.post("/gemini/initial-analysis", json=body)
+    assert len(calls) == 3
+    stats = client.get("/gemini/cache/stats").json()
+    assert (stats["hits"], stats["misses"], stats["bypasses"]) == (2, 2, 1)
+    assert stats["entries"] == 2
+
+
+def test_failed_responses_are_not_cached(client, monkeypatch):
+    import backend.main as main
+
+    calls = []
+
+    async def failing(system_prompt, user_prompt, model_name):
+        calls.append(user_prompt)
+        return {"error": "quota", "text": "Sorry, an error occurred while contacting the AI."}
+
+    monkeypatch.setattr(main, "generate_text_from_prompt", failing)
+    for _ in range(2):
+        r = client.post("/gemini/identify-from-filename", json={"rawFileName": "01_oasis-wonderwall.mp3"})
+        assert r.json()["artist"] == "Unknown Artist"
+    assert len(calls) == 2
+
+
+def test_entries_expire_persist_and_evict_by_size(tmp_path):
+    from backend.gemini_cache import ResponseCache, response_cache_key
+
+    cache = ResponseCache(tmp_path / "cache", ttl_seconds=60)
+    keys = [response_cache_key("sys", f"song {i}", "model") for i in range(4)]
+    for key in keys[:2]:
+        cache.put(key, {"text": "x" * 100})
+    assert cache.get(keys[0]) == {"text": "x" * 100}
+    entry_bytes = cache.stats()["bytes"] // 2
+
+    # A new process sees the same entries; room for three of them
+    reopened = ResponseCache(tmp_path / "cache", ttl_seconds=60, max_bytes=int(entry_bytes * 3.5))
+    assert reopened.get(keys[1]) is not None
+
+    for key in keys[2:]:
+        reopened.put(key, {"text": "x" * 100})
+    assert reopened.stats()["evictions"] == 1 and reopened.get(keys[0]) is None
+
+    path = tmp_path / "cache" / f"{keys[3]}.json"
+    entry = json.loads(path.read_text())
+    entry["storedAt"] = time.time() - 120
+    path.write_text(json.dumps(entry))
+    assert reopened.get(keys[3]) is None and not path.exists()
+    assert reopened.stats()["expired"] == 1
+
+
+def _sse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_streamed_tabs_forward_deltas_and_fill_the_shared_cache(client, monkeypatch):
+    import backend.main as main
+
+    streamed = []
+
+    async def fake_stream(system_prompt, user_prompt, model_name):
+        streamed.append(user_prompt)
+        for piece in ("e|--0--", "3--|"):
+            yield {"delta": piece}
+        yield {"done": True, "text": "e|--0--3--|"}
+
+    monkeypatch.setattr(main, "stream_text_from_prompt", fake_stream)
+    body = {"songTitle": "Smoke on the Water", "artist": "Deep Purple"}
+
+    r = client.post("/gemini/generate-tabs/stream", json=body)
+    assert r.headers["content-type"].startswith("text/event-stream")
+    assert _sse_events(r.text) == [("delta", {"delta": "e|--0--"}), ("delta", {"delta": "3--|"}),
+                                   ("done", {"done": True, "text": "e|--0--3--|"})]
+
+    # The non-streaming endpoint and a repeat stream are both served from the cache
+    assert client.post("/gemini/generate-tabs", json=body).json() == {"text": "e|--0--3--|"}
+    again = _sse_events(client.post("/gemini/generate-tabs/stream", json=body).text)
+    assert again[-1] == ("done", {"done": True, "text": "e|--0--3--|"}) and len(streamed) == 1
+
+    advice = client.post("/gemini/playing-advice/stream", json={**body, "section": "How do I mute?"})
+    assert [kind for kind, _ in _sse_events(advice.text)] == ["delta", "delta", "done"]
+    assert len(streamed) == 2
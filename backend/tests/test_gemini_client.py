@@ -1,17 +1,20 @@
+import asyncio
+
+
 def test_generate_text_from_prompt_handles_exception(monkeypatch):
     import backend.gemini_client as gc
 
     class FakeModel:
         def __init__(self, name):
             pass
-        def generate_content(self, prompt):
+        async def generate_content_async(self, prompt, **kwargs):
             raise RuntimeError("boom")
 
     # Patch the GenerativeModel constructor
     fake_genai = type("G", (), {"GenerativeModel": FakeModel})
     monkeypatch.setattr(gc, "genai", fake_genai)
 
-    out = gc.generate_text_from_prompt("sys", "user", "model-x")
+    out = asyncio.run(gc.generate_text_from_prompt("sys", "user", "model-x"))
     assert "error" in out
     assert "text" in out
 
@@ -39,7 +42,7 @@ def test_analyze_guitar_file_parses_json(monkeypatch, tmp_path):
     class FakeModel:
         def __init__(self, name):
             pass
-        def generate_content(self, parts, generation_config=None, safety_settings=None):
+        async def generate_content_async(self, parts, generation_config=None, safety_settings=None):
             # Return a valid JSON payload as text
             return FakeResp('{"tuning":"E Standard","key":"C"}')
 
@@ -53,7 +56,150 @@ def test_analyze_guitar_file_parses_json(monkeypatch, tmp_path):
     p = tmp_path / "a.wav"
     p.write_bytes(b"data")
 
-    out = gc.analyze_guitar_file(str(p), model_name="any")
+    out = asyncio.run(gc.analyze_guitar_file(str(p), model_name="any"))
     assert out.get("tuning") == "E Standard"
     assert out.get("key") == "C"
 
+
+
+def test_upload_cache_reuses_handles_by_content_and_refreshes_expired(monkeypatch, tmp_path):
+    import datetime
+    import threading
+    import backend.gemini_client as gc
+
+    uploads = []
+    release = threading.Event()
+
+    class FakeFile:
+        def __init__(self, path, expires_in):
+            self.path = path
+            self.expiration_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in)
+
+    def upload_file(path):
+        release.wait(5)
+        uploads.append(path)
+        return FakeFile(path, 3600)
+
+    monkeypatch.setattr(gc, "genai", type("G", (), {"upload_file": staticmethod(upload_file)}))
+    cache = gc.UploadCache()
+    first = tmp_path / "excerpt-a.flac"
+    first.write_bytes(b"same audio")
+    copy = tmp_path / "excerpt-b.flac"
+    copy.write_bytes(b"same audio")
+
+    # Two requests for the same audio at once upload it once
+    handles = []
+    threads = [threading.Thread(target=lambda p=p: handles.append(cache.get(str(p)))) for p in (first, copy)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(uploads) == 1 and handles[0] is handles[1]
+    assert cache.get(str(copy)) is handles[0]
+
+    # A handle inside the expiry margin is replaced
+    cache.margin_seconds = 7200
+    assert cache.get(str(first)) is not handles[0]
+    stats = cache.stats()
+    assert (stats["uploads"], stats["hits"], stats["refreshes"]) == (2, 2, 1)
+
+    cache.invalidate(cache.get(str(first)))
+    assert cache.stats()["entries"] == 0
+
+
+def test_calls_are_bounded_per_model_and_time_out(monkeypatch):
+    import backend.gemini_client as gc
+
+    in_flight = {"now": 0, "max": 0}
+
+    class SlowModel:
+        def __init__(self, name):
+            self.name = name
+
+        async def generate_content_async(self, prompt, **kwargs):
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            try:
+                await asyncio.sleep(0.5 if "slow" in prompt else 0.02)
+            finally:
+                in_flight["now"] -= 1
+            return type("R", (), {"text": "ok"})()
+
+    monkeypatch.setattr(gc, "genai", type("G", (), {"GenerativeModel": SlowModel}))
+    monkeypatch.setattr(gc, "GEMINI_MAX_CONCURRENCY", 2)
+
+    async def run():
+        results = await asyncio.gather(*(gc.generate_text_from_prompt("sys", f"q{i}", "model-a") for i in range(6)))
+        timed_out = await gc.generate_text_from_prompt("sys", "slow", "model-b", timeout=0.05)
+        return results, timed_out
+
+    results, timed_out = asyncio.run(run())
+    assert all(r == {"text": "ok"} for r in results)
+    assert in_flight["max"] == 2
+    assert timed_out["error_code"] == "TIMEOUT"
+
+
+def test_deadline_covers_waiting_for_a_model_slot(monkeypatch):
+    import time
+    import backend.gemini_client as gc
+
+    class SlowModel:
+        def __init__(self, name):
+            pass
+
+        async def generate_content_async(self, prompt, **kwargs):
+            await asyncio.sleep(0.3)
+            return type("R", (), {"text": "ok"})()
+
+    monkeypatch.setattr(gc, "genai", type("G", (), {"GenerativeModel": SlowModel}))
+    monkeypatch.setattr(gc, "GEMINI_MAX_CONCURRENCY", 1)
+
+    async def run():
+        holder = asyncio.ensure_future(gc.generate_text_from_prompt("sys", "first", "model-q"))
+        await asyncio.sleep(0.01)
+        started = time.monotonic()
+        queued = await gc.generate_text_from_prompt("sys", "second", "model-q", timeout=0.1)
+        return queued, time.monotonic() - started, await holder
+
+    queued, waited, first = asyncio.run(run())
+    assert queued["error_code"] == "TIMEOUT" and waited < 0.25
+    assert first == {"text": "ok"}
+
+
+class _StreamedResponse:
+    def __init__(self, pieces, fail_after=None):
+        self.pieces = pieces
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        for i, piece in enumerate(self.pieces):
+            if i == self.fail_after:
+                raise RuntimeError("400 input is too long")
+            yield type("Chunk", (), {"text": piece})()
+
+
+def test_stream_text_retries_token_errors_with_reset(monkeypatch):
+    import backend.gemini_client as gc
+
+    prompts = []
+
+    class FakeModel:
+        def __init__(self, name):
+            pass
+
+        async def generate_content_async(self, prompt, stream=False, **kwargs):
+            prompts.append((prompt, kwargs["generation_config"]))
+            if len(prompts) == 1:
+                return _StreamedResponse(["Partial ", "answer"], fail_after=1)
+            return _StreamedResponse(["Short ", "answer"])
+
+    monkeypatch.setattr(gc, "genai", type("G", (), {"GenerativeModel": FakeModel}))
+
+    async def collect():
+        return [event async for event in gc.stream_text_from_prompt("sys", "question", "model-x")]
+
+    events = asyncio.run(collect())
+    assert events == [{"delta": "Partial "}, {"reset": True}, {"delta": "Short "}, {"delta": "answer"},
+                      {"done": True, "text": "Short answer"}]
+    assert prompts[1][0].startswith(gc.FALLBACK_SYSTEM_PROMPT)
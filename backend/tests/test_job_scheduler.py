@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+
+def _blocking_job(started, release):
+    def job(cancel_token=None):
+        started.set()
+        while not release.wait(0.01):
+            cancel_token.raise_if_cancelled()
+    return job
+
+
+def test_priority_then_fifo_order_and_positions():
+    from backend.job_scheduler import SeparationScheduler
+
+    sched = SeparationScheduler(max_concurrent=1)
+    started, release = threading.Event(), threading.Event()
+    order = []
+
+    sched.submit("blocker", _blocking_job(started, release))
+    assert started.wait(2)
+
+    for task_id, priority in [("a", 5), ("b", 5), ("urgent", 0)]:
+        sched.submit(task_id, lambda task_id=task_id, cancel_token=None: order.append(task_id), priority=priority)
+
+    assert sched.position("urgent") == 1
+    assert sched.position("a") == 2
+    assert sched.position("b") == 3
+    assert sched.position("blocker") is None
+
+    release.set()
+    for task_id in ("a", "b", "urgent"):
+        assert sched.wait(task_id, timeout=2)
+    assert order == ["urgent", "a", "b"]
+    assert sched.snapshot("a")["state"] == "done"
+    sched.shutdown()
+
+
+def test_cancel_queued_and_running_jobs():
+    from backend.job_scheduler import SeparationScheduler
+
+    sched = SeparationScheduler(max_concurrent=1)
+    started, release = threading.Event(), threading.Event()
+    discarded = []
+
+    sched.submit("running", _blocking_job(started, release), owner="alice")
+    assert started.wait(2)
+    sched.submit("waiting", lambda cancel_token=None: None, on_discard=lambda: discarded.append("waiting"))
+
+    assert sched.cancel("waiting")
+    assert discarded == ["waiting"]
+    assert sched.snapshot("waiting")["state"] == "cancelled"
+
+    # Another user cannot cancel alice's job
+    assert not sched.cancel("running", owner="bob")
+    assert sched.cancel("running", owner="alice")
+    assert sched.wait("running", timeout=2)
+    assert sched.snapshot("running")["state"] == "cancelled"
+    sched.shutdown()
+
+
+def test_queue_limit_and_failure_state():
+    from backend.job_scheduler import QueueFull, SeparationScheduler
+
+    sched = SeparationScheduler(max_concurrent=1, max_queued=1)
+    started, release = threading.Event(), threading.Event()
+    sched.submit("running", _blocking_job(started, release))
+    assert started.wait(2)
+
+    def boom(cancel_token=None):
+        raise RuntimeError("demucs exploded")
+
+    sched.submit("fails", boom)
+    with pytest.raises(QueueFull):
+        sched.submit("overflow", boom)
+
+    release.set()
+    assert sched.wait("fails", timeout=2)
+    assert sched.snapshot("fails")["state"] == "failed"
+    assert "exploded" in sched.snapshot("fails")["error"]
+    sched.shutdown()
@@ -0,0 +1,121 @@
+import json
+from contextlib import ExitStack
+
+import pytest
+
+
+def test_filled_entries_are_served_without_downloading(fake_s3, tmp_path):
+    from backend.local_stem_cache import LocalStemCache
+
+    cache = LocalStemCache(tmp_path / "cache")
+    source = tmp_path / "guitar.wav"
+    source.write_bytes(b"RIFF" + b"\x01" * 4096)
+    fake_s3.upload_file(str(source), "test-bucket", "stems/amy/t1/guitar.wav")
+    cache.put_file("stems/amy/t1/guitar.wav", source)
+    source.unlink()  # the separation output directory goes away after publishing
+
+    with cache.mapped(fake_s3, "test-bucket", "stems/amy/t1/guitar.wav") as view:
+        assert view[:4] == b"RIFF"
+        assert len(view) == 4100
+    with cache.pinned(fake_s3, "test-bucket", "stems/amy/t1/guitar.wav") as path:
+        assert path.read_bytes()[4:8] == b"\x01" * 4
+    assert fake_s3.downloads == []
+    assert cache.stats()["hits"] == 2
+
+
+def test_changed_etag_refetches_the_object(fake_s3, tmp_path):
+    from backend.local_stem_cache import LocalStemCache
+
+    cache = LocalStemCache(tmp_path / "cache")
+    key = "stems/amy/t1/manifest.json"
+    fake_s3.put_object(Bucket="test-bucket", Key=key, Body=json.dumps({"stems": {"guitar": "a"}}))
+    with cache.mapped(fake_s3, "test-bucket", key) as view:
+        assert json.loads(view[:])["stems"]["guitar"] == "a"
+
+    fake_s3.put_object(Bucket="test-bucket", Key=key, Body=json.dumps({"stems": {"guitar": "b"}}))
+    with cache.mapped(fake_s3, "test-bucket", key) as view:
+        assert json.loads(view[:])["stems"]["guitar"] == "b"
+    stats = cache.stats()
+    assert stats["misses"] == 2 and stats["stale"] == 1
+    assert fake_s3.downloads == [key, key]
+
+
+def test_lru_eviction_by_bytes_skips_pinned_entries(fake_s3, tmp_path):
+    from backend.local_stem_cache import LocalStemCache
+
+    cache = LocalStemCache(tmp_path / "cache", max_bytes=2500)
+    for name in ("a", "b", "c"):
+        fake_s3.put_object(Bucket="test-bucket", Key=f"stems/{name}.wav", Body=name.encode() * 1000)
+
+    with ExitStack() as outer:
+        holding_b = outer.enter_context(cache.pinned(fake_s3, "test-bucket", "stems/b.wav"))
+        with cache.pinned(fake_s3, "test-bucket", "stems/a.wav") as pinned_path:
+            with cache.pinned(fake_s3, "test-bucket", "stems/c.wav"):
+                pass
+            # a and b were both pinned, so c stays over budget until something is released
+            assert pinned_path.exists()
+        assert cache.stats()["evictions"] == 0
+
+        fake_s3.put_object(Bucket="test-bucket", Key="stems/d.wav", Body=b"d" * 1000)
+        with cache.pinned(fake_s3, "test-bucket", "stems/d.wav"):
+            pass
+        assert cache.stats()["evictions"] == 2  # a then c; b is still pinned
+        assert not pinned_path.exists()
+        assert holding_b.exists()
+    # Per-key locks go with their entries, and missing keys leave none behind
+    assert set(cache._key_locks) <= set(cache._entries)
+    with pytest.raises(fake_s3.exceptions.NoSuchKey):
+        with cache.pinned(fake_s3, "test-bucket", "stems/missing.wav"):
+            pass
+    assert cache._name("stems/missing.wav") not in cache._key_locks
+
+
+def test_s3_etag_matches_multipart_form(tmp_path):
+    import hashlib
+    from backend.local_stem_cache import s3_etag
+
+    path = tmp_path / "stem.wav"
+    path.write_bytes(b"x" * 2500)
+    assert s3_etag(path) == hashlib.md5(b"x" * 2500).hexdigest()
+    parts = b"".join(hashlib.md5(b"x" * n).digest() for n in (1000, 1000, 500))
+    assert s3_etag(path, chunk_size=1000, threshold=2000) == f"{hashlib.md5(parts).hexdigest()}-3"
+    assert "-" not in s3_etag(path, chunk_size=1000, threshold=4000)
+
+
+def test_stem_cache_stats_endpoint(client, fake_s3):
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/manifest.json", Body=b"{}")
+    from backend.local_stem_cache import get_stem_cache
+    with get_stem_cache().mapped(fake_s3, "test-bucket", "stems/amy/t1/manifest.json") as view:
+        assert view[:] == b"{}"
+    body = client.get("/stems/cache/stats").json()
+    assert body["entries"] == 1 and body["misses"] == 1
+
+
+def test_a_new_process_indexes_the_files_already_on_disk(fake_s3, tmp_path):
+    import os
+    from backend.local_stem_cache import LocalStemCache
+
+    first = LocalStemCache(tmp_path / "cache", chunk_size=1000)
+    for name, age in (("old", 300), ("new", 100)):
+        key = f"stems/{name}.wav"
+        fake_s3.put_object(Bucket="test-bucket", Key=key, Body=name.encode() * 600)
+        with first.pinned(fake_s3, "test-bucket", key) as path:
+            os.utime(path, (path.stat().st_mtime - age,) * 2)
+    assert len(fake_s3.downloads) == 2
+
+    # Another worker starting on the same directory keeps the files and serves them after checking the ETag
+    second = LocalStemCache(tmp_path / "cache", max_bytes=4000, chunk_size=1000)
+    assert second.stats()["entries"] == 2
+    with second.mapped(fake_s3, "test-bucket", "stems/new.wav") as view:
+        assert view[:3] == b"new"
+    assert len(fake_s3.downloads) == 2 and second.stats()["hits"] == 1
+
+    # Least recently used by mtime goes first
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/next.wav", Body=b"n" * 1500)
+    with second.pinned(fake_s3, "test-bucket", "stems/next.wav"):
+        pass
+    assert not second.contains("stems/old.wav") and second.contains("stems/new.wav")
+    # A file the other worker evicted is fetched again instead of served from a missing path
+    with first.pinned(fake_s3, "test-bucket", "stems/old.wav") as path:
+        assert path.read_bytes() == b"old" * 600
+    assert fake_s3.downloads[-1] == "stems/old.wav"
@@ -0,0 +1,144 @@
+import io
+import json
+import time
+import wave
+
+import numpy as np
+
+
+def _tone_wav(frequency, seconds=6, sample_rate=22050):
+    t = np.arange(seconds * sample_rate) / sample_rate
+    audio = np.repeat((0.4 * np.sin(2 * np.pi * frequency * t))[:, None], 2, axis=1)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((audio * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def _dominant_frequency(audio, sample_rate):
+    spectrum = np.abs(np.fft.rfft(audio))
+    return np.argmax(spectrum) * sample_rate / len(audio)
+
+
+def test_time_stretch_changes_length_but_not_pitch():
+    from backend.loop_rendering import time_stretch
+
+    sample_rate = 22050
+    t = np.arange(4 * sample_rate) / sample_rate
+    audio = np.repeat(np.sin(2 * np.pi * 330 * t)[:, None], 2, axis=1).astype(np.float32)
+    for speed in (0.5, 0.75):
+        stretched = time_stretch(audio, speed)
+        assert len(stretched) == round(len(audio) / speed)
+        assert abs(_dominant_frequency(stretched[sample_rate:3 * sample_rate, 0], sample_rate) - 330) < 2
+
+
+def test_blockwise_stretch_matches_a_single_block():
+    from backend.loop_rendering import stretch_blocks
+
+    rng = np.random.default_rng(0)
+    audio = rng.uniform(-0.5, 0.5, size=(3 * 22050, 2)).astype(np.float32)
+    whole = np.concatenate(list(stretch_blocks(audio, 0.3, block_frames=100_000)))
+    chunks = list(stretch_blocks(audio, 0.3, block_frames=7))
+    assert len(chunks) > 10 and max(len(c) for c in chunks) <= 7 * 512 + 2048
+    assert np.allclose(np.concatenate(chunks), whole, atol=1e-5)
+
+
+def _seed_project(fake_s3):
+    base = "https://test-bucket.s3.eu-west-2.amazonaws.com/stems/amy/t1"
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/guitar.wav", Body=_tone_wav(440))
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/no_guitar.wav", Body=_tone_wav(110))
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/manifest.json", Body=json.dumps({
+        "stems": {"guitar": f"{base}/guitar.flac", "backingTrack": f"{base}/no_guitar.flac"},
+        "renditions": {"guitar": {"wav": f"{base}/guitar.wav"}, "backingTrack": {"wav": f"{base}/no_guitar.wav"}},
+    }))
+
+
+def test_loop_endpoint_renders_mix_and_caches(client, fake_s3):
+    _seed_project(fake_s3)
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/bookmarks.json",
+                       Body=json.dumps([{"id": 3, "start": 1.0, "end": 3.0, "label": "Riff"}]))
+
+    params = {"speed": 0.8, "guitar_gain": 1.0, "backing_gain": 0.0}
+    r = client.get("/project/amy/t1/loops/3", params=params)
+    assert r.status_code == 200
+    assert r.headers["X-Loop-Cache"] == "miss"
+    with wave.open(io.BytesIO(r.content)) as wav:
+        rate = wav.getframerate()
+        audio = np.frombuffer(wav.readframes(wav.getnframes()), dtype="<i2").reshape(-1, 2)
+    assert len(audio) == round(2.0 * rate / 0.8)
+    # Backing muted, so only the guitar's pitch is left
+    assert abs(_dominant_frequency(audio[:, 0].astype(float), rate) - 440) < 3
+
+    assert client.get("/project/amy/t1/loops/3", params=params).headers["X-Loop-Cache"] == "hit"
+    assert client.get("/project/amy/t1/loops/9").status_code == 404
+    assert client.get("/project/amy/t1/loops/3", params={"speed": 5}).status_code == 400
+    assert client.get("/loops/cache/stats").json()["renders"] == 1
+
+
+def test_saving_bookmarks_prerenders_common_speeds_and_lru_evicts(client, fake_s3, tmp_path, monkeypatch):
+    import backend.main as main
+
+    _seed_project(fake_s3)
+    renderer = main.LoopRenderer(cache_dir=tmp_path / "lru", max_entries=2, workers=0)
+    monkeypatch.setattr(main, "loop_renderer", renderer)
+    bookmarks = [{"id": 1, "start": 0.0, "end": 2.0, "label": "Intro"}]
+    assert client.put("/amy/t1/bookmarks", json=bookmarks).status_code == 200
+    while renderer.stats()["prerenderQueued"]:
+        time.sleep(0.01)
+    # Saving again finds both clips cached and queues nothing
+    assert client.put("/amy/t1/bookmarks", json=bookmarks).status_code == 200
+    renderer._prerender_pool.shutdown(wait=True)
+    assert renderer.stats()["renders"] == 2
+    assert renderer.stats()["prerenderSkipped"] == 2
+
+    path, cached = renderer.render(fake_s3, "test-bucket", "amy", "t1", bookmarks[0], speed=0.5)
+    assert cached
+    renderer.render(fake_s3, "test-bucket", "amy", "t1", bookmarks[0], speed=0.9)
+    assert renderer.stats()["evictions"] == 1
+    assert len(list((tmp_path / "lru").glob("*.wav"))) == 2
+
+
+def test_an_open_clip_survives_eviction(fake_s3, tmp_path):
+    from backend.loop_rendering import LoopRenderer
+
+    _seed_project(fake_s3)
+    renderer = LoopRenderer(cache_dir=tmp_path / "lru", max_entries=1, workers=0)
+    bookmark = {"id": 1, "start": 0.0, "end": 1.0}
+    clip, cached = renderer.open(fake_s3, "test-bucket", "amy", "t1", bookmark, speed=0.5)
+    with clip:
+        head = clip.read(44)
+        renderer.render(fake_s3, "test-bucket", "amy", "t1", bookmark, speed=0.75)
+        assert renderer.stats()["evictions"] == 1
+        # The evicted file is gone from the cache but the response still reads all of it
+        rest = clip.read()
+    with wave.open(io.BytesIO(head + rest)) as wav:
+        assert wav.getnframes() == round(wav.getframerate() / 0.5)
+    assert not cached
+
+
+def test_prerender_queue_is_bounded_and_skips_queued_loops(monkeypatch, tmp_path):
+    import threading
+    from backend.loop_rendering import LoopRenderer
+
+    renderer = LoopRenderer(cache_dir=tmp_path / "lru", workers=0, max_prerender_queued=2)
+    release, rendered = threading.Event(), []
+    def slow_render(s3_client, bucket, username, task_id, bookmark, speed=1.0, *gains):
+        release.wait(5)
+        rendered.append((bookmark["id"], speed))
+
+    monkeypatch.setattr(renderer, "render", slow_render)
+    bookmarks = [{"id": 1, "start": 0.0, "end": 2.0}, {"id": 2, "start": 4.0, "end": 6.0}]
+    first = renderer.prerender(None, "b", "amy", "t1", bookmarks, speeds=[0.5, 0.75])
+    again = renderer.prerender(None, "b", "amy", "t1", bookmarks[:1], speeds=[0.5, 0.75])
+    assert len(first) == 2 and again == []
+    stats = renderer.stats()
+    assert (stats["prerenderQueued"], stats["prerenderDropped"], stats["prerenderSkipped"]) == (2, 2, 2)
+
+    release.set()
+    for future in first:
+        future.result()
+    assert sorted(rendered) == [(1, 0.5), (1, 0.75)]
+    assert renderer.stats()["prerenderQueued"] == 0
@@ -0,0 +1,76 @@
+import json
+
+
+def _seed_project(fake_s3, prefix, base_url):
+    fake_s3.put_object(Bucket="test-bucket", Key=prefix + "guitar.wav", Body=b"G")
+    fake_s3.put_object(Bucket="test-bucket", Key=prefix + "no_guitar.wav", Body=b"B")
+    manifest = {
+        "stems": {"guitar": f"{base_url}/{prefix}guitar.wav", "backingTrack": f"{base_url}/{prefix}no_guitar.wav"},
+        "originalFileName": "first.mp3",
+    }
+    fake_s3.put_object(Bucket="test-bucket", Key=prefix + "manifest.json", Body=json.dumps(manifest))
+    return manifest
+
+
+def test_store_then_materialize_rewrites_project_urls(fake_s3):
+    from backend.separation_cache import SeparationCache
+
+    base = "https://test-bucket.s3.eu-west-2.amazonaws.com"
+    cache = SeparationCache()
+    manifest = _seed_project(fake_s3, "stems/a/t1/", base)
+    cache.store(fake_s3, "test-bucket", "k1", "stems/a/t1/", base, manifest)
+
+    assert fake_s3.storage["cache/separations/k1/guitar.wav"] == b"G"
+    assert "cache/separations/k1/manifest.json" not in fake_s3.storage
+
+    entry = cache.lookup(fake_s3, "test-bucket", "k1")
+    out = cache.materialize(fake_s3, "test-bucket", "k1", entry, "stems/b/t2/", base, "second.mp3")
+    assert out["stems"]["guitar"] == f"{base}/stems/b/t2/guitar.wav"
+    assert out["originalFileName"] == "second.mp3"
+    assert fake_s3.storage["stems/b/t2/no_guitar.wav"] == b"B"
+    assert cache.stats()["hits"] == 1
+
+    # A fresh instance reloads the index mirrored to S3
+    assert SeparationCache().lookup(fake_s3, "test-bucket", "k1") is not None
+
+
+def test_lru_eviction_deletes_cached_objects(fake_s3):
+    from backend.separation_cache import SeparationCache
+
+    base = "https://test-bucket.s3.eu-west-2.amazonaws.com"
+    cache = SeparationCache(max_entries=1)
+    cache.store(fake_s3, "test-bucket", "old", "stems/a/t1/", base, _seed_project(fake_s3, "stems/a/t1/", base))
+    cache.store(fake_s3, "test-bucket", "new", "stems/a/t2/", base, _seed_project(fake_s3, "stems/a/t2/", base))
+
+    assert cache.lookup(fake_s3, "test-bucket", "old") is None
+    assert "cache/separations/old/guitar.wav" not in fake_s3.storage
+    assert cache.stats()["evictions"] == 1
+
+
+def test_separate_reuses_cached_stems_for_same_audio(client, monkeypatch, fake_s3):
+    import backend.main as main
+
+    runs = []
+
+    def fake_upload_and_separate(temp_file_path, object_key, task_id, username, original_filename, separator,
+                                 cancel_token=None, cache_key=None):
+        runs.append(task_id)
+        base = main.s3_base_url()
+        manifest = _seed_project(fake_s3, f"stems/{username}/{task_id}/", base)
+        main.separation_cache.store(fake_s3, "test-bucket", cache_key, f"stems/{username}/{task_id}/", base, manifest)
+
+    monkeypatch.setattr(main, "upload_and_separate", fake_upload_and_separate)
+    files = {"file": ("song.mp3", b"SAME AUDIO BYTES", "audio/mpeg")}
+
+    first = client.post("/separate/", files=files, data={"username": "alice"}).json()
+    assert main.separation_scheduler.wait(first["taskId"], timeout=5)
+    assert first["cached"] is False
+
+    second = client.post("/separate/", files=files, data={"username": "bob"}).json()
+    assert second["cached"] is True
+    assert runs == [first["taskId"]]
+    manifest = json.loads(fake_s3.storage[f"stems/bob/{second['taskId']}/manifest.json"])
+    assert manifest["stems"]["guitar"].endswith(f"stems/bob/{second['taskId']}/guitar.wav")
+
+    stats = client.get("/separate/cache/stats").json()
+    assert stats["hits"] == 1 and stats["misses"] == 1
@@ -0,0 +1,56 @@
+def test_short_song_on_big_machine_uses_full_segment_and_cores():
+    from backend.separation_planner import AudioProbe, plan_separation
+
+    plan = plan_separation("htdemucs_6s", AudioProbe(180.0, 44100, 2), free_mb=32000, cores=16)
+    assert plan.segment == 7
+    assert plan.jobs > 1
+    # A second shift would double the compute, so short songs keep one
+    assert plan.shifts == 1
+    assert plan.output_format == "wav"
+    assert plan.threads * plan.jobs <= 16
+
+
+def test_concurrent_jobs_plan_with_their_share_of_the_machine():
+    from backend.separation_planner import AudioProbe, job_share, plan_separation
+
+    assert job_share(32000, 16, 1) == (32000, 16)
+    assert job_share(32000, 16, 4, ram_per_job_mb=4096) == (4096, 4)
+    assert job_share(6000, 16, 4) == (1500, 4)
+    assert job_share(2000, 3, 4, ram_per_job_mb=4096) == (2000, 1)
+
+    alone = plan_separation("htdemucs_6s", AudioProbe(180.0, 44100, 2), *job_share(32000, 16, 1))
+    shared = plan_separation("htdemucs_6s", AudioProbe(180.0, 44100, 2), *job_share(32000, 16, 4, 4096))
+    assert shared.jobs * shared.threads <= 4 < alone.jobs * alone.threads
+    assert shared.estimated_mb <= 4096
+
+
+def test_long_song_with_little_ram_shrinks_segment_and_uses_mp3():
+    from backend.separation_planner import AudioProbe, plan_separation
+
+    roomy = plan_separation("htdemucs_6s", AudioProbe(900.0, 44100, 2), free_mb=32000, cores=4)
+    tight = plan_separation("htdemucs_6s", AudioProbe(900.0, 44100, 2), free_mb=2600, cores=4)
+    assert tight.segment < roomy.segment
+    assert tight.jobs == 1
+    assert tight.output_format == "mp3"
+    assert tight.overlap > roomy.overlap
+
+
+def test_failed_probe_estimates_duration_from_file_size():
+    from backend.separation_planner import plan_separation
+
+    # 3 MB at 128 kbps is a little over three minutes, so WAV output is still fine
+    plan = plan_separation("htdemucs_6s", None, free_mb=8000, cores=4, file_size_bytes=3_000_000)
+    assert 150 < plan.duration < 250
+    assert plan.output_format == "wav"
+    assert "probe failed" in plan.reason
+
+
+def test_probe_audio_parses_ffprobe_json(monkeypatch):
+    from backend.separation_planner import probe_audio
+
+    class Done:
+        stdout = '{"streams": [{"sample_rate": "48000", "channels": 1}], "format": {"duration": "61.5"}}'
+
+    monkeypatch.setattr("backend.separation_planner.subprocess.run", lambda *a, **k: Done())
+    probe = probe_audio("x.wav")
+    assert (probe.duration, probe.sample_rate, probe.channels) == (61.5, 48000, 1)
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+import pytest
+
+
+def test_async_callers_with_the_same_key_share_one_call():
+    from backend.single_flight import AsyncSingleFlight
+
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value * 2
+
+    async def run():
+        same = [flights.do("double", "k", lambda: work(21)) for _ in range(4)]
+        other = flights.do("double", "other", lambda: work(5))
+        return await asyncio.gather(*same, other)
+
+    results = asyncio.run(run())
+    assert [r for r, _ in results] == [42, 42, 42, 42, 10]
+    assert sorted(shared for _, shared in results) == [False, False, True, True, True]
+    assert sorted(calls) == [5, 21]
+    assert flights.stats() == {"double": {"calls": 5, "coalesced": 3, "coalescedRate": 0.6}}
+
+
+def test_thread_callers_share_results_and_exceptions():
+    from backend.single_flight import SingleFlight
+
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls, waited = [], []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "stems"
+
+    results = []
+    owner = threading.Thread(target=lambda: results.append(flights.do("separation", "song", slow)))
+    owner.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(
+        flights.do("separation", "song", slow, on_wait=lambda: waited.append(1))))
+    follower.start()
+    while flights.stats()["separation"]["calls"] < 2:
+        pass
+    release.set()
+    owner.join(5)
+    follower.join(5)
+    assert sorted(results) == [("stems", False), ("stems", True)]
+    assert calls == [1] and waited == [1]
+
+    def broken():
+        raise RuntimeError("demucs failed")
+
+    with pytest.raises(RuntimeError):
+        flights.do("separation", "song", broken)
+    # A finished call leaves no slot behind, so the next caller runs again
+    assert flights.do("separation", "song", lambda: "again") == ("again", False)
+
+
+def test_concurrent_identical_prompts_reach_gemini_once(monkeypatch, tmp_path):
+    import backend.main as main
+    from backend.gemini_cache import ResponseCache
+    from backend.single_flight import AsyncSingleFlight
+
+    calls = []
+
+    async def slow_generate(system_prompt, user_prompt, model_name):
+        calls.append(user_prompt)
+        await asyncio.sleep(0.05)
+        return {"text": "Strum it gently."}
+
+    monkeypatch.setattr(main, "generate_text_from_prompt", slow_generate)
+    monkeypatch.setattr(main, "ai_flights", AsyncSingleFlight())
+    monkeypatch.setattr(main, "response_cache", ResponseCache(tmp_path, enabled=False))
+
+    async def run():
+        return await asyncio.gather(*[
+            main.generate_once("advice", "sys", "How do I play the intro?", "m", cached=False) for _ in range(3)
+        ])
+
+    assert asyncio.run(run()) == [{"text": "Strum it gently."}] * 3
+    assert len(calls) == 1
+    assert main.ai_flights.stats()["advice"]["coalesced"] == 2
@@ -0,0 +1,73 @@
+import json
+
+
+def test_only_obviously_clean_names_are_identified_locally():
+    from backend.song_identification import identify_locally
+
+    assert identify_locally("Oasis - Wonderwall.mp3") == {"songTitle": "Wonderwall", "artist": "Oasis"}
+    assert identify_locally("03. Radiohead - Karma Police.flac") == {"songTitle": "Karma Police", "artist": "Radiohead"}
+    assert identify_locally("07 - AC/DC - Thunderstruck.wav") == {"songTitle": "Thunderstruck", "artist": "AC/DC"}
+    assert identify_locally("04) Oasis - Wonderwall.mp3") == {"songTitle": "Wonderwall", "artist": "Oasis"}
+    assert identify_locally("09 Oasis - Wonderwall.mp3") == {"songTitle": "Wonderwall", "artist": "Oasis"}
+    # Artists that start with a number are never mistaken for a track number
+    for numbered in ["3 Doors Down - Kryptonite.mp3", "50 Cent - In Da Club.mp3", "10 Years - Wasteland.mp3",
+                     "2 Chainz - Birthday Song.mp3", "01. 50 Cent - In Da Club.mp3"]:
+        assert identify_locally(numbered) is None, numbered
+    for messy in ["01_oasis-wonderwall.mp3", "oasis - wonderwall.mp3", "Oasis - Wonderwall (Official Video).mp3",
+                  "Wonderwall.mp3", "Oasis - Wonderwall - Live - 1995.mp3", "311 - Amber.mp3"]:
+        assert identify_locally(messy) is None, messy
+
+
+def test_batch_answers_are_parsed_item_by_item():
+    from backend.song_identification import parse_batch_response
+
+    fenced = '```json\n[{"index": 1, "songTitle": "Creep", "artist": "Radiohead"}, {"index": 0, "songTitle": "Yellow"}]\n```'
+    assert parse_batch_response(fenced, 2) == {
+        0: {"songTitle": "Yellow", "artist": "Unknown Artist"},
+        1: {"songTitle": "Creep", "artist": "Radiohead"},
+    }
+    # A cut off answer keeps its whole objects; bad indexes and empty titles are left for a retry
+    truncated = ('[{"index": 0, "songTitle": "Yellow", "artist": "Coldplay"}, {"index": 7, "songTitle": "X"}, '
+                 '{"index": "1", "songTitle": "Creep"}, {"index": 2, "songTitle": ""}, {"index": 3, "songTi')
+    assert parse_batch_response(truncated, 4) == {0: {"songTitle": "Yellow", "artist": "Coldplay"}}
+    assert parse_batch_response("I could not identify these.", 3) == {}
+
+
+def test_batch_endpoint_skips_clean_names_and_retries_missing_items(client, monkeypatch):
+    import backend.main as main
+
+    prompts = []
+
+    async def generate(system_prompt, user_prompt, model_name):
+        items = json.loads(user_prompt)
+        prompts.append([item["filename"] for item in items])
+        # The first answer leaves out the last filename of the batch
+        answered = items if len(prompts) > 1 else items[:-1]
+        return {"text": json.dumps([{"index": item["index"], "songTitle": item["filename"].split(".")[0].title(),
+                                     "artist": "Someone"} for item in answered])}
+
+    monkeypatch.setattr(main, "generate_text_from_prompt", generate)
+    names = ["Oasis - Wonderwall.mp3", "track_one.mp3", "track_two.mp3", "track_one.mp3"]
+    body = client.post("/gemini/identify-batch", json={"rawFileNames": names}).json()
+
+    assert prompts == [["track_one.mp3", "track_two.mp3"], ["track_two.mp3"]]
+    assert [r["rawFileName"] for r in body["results"]] == names
+    assert [r["source"] for r in body["results"]] == ["local", "model", "model", "model"]
+    assert body["results"][2]["songTitle"] == "Track_Two"
+    assert (body["local"], body["model"], body["unresolved"]) == (1, 3, 0)
+
+
+def test_batch_items_the_model_never_answers_fall_back_to_the_filename(client, monkeypatch):
+    import backend.main as main
+
+    calls = []
+
+    async def failing(system_prompt, user_prompt, model_name):
+        calls.append(user_prompt)
+        return {"error": "quota", "error_code": "RATE_LIMIT"}
+
+    monkeypatch.setattr(main, "generate_text_from_prompt", failing)
+    body = client.post("/gemini/identify-batch", json={"rawFileNames": ["mystery_track.mp3"]}).json()
+    assert body["results"] == [{"rawFileName": "mystery_track.mp3", "songTitle": "mystery_track.mp3",
+                                "artist": "Unknown Artist", "source": "fallback"}]
+    assert len(calls) == main.IDENTIFY_BATCH_RETRIES + 1
@@ -0,0 +1,85 @@
+import io
+import json
+import wave
+
+import numpy as np
+
+
+def _sparse_then_busy_wav(path, sample_rate=22050):
+    """Ten seconds of near silence, then ten seconds of plucked notes, then ten quiet seconds."""
+    t = np.arange(sample_rate // 4) / sample_rate
+    pluck = np.sin(2 * np.pi * 330 * t) * np.exp(-t * 12)
+    busy = np.tile(pluck, 40)
+    audio = np.concatenate([np.full(10 * sample_rate, 1e-4), busy, 0.02 * np.sin(2 * np.pi * 110 * np.arange(10 * sample_rate) / sample_rate)])
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((audio * 0.8 * 32767).astype("<i2").tobytes())
+    return path
+
+
+def test_activity_map_scores_playing_above_silence_and_round_trips(tmp_path):
+    from backend.stem_activity import ActivityMap, compute_activity
+
+    activity = compute_activity(str(_sparse_then_busy_wav(tmp_path / "guitar.wav")))
+    hops_per_second = 1 / activity.hop_seconds
+    silent = activity.values[:int(9 * hops_per_second)]
+    playing = activity.values[int(11 * hops_per_second):int(19 * hops_per_second)]
+    assert silent.max() < 40 and playing.min() > silent.max() + 100
+    assert activity.values.dtype == np.uint8 and len(activity.values) == round(30 / activity.hop_seconds)
+
+    restored = ActivityMap.from_manifest(json.loads(json.dumps(activity.to_manifest())))
+    assert np.array_equal(restored.values, activity.values)
+
+
+def test_densest_windows_picks_busiest_spans_in_time_order():
+    from backend.stem_activity import ActivityMap, densest_windows
+
+    values = np.zeros(120, dtype=np.uint8)
+    values[80:90] = 200
+    values[20:30] = 150
+    activity = ActivityMap(0.5, values)
+    assert densest_windows(activity, 5.0) == [(40.0, 5.0)]
+    assert densest_windows(activity, 10.0, count=2) == [(10.0, 5.0), (40.0, 5.0)]
+    # A song shorter than the budget goes whole
+    assert densest_windows(activity, 90.0) == [(0.0, 90.0)]
+
+
+def test_analyze_stem_sends_the_densest_window(client, fake_s3, monkeypatch):
+    import backend.main as main
+    import backend.stem_excerpts as se
+    from backend.stem_activity import ActivityMap
+
+    cut, contexts = [], []
+    monkeypatch.setattr(se.ExcerptExtractor, "_cut", lambda self, s3, bucket, urls, windows, out: (
+        cut.append(windows), out.write_bytes(b"excerpt")))
+    async def analyze(path, **kwargs):
+        contexts.append(kwargs["extra_context_json"])
+        return {"key": "E"}
+
+    monkeypatch.setattr(main, "analyze_guitar_file", analyze)
+    values = np.zeros(600, dtype=np.uint8)
+    values[300:480] = 220
+    base = "https://test-bucket.s3.eu-west-2.amazonaws.com/stems/amy/t1"
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/manifest.json", Body=json.dumps({
+        "stems": {"guitar": f"{base}/guitar.flac"},
+        "activity": {"guitar": ActivityMap(0.5, values).to_manifest()},
+    }))
+
+    r = client.post("/gemini/analyze-stem", json={"username": "amy", "task_id": "t1", "songTitle": "Song"})
+    assert r.status_code == 200
+    assert cut == [[(150.0, 90.0)]]
+    assert contexts[0]["excerptWindows"] == [{"start": 150.0, "duration": 90.0}]
+
+
+def test_song_length_comes_from_whichever_field_the_manifest_has():
+    from backend.main import manifest_duration
+    from backend.stem_activity import ActivityMap
+
+    activity = {"guitar": ActivityMap(0.5, np.zeros(400, dtype=np.uint8)).to_manifest()}
+    assert manifest_duration({"duration": 241.5, "analysis": {"duration": 240}, "activity": activity}) == 241.5
+    # Essentia results from before durations were recorded leave only the activity map
+    assert manifest_duration({"analysis": {"bpm": 120.0}, "activity": activity}) == 200.0
+    assert manifest_duration({"analysis": {"duration": 180.0}}) == 180.0
+    assert manifest_duration({}) is None
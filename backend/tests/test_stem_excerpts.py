@@ -0,0 +1,150 @@
+import io
+import json
+import struct
+import wave
+
+import numpy as np
+
+
+def _wav_with_metadata(seconds=4, sample_rate=8000):
+    audio = (np.arange(seconds * sample_rate * 2) % 1000).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(audio.tobytes())
+    data = buffer.getvalue()
+    # Put a LIST chunk between fmt and data, as many encoders do
+    info = b"INFOISFT\x06\x00\x00\x00demucs"
+    listing = b"LIST" + struct.pack("<I", len(info)) + info
+    body = data[12:36] + listing + data[36:]
+    return b"RIFF" + struct.pack("<I", 4 + len(body)) + b"WAVE" + body, audio.tobytes()
+
+
+def _fake_encode(calls):
+    def encode(command, chunks, out_path):
+        payload = b"".join(chunks) if chunks is not None else b""
+        calls.append((command, payload))
+        out_path.write_bytes(payload or b"excerpt")
+    return encode
+
+
+def test_trim_args_stop_reading_at_the_last_window():
+    from backend.stem_excerpts import trim_args
+
+    assert trim_args([(30.0, 90.0)]) == (["-ss", "30.000", "-t", "90.000"], [])
+    window, trim = trim_args([(10.0, 30.0), (100.0, 30.0), (55.0, 30.0)])
+    assert window == ["-t", "130.000"]
+    assert "atrim=start=100.000:duration=30.000" in trim[1] and trim[-2:] == ["-map", "[out]"]
+
+
+def test_parse_wav_header_finds_data_after_metadata_chunks():
+    from backend.stem_excerpts import parse_wav_header
+
+    data, pcm = _wav_with_metadata()
+    layout = parse_wav_header(data[:4096])
+    assert (layout.sample_rate, layout.channels, layout.block_align, layout.sample_format) == (8000, 2, 4, "s16le")
+    assert data[layout.data_offset:] == pcm
+    first, last = layout.byte_range(1.0, 2.0)
+    assert data[first:last + 1] == pcm[8000 * 4:24000 * 4]
+    # A window past the end is clamped to the data
+    assert layout.byte_range(3.5, 10.0)[1] == len(data) - 1
+    assert parse_wav_header(b"ID3\x03" + b"\x00" * 100) is None
+
+
+def test_wav_excerpt_fetches_only_the_window_and_is_cached(monkeypatch, fake_s3, tmp_path):
+    import backend.stem_excerpts as se
+
+    calls = []
+    monkeypatch.setattr(se, "_encode", _fake_encode(calls))
+    data, pcm = _wav_with_metadata(seconds=20)
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/guitar.wav", Body=data)
+    base = "https://test-bucket.s3.eu-west-2.amazonaws.com/stems/amy/t1"
+    manifest = {"stems": {"guitar": f"{base}/guitar.flac"}, "renditions": {"guitar": {"wav": f"{base}/guitar.wav"}}}
+
+    extractor = se.ExcerptExtractor(cache_dir=tmp_path / "excerpts")
+    path, cached = extractor.excerpt(fake_s3, "test-bucket", se.excerpt_sources(manifest), [(1.0, 2.0)])
+    assert not cached and path.exists()
+    command, payload = calls[0]
+    assert command[command.index("-f") + 1] == "s16le" and "pipe:0" in command
+    assert payload == pcm[8000 * 4:24000 * 4]
+    # One small header read and one ranged read of just the window
+    assert len(fake_s3.ranges) == 2
+    assert extractor.stats()["bytesFetched"] == se.WAV_HEADER_BYTES + len(payload) < len(data) / 4
+    assert fake_s3.downloads == []
+
+    again, cached = extractor.excerpt(fake_s3, "test-bucket", se.excerpt_sources(manifest), [(1.0, 2.0)])
+    assert cached and again == path and len(calls) == 1
+
+    # Several windows are joined by sending their byte ranges back to back
+    extractor.excerpt(fake_s3, "test-bucket", se.excerpt_sources(manifest), [(1.0, 1.0), (10.0, 0.5)])
+    assert calls[-1][1] == pcm[8000 * 4:16000 * 4] + pcm[80000 * 4:84000 * 4]
+
+
+def test_compressed_excerpt_stops_fetching_once_ffmpeg_is_done(monkeypatch, fake_s3, tmp_path):
+    import backend.stem_excerpts as se
+
+    def encode_two_chunks(command, chunks, out_path):
+        assert command[command.index("-t") + 1] == "90.000"
+        for _ in range(2):
+            next(chunks)
+        chunks.close()
+        out_path.write_bytes(b"excerpt")
+
+    monkeypatch.setattr(se, "_encode", encode_two_chunks)
+    monkeypatch.setattr(se, "EXCERPT_CHUNK_BYTES", 1024)
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/guitar.flac", Body=b"f" * 100_000)
+    manifest = {"stems": {"guitar": "https://test-bucket.s3.eu-west-2.amazonaws.com/stems/amy/t1/guitar.flac"}}
+
+    extractor = se.ExcerptExtractor(cache_dir=tmp_path / "excerpts")
+    extractor.excerpt(fake_s3, "test-bucket", se.excerpt_sources(manifest))
+    assert extractor.stats()["bytesFetched"] == 2048
+
+
+def test_pinned_excerpts_survive_eviction_until_released(monkeypatch, fake_s3, tmp_path):
+    import backend.stem_excerpts as se
+
+    monkeypatch.setattr(se, "_encode", _fake_encode([]))
+    data, _ = _wav_with_metadata(seconds=20)
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/guitar.wav", Body=data)
+    sources = ["https://test-bucket.s3.eu-west-2.amazonaws.com/stems/amy/t1/guitar.wav"]
+
+    extractor = se.ExcerptExtractor(cache_dir=tmp_path / "excerpts", max_entries=1)
+    held, _ = extractor.excerpt(fake_s3, "test-bucket", sources, [(0.0, 1.0)], pin=True)
+    other, _ = extractor.excerpt(fake_s3, "test-bucket", sources, [(5.0, 1.0)])
+    # The cache runs over its size rather than delete a file still being read
+    assert held.exists() and other.exists()
+    assert extractor.stats()["evictions"] == 0
+
+    extractor.release(held)
+    extractor.excerpt(fake_s3, "test-bucket", sources, [(9.0, 1.0)])
+    assert not held.exists() and not other.exists()
+    assert extractor.stats()["evictions"] == 2 and extractor._pins == {}
+
+
+def test_analyze_stem_sends_the_cached_excerpt(client, fake_s3, monkeypatch):
+    import backend.main as main
+    import backend.stem_excerpts as se
+
+    calls, sent = [], []
+    monkeypatch.setattr(se, "_encode", _fake_encode(calls))
+    async def analyze(path, **kwargs):
+        sent.append(path)
+        return {"key": "E"}
+
+    monkeypatch.setattr(main, "analyze_guitar_file", analyze)
+    data, _ = _wav_with_metadata()
+    base = "https://test-bucket.s3.eu-west-2.amazonaws.com/stems/amy/t1"
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/guitar.wav", Body=data)
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/manifest.json", Body=json.dumps({
+        "stems": {"guitar": f"{base}/guitar.wav"}, "renditions": {"guitar": {"wav": f"{base}/guitar.wav"}},
+    }))
+
+    body = {"username": "amy", "task_id": "t1", "songTitle": "Song", "artist": "Band"}
+    for _ in range(2):
+        r = client.post("/gemini/analyze-stem", json=body)
+        assert r.status_code == 200 and r.json()["result"] == {"key": "E"}
+    assert len(calls) == 1 and sent[0] == sent[1]
+    assert client.get("/excerpts/cache/stats").json()["hits"] == 1
+    assert main.excerpt_extractor._pins == {}
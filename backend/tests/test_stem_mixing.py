@@ -0,0 +1,94 @@
+import io
+import json
+import wave
+from pathlib import Path
+
+import numpy as np
+
+
+def _wav_bytes(value, frames=1000, rate=8000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(np.full((frames, 2), value, dtype="<i2").tobytes())
+    return buffer.getvalue()
+
+
+def _samples(data):
+    with wave.open(io.BytesIO(data)) as wav:
+        return np.frombuffer(wav.readframes(wav.getnframes()), dtype="<i2")
+
+
+def test_mix_stems_sums_block_by_block_and_clips(monkeypatch, tmp_path):
+    import backend.stem_mixing as sm
+
+    monkeypatch.setattr(sm, "MIX_BLOCK_SECONDS", 0.01)
+    paths = []
+    for name, value in (("a", 100), ("b", 250), ("c", 32600)):
+        path = tmp_path / f"{name}.wav"
+        path.write_bytes(_wav_bytes(value))
+        paths.append(path)
+
+    out = sm.mix_stems(paths[:2], tmp_path / "ab.wav")
+    mixed = _samples(out.read_bytes())
+    assert len(mixed) == 2000 and (mixed == 350).all()
+    assert (_samples(sm.mix_stems(paths[1:], tmp_path / "bc.wav").read_bytes()) == 32767).all()
+
+
+def test_six_stem_mode_publishes_sources_and_derives_backing(monkeypatch, fake_s3, tmp_path):
+    import backend.stem_separation as ss
+    from backend.separation_planner import AudioProbe
+
+    class SourcesOnlyEngine:
+        """Writes the six sources the way demucs.separate does without --two-stems."""
+        state = "ready"
+
+        def separate(self, input_path, output_dir, plan=None, two_stems="guitar", cancel_token=None, keep_sources=False):
+            assert keep_sources
+            track_dir = output_dir / "htdemucs_6s" / Path(input_path).stem
+            track_dir.mkdir(parents=True, exist_ok=True)
+            for value, name in enumerate(ss.SIX_STEM_SOURCES, start=1):
+                (track_dir / f"{name}.wav").write_bytes(_wav_bytes(value))
+            return track_dir
+
+    local = tmp_path / "six.wav"
+    local.write_bytes(b"audio")
+    monkeypatch.setattr(ss, "probe_audio", lambda path: AudioProbe(900.0, 44100, 2))
+    monkeypatch.setattr(ss, "get_analysis_pool", lambda: None)
+
+    sep = ss.DemucsSeparator(s3_client=fake_s3, model="htdemucs_6s", engine=SourcesOnlyEngine(), stem_mode="six")
+    sep.encoder.renditions = []
+    sep.packager.enabled = False
+    manifest = sep.separate_audio_stems("b", "uploads/six.wav", "six", "eve", "song.wav", local_input_path=str(local))
+
+    assert set(manifest["sources"]) == set(ss.SIX_STEM_SOURCES)
+    assert manifest["sources"]["guitar"] == manifest["stems"]["guitar"]
+    assert manifest["sources"]["drums"].endswith("stems/eve/six/sources/drums.wav")
+    # Long songs still come out as WAV so mixes can be summed; no_guitar is everything but guitar (5)
+    assert (_samples(fake_s3.storage["stems/eve/six/no_guitar.wav"]) == 1 + 2 + 3 + 4 + 6).all()
+    assert sep.cache_signature().startswith("six-stems;")
+
+
+def test_mix_endpoint_derives_and_reuses_mixes(client, fake_s3):
+    base = "https://test-bucket.s3.eu-west-2.amazonaws.com/stems/amy/t6"
+    sources = {}
+    for value, name in enumerate(("drums", "bass", "other", "vocals", "guitar", "piano"), start=1):
+        fake_s3.put_object(Bucket="test-bucket", Key=f"stems/amy/t6/sources/{name}.wav", Body=_wav_bytes(value))
+        sources[name] = f"{base}/sources/{name}.wav"
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t6/manifest.json", Body=json.dumps({
+        "stems": {"guitar": sources["guitar"], "backingTrack": f"{base}/no_guitar.wav"}, "sources": sources,
+    }))
+
+    r = client.get("/project/amy/t6/mix", params={"stems": "bass,drums"})
+    assert r.status_code == 200
+    assert r.json() == {"stems": ["bass", "drums"], "url": f"{base}/mixes/drums+bass.wav", "cached": False}
+    assert (_samples(fake_s3.storage["stems/amy/t6/mixes/drums+bass.wav"]) == 3).all()
+    assert client.get("/project/amy/t6/mix", params={"stems": "drums,bass"}).json()["cached"] is True
+
+    assert client.get("/project/amy/t6/mix", params={"stems": "guitar"}).json()["url"] == sources["guitar"]
+    assert client.get("/project/amy/t6/mix", params={"without": "guitar"}).json()["url"] == f"{base}/no_guitar.wav"
+    r = client.get("/project/amy/t6/mix", params={"without": "guitar,vocals"})
+    assert r.json()["url"].endswith("/mixes/drums+bass+other+piano.wav")
+    assert client.get("/project/amy/t6/mix", params={"stems": "kazoo"}).status_code == 400
@@ -0,0 +1,85 @@
+import json
+
+
+def test_registry_tracks_stages_and_eta():
+    from backend.task_status import TaskStatusRegistry
+
+    reg = TaskStatusRegistry()
+    reg.create("t1", "amy")
+    report = reg.reporter("t1")
+    for state in ("uploading", "downloading"):
+        report(state)
+    report("separating", duration=60.0)
+    report("encoding")
+    report("uploading_stems")
+    report("done", manifestUrl="https://x/manifest.json")
+
+    snap = reg.snapshot("t1")
+    assert [s["state"] for s in snap["stages"]] == ["queued", "uploading", "downloading", "separating", "encoding", "uploading_stems", "done"]
+    assert all(s["elapsed"] >= 0 for s in snap["stages"])
+    assert snap["details"]["manifestUrl"] == "https://x/manifest.json"
+    assert snap["eta"] is None
+
+    # Reports after a terminal state are ignored
+    report("failed", error="late")
+    assert reg.snapshot("t1")["state"] == "done"
+
+    # Once every stage has a history the next task gets an estimate
+    reg.create("t2")
+    assert reg.snapshot("t2")["eta"] is not None
+
+
+def test_separator_reports_failure(fake_s3):
+    from backend.task_status import TaskStatusRegistry
+    from backend.stem_separation import DemucsSeparator
+
+    reg = TaskStatusRegistry()
+    reg.create("missing")
+    sep = DemucsSeparator(s3_client=fake_s3)
+    assert sep.separate_audio_stems("b", "uploads/missing.wav", "missing", "amy", "x.wav",
+                                    report=reg.reporter("missing")) is None
+    snap = reg.snapshot("missing")
+    assert snap["state"] == "failed"
+    assert [s["state"] for s in snap["stages"]] == ["queued", "downloading", "failed"]
+
+
+def test_task_endpoints_and_event_stream(client):
+    import backend.main as main
+
+    assert client.get("/tasks/nope").status_code == 404
+
+    main.task_statuses.create("sse-task", "amy")
+    main.task_statuses.update("sse-task", "separating", duration=10.0)
+    r = client.get("/tasks/sse-task")
+    assert r.status_code == 200
+    assert r.json()["state"] == "separating"
+    assert r.json()["queuePosition"] is None
+
+    main.task_statuses.update("sse-task", "failed", error="Demucs failed: out of memory")
+    with client.stream("GET", "/tasks/sse-task/events") as stream:
+        assert stream.headers["content-type"].startswith("text/event-stream")
+        body = "".join(stream.iter_text())
+    events = [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+    assert events[-1]["state"] == "failed"
+    assert "out of memory" in events[-1]["error"]
+
+
+def test_eta_covers_the_local_handoff_path(monkeypatch):
+    import backend.task_status as ts
+
+    now = [1000.0]
+    monkeypatch.setattr(ts.time, "time", lambda: now[0])
+    reg = ts.TaskStatusRegistry()
+    # The local handoff never enters uploading or downloading
+    for n in range(3):
+        reg.create(f"t{n}")
+        report = reg.reporter(f"t{n}")
+        for state, seconds in (("separating", 2.0), ("encoding", 30.0), ("uploading_stems", 5.0), ("done", 3.0)):
+            now[0] += seconds
+            report(state, duration=60.0)
+
+    reg.create("next")
+    assert reg.snapshot("next")["eta"] == 2.0 + 30.0 + 5.0 + 3.0
+    now[0] += 2.0
+    reg.update("next", "separating", duration=60.0)
+    assert reg.snapshot("next")["eta"] == 30.0 + 5.0 + 3.0
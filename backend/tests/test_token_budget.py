@@ -0,0 +1,127 @@
+import asyncio
+
+
+def _tiers():
+    from backend.token_budget import PromptTier
+
+    return [PromptTier("full", "x" * 4000, 8192), PromptTier("simple", "x" * 400, 2048), PromptTier("brief", "x", 1024)]
+
+
+def test_tier_is_chosen_from_input_estimate_and_output_history():
+    from backend.token_budget import TokenBudget, estimate_input_tokens
+
+    assert estimate_input_tokens(90, 4000) == 90 * 32 + 1000
+    budget = TokenBudget(input_budget=5000, bucket_seconds=60)
+    tiers = _tiers()
+    assert budget.choose(tiers, audio_seconds=90, song_seconds=200) == 0
+    # A long excerpt does not leave room for the full prompt
+    assert budget.choose(tiers, audio_seconds=140, song_seconds=200) == 1
+    assert budget.choose(tiers, audio_seconds=1000, song_seconds=200) == 2
+
+    # One cut off answer is not enough evidence; a few send similar songs straight to the simpler prompt
+    budget.record(tiers[0], 200, None, truncated=True)
+    budget.record(tiers[1], 200, 900)
+    assert budget.choose(tiers, audio_seconds=90, song_seconds=230) == 0
+    budget.record(tiers[0], 210, None, truncated=True)
+    budget.record(tiers[0], 220, None, truncated=True)
+    assert budget.choose(tiers, audio_seconds=90, song_seconds=230) == 1
+    assert budget.choose(tiers, audio_seconds=90, song_seconds=100) == 0
+    assert budget.stats()["chosenTiers"] == {"full": 3, "simple": 2, "brief": 1}
+
+
+def test_a_skipped_tier_is_reprobed_and_its_samples_age_out(monkeypatch):
+    import backend.token_budget as tb
+
+    budget = tb.TokenBudget(min_samples=2, reprobe_every=4, max_age_seconds=3600)
+    tiers = _tiers()
+    now = [1000.0]
+    monkeypatch.setattr(tb.time, "time", lambda: now[0])
+    for _ in range(2):
+        budget.record(tiers[0], 200, None, truncated=True)
+
+    picks = [budget.choose(tiers, audio_seconds=90, song_seconds=200) for _ in range(8)]
+    assert picks == [1, 1, 1, 0, 1, 1, 1, 0]
+    assert budget.stats()["probes"] == 2
+
+    now[0] += 3601
+    assert budget.predicted_output("full", 200) is None
+    assert budget.choose(tiers, audio_seconds=90, song_seconds=200) == 0
+
+
+def test_analysis_learns_from_a_truncated_answer(monkeypatch, tmp_path):
+    import backend.gemini_client as gc
+    from backend.token_budget import TokenBudget
+
+    limits = []
+
+    class FakeFinish:
+        def __init__(self, name):
+            self.name = name
+
+    class FakeResp:
+        def __init__(self, text, reason):
+            self.text = text
+            self.candidates = [type("C", (), {"finish_reason": FakeFinish(reason)})()]
+            self.usage_metadata = type("U", (), {"candidates_token_count": 700})()
+
+    class FakeModel:
+        def __init__(self, name):
+            pass
+        async def generate_content_async(self, parts, generation_config=None, safety_settings=None):
+            limits.append(generation_config.max_output_tokens)
+            if generation_config.max_output_tokens == 8192:
+                return FakeResp('{"sections": [', "MAX_TOKENS")
+            return FakeResp('{"key": "G"}', "STOP")
+
+    monkeypatch.setattr(gc, "genai", type("G", (), {"GenerativeModel": FakeModel, "upload_file": lambda path: object()}))
+    monkeypatch.setattr(gc, "analysis_budget", TokenBudget(min_samples=1))
+    p = tmp_path / "a.flac"
+    p.write_bytes(b"data")
+
+    first = asyncio.run(gc.analyze_guitar_file(str(p), model_name="any", audio_seconds=90, song_seconds=240))
+    again = asyncio.run(gc.analyze_guitar_file(str(p), model_name="any", audio_seconds=90, song_seconds=250))
+    assert first == again == {"key": "G"}
+    assert limits == [8192, 2048, 2048]
+    stats = gc.analysis_budget.stats()
+    assert (stats["requests"], stats["fallbacks"], stats["wastedGenerations"]) == (2, 1, 1)
+    assert stats["fallbackRate"] == 0.5
+
+
+def test_every_tier_keeps_the_user_request_and_song_context(monkeypatch, tmp_path):
+    import backend.gemini_client as gc
+    from backend.token_budget import TokenBudget
+
+    sent, chars = [], []
+
+    class FakeResp:
+        text = '{"key": "G"}'
+        candidates = [type("C", (), {"finish_reason": type("F", (), {"name": "STOP"})()})()]
+        usage_metadata = None
+
+    class FakeModel:
+        def __init__(self, name):
+            pass
+        async def generate_content_async(self, parts, generation_config=None, safety_settings=None):
+            sent.append([part["text"] for part in parts if isinstance(part, dict)])
+            return FakeResp()
+
+    budget = TokenBudget()
+    def choose(tiers, audio_seconds, song_seconds=None, prompt_chars=None):
+        chars.append(list(prompt_chars))
+        return len(tiers) - 1
+
+    monkeypatch.setattr(budget, "choose", choose)
+    monkeypatch.setattr(gc, "genai", type("G", (), {"GenerativeModel": FakeModel, "upload_file": lambda path: object()}))
+    monkeypatch.setattr(gc, "analysis_budget", budget)
+    p = tmp_path / "a.flac"
+    p.write_bytes(b"data")
+
+    context = {"songTitle": "Wonderwall", "artist": "Oasis"}
+    asyncio.run(gc.analyze_guitar_file(str(p), model_name="any", user_prompt="Show the capo position",
+                                       extra_context_json=context, audio_seconds=90))
+    assert sent[0][0] == gc.ANALYSIS_TIERS[-1].prompt
+    assert sent[0][1] == "User request: Show the capo position"
+    assert '"songTitle": "Wonderwall"' in sent[0][2]
+    # The request and context count towards every tier's input estimate
+    extra = sum(len(text) for text in sent[0][1:])
+    assert chars == [[len(tier.prompt) + extra for tier in gc.ANALYSIS_TIERS]]
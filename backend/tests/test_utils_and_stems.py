@@ -12,44 +12,298 @@ def test_password_hashing_roundtrip():
     assert not verify_password("wrong", h)
 
 
-def test_get_audio_duration_success(monkeypatch, tmp_path):
+def test_convert_numpy_types_handles_primitives():
+    import numpy as np
     from backend.stem_separation import DemucsSeparator
 
-    class FakeCompleted:
+    sep = DemucsSeparator(s3_client=None)
+    obj = {
+        "a": np.int64(3),
+        "b": np.float64(1.25),
+        "c": np.array([1, 2, 3]),
+        "d": [np.int64(2), np.float64(4.5)],
+    }
+    out = sep._convert_numpy_types(obj)
+    assert out == {"a": 3, "b": 1.25, "c": [1, 2, 3], "d": [2, 4.5]}
+
+
+def test_separate_audio_stems_uses_resident_engine(monkeypatch, fake_s3):
+    import backend.stem_separation as ss
+    from backend.separation_planner import AudioProbe
+
+    class FakeEngine:
+        state = "ready"
+
         def __init__(self):
-            self.stdout = "123.456\n"
+            self.calls = []
 
-    def fake_run(cmd, capture_output, text, check):
-        return FakeCompleted()
+        def separate(self, input_path, output_dir, plan=None, two_stems="guitar", cancel_token=None, keep_sources=False):
+            self.calls.append((Path(input_path).name, plan.duration, plan.output_format))
+            track_dir = output_dir / "htdemucs_6s" / Path(input_path).stem
+            track_dir.mkdir(parents=True, exist_ok=True)
+            for name in ("guitar", "no_guitar"):
+                (track_dir / f"{name}.{plan.output_format}").write_bytes(b"stem")
+            return track_dir
 
-    # Patch where it's looked up in the module under test
-    monkeypatch.setattr("backend.stem_separation.subprocess.run", fake_run)
+    def no_subprocess(*args, **kwargs):
+        raise AssertionError("demucs subprocess should not run in engine mode")
 
-    sep = DemucsSeparator(s3_client=None)
-    assert abs(sep.get_audio_duration("somefile.wav") - 123.456) < 0.001
+    monkeypatch.setattr(ss.subprocess, "Popen", no_subprocess)
+    monkeypatch.setattr(ss, "probe_audio", lambda path: AudioProbe(60.0, 44100, 2))
+    fake_s3.put_object(Bucket="b", Key="uploads/engine-task.wav", Body=b"audio")
 
+    engine = FakeEngine()
+    sep = ss.DemucsSeparator(s3_client=fake_s3, model="htdemucs_6s", engine=engine)
+    sep.separate_audio_stems("b", "uploads/engine-task.wav", "engine-task", "eve", "song.wav")
 
-def test_get_audio_duration_failure(monkeypatch):
-    from backend.stem_separation import DemucsSeparator
+    assert engine.calls == [("engine-task.wav", 60.0, "wav")]
+    manifest = json.loads(fake_s3.storage["stems/eve/engine-task/manifest.json"])
+    assert set(manifest["stems"]) == {"guitar", "backingTrack"}
+    assert manifest["duration"] == 60.0
+    assert fake_s3.storage["stems/eve/engine-task/guitar.wav"] == b"stem"
 
-    def fake_run(cmd, capture_output, text, check):
-        raise FileNotFoundError("ffprobe not present")
 
-    monkeypatch.setattr("backend.stem_separation.subprocess.run", fake_run)
-    sep = DemucsSeparator(s3_client=None)
-    assert sep.get_audio_duration("file.wav") == 999.0
+def test_get_engine_returns_shared_instance():
+    from backend.stem_separation import get_engine
 
+    engine = get_engine("model-under-test")
+    assert get_engine("model-under-test") is engine
+    assert engine.status()["state"] == "cold"
+    assert not engine.is_ready()
 
-def test_convert_numpy_types_handles_primitives():
+
+def test_overlap_add_windows_tiles_and_crossfades():
     import numpy as np
-    from backend.stem_separation import DemucsSeparator
+    from backend.stem_separation import overlap_add_windows
 
-    sep = DemucsSeparator(s3_client=None)
-    obj = {
-        "a": np.int64(3),
-        "b": np.float64(1.25),
-        "c": np.array([1, 2, 3]),
-        "d": [np.int64(2), np.float64(4.5)],
-    }
-    out = sep._convert_numpy_types(obj)
-    assert out == {"a": 3, "b": 1.25, "c": [1, 2, 3], "d": [2, 4.5]}
+    signal = np.random.default_rng(0).standard_normal((2, 1000)).astype(np.float32)
+    seen = []
+
+    def identity(start, end):
+        seen.append((start, end))
+        return signal[:, start:end]
+
+    blocks = list(overlap_add_windows(signal.shape[-1], 300, 50, identity))
+    # Windows overlap by 50 samples and the emitted blocks tile the whole signal
+    assert seen == [(0, 300), (250, 550), (500, 800), (750, 1000)]
+    assert [(s, e) for s, e, _ in blocks] == [(0, 250), (250, 500), (500, 750), (750, 1000)]
+    rebuilt = np.concatenate([b for _, _, b in blocks], axis=-1)
+    assert np.allclose(rebuilt, signal, atol=1e-6)
+
+
+def test_progressive_separation_publishes_segments(monkeypatch, fake_s3):
+    import numpy as np
+    import backend.stem_separation as ss
+    from backend.separation_planner import AudioProbe
+
+    class FakeProgressiveEngine:
+        state = "ready"
+
+        def separate_progressive(self, input_path, output_dir, on_chunk, window_seconds=20.0,
+                                 overlap_seconds=1.0, plan=None, two_stems="guitar", cancel_token=None,
+                                 keep_sources=False):
+            track_dir = output_dir / "htdemucs_6s" / Path(input_path).stem
+            track_dir.mkdir(parents=True, exist_ok=True)
+            for name in ("guitar", "no_guitar"):
+                (track_dir / f"{name}.wav").write_bytes(b"full")
+            block = np.zeros((2, 100), dtype=np.float32)
+            on_chunk(0, 0.0, 19.0, {"guitar": block, "no_guitar": block}, 100)
+            progressive = json.loads(fake_s3.storage["stems/eve/prog/progressive.json"])
+            assert progressive["status"] == "separating"
+            assert progressive["availableUntil"] == 19.0
+            on_chunk(1, 19.0, 30.0, {"guitar": block, "no_guitar": block}, 100)
+            return track_dir
+
+    monkeypatch.setattr(ss, "probe_audio", lambda path: AudioProbe(30.0, 44100, 2))
+    fake_s3.put_object(Bucket="b", Key="uploads/prog.wav", Body=b"audio")
+    sep = ss.DemucsSeparator(s3_client=fake_s3, model="htdemucs_6s", engine=FakeProgressiveEngine(), streaming=True)
+    manifest = sep.separate_audio_stems("b", "uploads/prog.wav", "prog", "eve", "song.wav")
+
+    assert [seg["end"] for seg in manifest["segments"]] == [19.0, 30.0]
+    assert manifest["segments"][1]["stems"]["backingTrack"].endswith("stems/eve/prog/segments/no_guitar/0001.wav")
+    assert "stems/eve/prog/segments/guitar/0000.wav" in fake_s3.storage
+    assert json.loads(fake_s3.storage["stems/eve/prog/progressive.json"])["status"] == "complete"
+
+
+def test_separate_audio_stems_uses_local_input_without_download(monkeypatch, fake_s3, tmp_path):
+    import backend.stem_separation as ss
+    from backend.separation_planner import AudioProbe
+
+    class RecordingEngine:
+        state = "ready"
+
+        def separate(self, input_path, output_dir, plan=None, two_stems="guitar", cancel_token=None, keep_sources=False):
+            assert Path(input_path) == local
+            track_dir = output_dir / "htdemucs_6s" / Path(input_path).stem
+            track_dir.mkdir(parents=True, exist_ok=True)
+            (track_dir / "guitar.wav").write_bytes(b"stem")
+            return track_dir
+
+    def no_download(*args, **kwargs):
+        raise AssertionError("local handoff should not download from S3")
+
+    local = tmp_path / "handoff.wav"
+    local.write_bytes(b"audio")
+    monkeypatch.setattr(fake_s3, "download_file", no_download)
+    monkeypatch.setattr(ss, "probe_audio", lambda path: AudioProbe(30.0, 44100, 2))
+
+    sep = ss.DemucsSeparator(s3_client=fake_s3, model="htdemucs_6s", engine=RecordingEngine())
+    manifest = sep.separate_audio_stems("b", "uploads/handoff.wav", "handoff", "eve", "song.wav", local_input_path=str(local))
+
+    assert "guitar" in manifest["stems"]
+    # The caller owns the handed-off file
+    assert local.exists()
+
+    # Published stems and the manifest are already in the local stem cache, so reading them back never downloads
+    from backend.local_stem_cache import get_stem_cache
+    with get_stem_cache().mapped(fake_s3, "b", "stems/eve/handoff/manifest.json") as view:
+        assert json.loads(view[:])["stems"] == manifest["stems"]
+    with get_stem_cache().pinned(fake_s3, "b", "stems/eve/handoff/guitar.wav") as path:
+        assert path.read_bytes() == b"stem"
+
+
+def test_audio_analysis_runs_alongside_separation_and_lands_in_manifest(monkeypatch, fake_s3, tmp_path):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import backend.stem_separation as ss
+    from backend.separation_planner import AudioProbe
+
+    separating = threading.Event()
+
+    class SlowEngine:
+        state = "ready"
+
+        def separate(self, input_path, output_dir, plan=None, two_stems="guitar", cancel_token=None, keep_sources=False):
+            separating.set()
+            track_dir = output_dir / "htdemucs_6s" / Path(input_path).stem
+            track_dir.mkdir(parents=True, exist_ok=True)
+            (track_dir / "guitar.wav").write_bytes(b"stem")
+            return track_dir
+
+    def fake_analysis(file_path):
+        # Only finishes if separation starts while analysis is still in flight
+        assert separating.wait(timeout=5)
+        return {"bpm": 120.0, "key": "A minor", "key_strength": 0.81}
+
+    local = tmp_path / "analysed.wav"
+    local.write_bytes(b"audio")
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(ss, "get_analysis_pool", lambda: pool)
+    monkeypatch.setattr(ss, "analyze_audio", fake_analysis)
+    monkeypatch.setattr(ss, "probe_audio", lambda path: AudioProbe(30.0, 44100, 2))
+
+    sep = ss.DemucsSeparator(s3_client=fake_s3, model="htdemucs_6s", engine=SlowEngine())
+    manifest = sep.separate_audio_stems("b", "uploads/analysed.wav", "analysed", "eve", "song.wav", local_input_path=str(local))
+    pool.shutdown()
+
+    assert manifest["analysis"] == {"bpm": 120.0, "key": "A minor", "key_strength": 0.81}
+    stored = json.loads(fake_s3.storage["stems/eve/analysed/manifest.json"])
+    assert stored["analysis"]["key"] == "A minor"
+
+
+def test_stem_publisher_uploads_concurrently_and_reports_throughput(fake_s3, tmp_path):
+    import threading
+    from backend.stem_publishing import StemPublisher, StemUpload
+
+    in_flight, peak = [0], [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(2, timeout=2)
+    configs = []
+
+    original = fake_s3.upload_file
+
+    def tracking_upload(Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        configs.append(Config)
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        barrier.wait()  # both stems must be uploading at the same time
+        original(Filename, Bucket, Key, ExtraArgs=ExtraArgs)
+        with lock:
+            in_flight[0] -= 1
+
+    fake_s3.upload_file = tracking_upload
+    uploads = []
+    for name in ("guitar", "no_guitar"):
+        path = tmp_path / f"{name}.wav"
+        path.write_bytes(b"x" * 2048)
+        uploads.append(StemUpload(name, path, f"stems/u/t/{name}.wav", "audio/wav"))
+
+    publisher = StemPublisher(fake_s3)
+    stats = publisher.publish("b", uploads)
+
+    assert peak[0] == 2
+    assert stats["guitar"]["bytes"] == 2048 and stats["no_guitar"]["mbps"] > 0
+    assert all(c is publisher.transfer_config for c in configs)
+    assert fake_s3.storage["stems/u/t/no_guitar.wav"] == b"x" * 2048
+
+
+def test_stem_encoder_builds_ladder_and_skips_failures(monkeypatch, tmp_path):
+    from backend.stem_encoding import StemEncoder, renditions_from_env
+
+    monkeypatch.setenv("STEM_RENDITIONS", "flac,opus")
+    monkeypatch.setenv("STEM_OPUS_BITRATE_KBPS", "96")
+    commands = []
+
+    def fake_ffmpeg(cmd, capture_output, text, check):
+        commands.append(cmd)
+        if "libopus" in cmd and "no_guitar" in cmd[-1]:
+            raise FileNotFoundError("encoder missing")
+        Path(cmd[-1]).write_bytes(b"encoded")
+
+    monkeypatch.setattr("backend.stem_encoding.subprocess.run", fake_ffmpeg)
+    stems = {}
+    for name in ("guitar", "no_guitar"):
+        stems[name] = tmp_path / f"{name}.wav"
+        stems[name].write_bytes(b"pcm")
+
+    out = StemEncoder(renditions_from_env(), max_workers=4).encode(stems)
+
+    assert out["guitar"] == {"flac": tmp_path / "guitar.flac", "opus": tmp_path / "guitar.opus"}
+    assert out["no_guitar"] == {"flac": tmp_path / "no_guitar.flac"}
+    assert any("96k" in cmd for cmd in commands)
+    assert all("-threads" in cmd for cmd in commands)
+
+
+def test_hls_packaging_publishes_segments_and_index(monkeypatch, fake_s3, tmp_path):
+    import backend.stem_packaging as sp
+    import backend.stem_separation as ss
+    from backend.separation_planner import AudioProbe
+
+    def fake_ffmpeg(command, **kwargs):
+        playlist = Path(command[-1])
+        for index in range(3):
+            (playlist.parent / f"segment_{index:05d}.m4s").write_bytes(b"seg")
+        (playlist.parent / "init.mp4").write_bytes(b"init")
+        playlist.write_text(
+            "#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MAP:URI=\"init.mp4\"\n"
+            "#EXTINF:2.000,\nsegment_00000.m4s\n#EXTINF:2.000,\nsegment_00001.m4s\n"
+            "#EXTINF:1.250,\nsegment_00002.m4s\n#EXT-X-ENDLIST\n"
+        )
+
+    class Engine:
+        state = "ready"
+
+        def separate(self, input_path, output_dir, plan=None, two_stems="guitar", cancel_token=None, keep_sources=False):
+            track_dir = output_dir / "htdemucs_6s" / Path(input_path).stem
+            track_dir.mkdir(parents=True, exist_ok=True)
+            (track_dir / "guitar.wav").write_bytes(b"stem")
+            return track_dir
+
+    local = tmp_path / "hls.wav"
+    local.write_bytes(b"audio")
+    monkeypatch.setattr(sp.subprocess, "run", fake_ffmpeg)
+    monkeypatch.setattr(ss, "probe_audio", lambda path: AudioProbe(5.25, 44100, 2))
+    monkeypatch.setattr(ss, "get_analysis_pool", lambda: None)
+
+    sep = ss.DemucsSeparator(s3_client=fake_s3, model="htdemucs_6s", engine=Engine())
+    sep.encoder.renditions = []
+    sep.packager = sp.StemPackager(segment_seconds=2, enabled=True)
+    manifest = sep.separate_audio_stems("b", "uploads/hls.wav", "hls", "eve", "song.wav", local_input_path=str(local))
+
+    stream = manifest["streams"]["guitar"]
+    assert stream["playlist"].endswith("stems/eve/hls/hls/guitar/index.m3u8")
+    assert stream["init"].endswith("/hls/guitar/init.mp4")
+    assert [(s["start"], s["duration"]) for s in stream["segments"]] == [(0.0, 2.0), (2.0, 2.0), (4.0, 1.25)]
+    assert fake_s3.storage["stems/eve/hls/hls/guitar/segment_00002.m4s"] == b"seg"
+    assert "packaging=hls:2" in sep.cache_signature()
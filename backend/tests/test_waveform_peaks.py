@@ -0,0 +1,65 @@
+import wave
+
+import numpy as np
+
+
+def _write_ramp(path, seconds=3, sample_rate=8000):
+    # Amplitude grows linearly so every bin's peak is predictable
+    t = np.arange(seconds * sample_rate)
+    audio = (t / len(t)) * np.where(t % 2, 1.0, -1.0)
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((audio * 32767).astype("<i2").tobytes())
+
+
+def test_pyramid_levels_round_trip_and_nest(tmp_path):
+    from backend.waveform_peaks import compute_peak_pyramid, decode_pyramid, encode_pyramid
+
+    song = tmp_path / "guitar.wav"
+    _write_ramp(song)
+    pyramid = compute_peak_pyramid(str(song), samples_per_bin=100, factor=4, levels=3)
+
+    assert [len(level) for level in pyramid.levels] == [240, 60, 15]
+    # Every coarse bin covers exactly the extremes of the finer bins beneath it
+    fine, coarse = pyramid.levels[0].astype(int), pyramid.levels[1].astype(int)
+    assert (coarse[:, 1] == fine[:, 1].reshape(-1, 4).max(axis=1)).all()
+    assert (coarse[:, 0] == fine[:, 0].reshape(-1, 4).min(axis=1)).all()
+    assert pyramid.levels[-1][-1].tolist() == [-127, 127]
+
+    data = encode_pyramid(pyramid)
+    assert len(data) < 700
+    decoded = decode_pyramid(data)
+    assert decoded.sample_rate == 8000 and decoded.bin_samples(2) == 1600
+    assert all((a == b).all() for a, b in zip(decoded.levels, pyramid.levels))
+
+
+def test_peaks_endpoint_picks_level_for_view_width(client, fake_s3, tmp_path):
+    from backend.waveform_peaks import compute_peak_pyramid, encode_pyramid
+
+    song = tmp_path / "no_guitar.wav"
+    _write_ramp(song)
+    fake_s3.put_object(Bucket="test-bucket", Key="stems/amy/t1/no_guitar.peaks",
+                       Body=encode_pyramid(compute_peak_pyramid(str(song), samples_per_bin=100, factor=4, levels=3)))
+
+    r = client.get("/project/amy/t1/peaks/backingTrack", params={"start": 1.0, "end": 2.0, "width": 50})
+    assert r.status_code == 200
+    # One second is 80 bins at level 0, 20 at level 1, so 50 pixels needs level 0
+    assert r.headers["X-Peaks-Level"] == "0"
+    assert r.headers["X-Peaks-Start-Bin"] == "80"
+    assert len(r.content) == 80 * 2
+
+    r = client.get("/project/amy/t1/peaks/backingTrack", params={"width": 10})
+    assert r.headers["X-Peaks-Level"] == "2"
+    assert np.frombuffer(r.content, dtype=np.int8).reshape(-1, 2).shape == (15, 2)
+
+    assert client.get("/project/amy/t1/peaks/guitar").status_code == 404
+
+
+def test_peaks_endpoint_only_reports_missing_objects_as_404(client, fake_s3, monkeypatch):
+    def forbidden(Bucket, Key, Filename):
+        raise fake_s3.exceptions.ClientError(403)
+
+    monkeypatch.setattr(fake_s3, "download_file", forbidden)
+    assert client.get("/project/amy/t2/peaks/guitar").status_code == 500
@@ -0,0 +1,135 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, NamedTuple, Optional, Sequence, Tuple
+
+# Gemini counts audio at a fixed rate whatever its sample rate or channels; text at roughly four characters a token
+AUDIO_TOKENS_PER_SECOND = 32
+CHARS_PER_TOKEN = 4
+GEMINI_INPUT_TOKEN_BUDGET = int(os.getenv("GEMINI_INPUT_TOKEN_BUDGET", "1000000"))
+# Songs whose lengths fall in the same bucket share output history
+OUTPUT_BUCKET_SECONDS = float(os.getenv("OUTPUT_BUCKET_SECONDS", "60"))
+OUTPUT_HISTORY = int(os.getenv("OUTPUT_HISTORY", "50"))
+# A tier is only skipped on the strength of this many recent samples, and samples older than the age limit are dropped
+OUTPUT_MIN_SAMPLES = int(os.getenv("OUTPUT_MIN_SAMPLES", "3"))
+OUTPUT_SAMPLE_MAX_AGE_SECONDS = float(os.getenv("OUTPUT_SAMPLE_MAX_AGE_SECONDS", str(24 * 3600)))
+# Every this many skips a tier is tried anyway, so it can earn its way back when answers get shorter
+OUTPUT_REPROBE_EVERY = int(os.getenv("OUTPUT_REPROBE_EVERY", "10"))
+OUTPUT_PERCENTILE = 0.9
+OUTPUT_HEADROOM = 1.1
+
+
+class PromptTier(NamedTuple):
+    name: str
+    prompt: str
+    max_output_tokens: int
+
+
+def estimate_input_tokens(audio_seconds: float, prompt_chars: int) -> int:
+    return math.ceil(audio_seconds * AUDIO_TOKENS_PER_SECOND + prompt_chars / CHARS_PER_TOKEN)
+
+
+class TokenBudget:
+    """picks the richest prompt tier a request can afford before the model is called
+    input tokens are estimated from the audio duration and the prompt size
+    output tokens are predicted per tier from what earlier songs of a similar length used
+    counts how often the chosen tier still had to fall back to a cheaper one
+    """
+    def __init__(self, input_budget: int = GEMINI_INPUT_TOKEN_BUDGET, bucket_seconds: float = OUTPUT_BUCKET_SECONDS,
+                 history: int = OUTPUT_HISTORY, min_samples: int = OUTPUT_MIN_SAMPLES,
+                 max_age_seconds: float = OUTPUT_SAMPLE_MAX_AGE_SECONDS, reprobe_every: int = OUTPUT_REPROBE_EVERY):
+        self.input_budget = input_budget
+        self.bucket_seconds = bucket_seconds
+        self.history = history
+        self.min_samples = min_samples
+        self.max_age_seconds = max_age_seconds
+        self.reprobe_every = reprobe_every
+        self.requests = 0
+        self.probes = 0
+        self.fallbacks = 0
+        self.wasted_generations = 0
+        self.chosen: Dict[str, int] = {}
+        # (tier, song length bucket) -> recent (time, output tokens), a truncated answer counting as its limit
+        self._outputs: Dict[Tuple[str, int], Deque[Tuple[float, int]]] = {}
+        self._skips: Dict[Tuple[str, int], int] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, song_seconds: Optional[float]) -> int:
+        return -1 if song_seconds is None else int(song_seconds // self.bucket_seconds)
+
+    def predicted_output(self, tier: str, song_seconds: Optional[float]) -> Optional[int]:
+        """High percentile of the tier's recent output for songs of this length, or None with too few samples."""
+        cutoff = time.time() - self.max_age_seconds
+        with self._lock:
+            recent = self._outputs.get((tier, self._bucket(song_seconds)))
+            while recent and recent[0][0] < cutoff:
+                recent.popleft()
+            samples = sorted(tokens for _, tokens in recent or ())
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(OUTPUT_PERCENTILE * len(samples)))]
+
+    def _skip_for_output(self, tier: str, song_seconds: Optional[float]) -> bool:
+        """Counts a skip of the tier, except that every reprobe_every-th one tries the tier again."""
+        with self._lock:
+            key = (tier, self._bucket(song_seconds))
+            self._skips[key] = self._skips.get(key, 0) + 1
+            if self._skips[key] < self.reprobe_every:
+                return True
+            self._skips[key] = 0
+            self.probes += 1
+            return False
+
+    def choose(self, tiers: Sequence[PromptTier], audio_seconds: float, song_seconds: Optional[float] = None,
+               prompt_chars: Optional[Sequence[int]] = None) -> int:
+        """Index of the first tier whose input fits the budget and whose expected output fits its limit.
+
+        `prompt_chars` gives each tier's full text size when it sends more than its own prompt. The last
+        tier is the answer when nothing fits, since it is the cheapest there is.
+        """
+        choice = len(tiers) - 1
+        for index, tier in enumerate(tiers[:-1]):
+            chars = prompt_chars[index] if prompt_chars else len(tier.prompt)
+            if estimate_input_tokens(audio_seconds, chars) > self.input_budget:
+                continue
+            predicted = self.predicted_output(tier.name, song_seconds)
+            if (predicted is not None and predicted * OUTPUT_HEADROOM >= tier.max_output_tokens
+                    and self._skip_for_output(tier.name, song_seconds)):
+                continue
+            choice = index
+            break
+        with self._lock:
+            self.requests += 1
+            self.chosen[tiers[choice].name] = self.chosen.get(tiers[choice].name, 0) + 1
+        return choice
+
+    def record(self, tier: PromptTier, song_seconds: Optional[float], output_tokens: Optional[int],
+               truncated: bool = False):
+        """Remembers how much output a tier needed; a truncated answer needed at least its limit."""
+        if truncated:
+            output_tokens = tier.max_output_tokens
+        if output_tokens is None:
+            return
+        with self._lock:
+            key = (tier.name, self._bucket(song_seconds))
+            self._outputs.setdefault(key, deque(maxlen=self.history)).append((time.time(), int(output_tokens)))
+
+    def record_fallback(self, wasted: int):
+        """Counts a request that spent `wasted` generations on tiers before the one that answered."""
+        with self._lock:
+            self.fallbacks += 1
+            self.wasted_generations += wasted
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "chosenTiers": dict(self.chosen),
+                "fallbacks": self.fallbacks,
+                "wastedGenerations": self.wasted_generations,
+                "fallbackRate": round(self.fallbacks / self.requests, 3) if self.requests else 0.0,
+                "probes": self.probes,
+                "songLengthBuckets": len({bucket for _, bucket in self._outputs}),
+            }
@@ -0,0 +1,107 @@
+import os
+import struct
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+try:
+    from .audio_analysis import open_audio_stream
+except ImportError:
+    from audio_analysis import open_audio_stream
+
+PEAKS_SAMPLES_PER_BIN = int(os.getenv("PEAKS_SAMPLES_PER_BIN", "256"))
+PEAKS_LEVEL_FACTOR = int(os.getenv("PEAKS_LEVEL_FACTOR", "4"))
+PEAKS_LEVELS = int(os.getenv("PEAKS_LEVELS", "5"))
+PEAKS_CONTENT_TYPE = "application/octet-stream"
+
+# magic, sample rate, samples per bin at level 0, factor between levels, level count; then one u32 bin count per level
+_HEADER = struct.Struct("<4sIIHH")
+_MAGIC = b"PEAK"
+
+
+class PeakPyramid(NamedTuple):
+    sample_rate: int
+    samples_per_bin: int
+    factor: int
+    levels: List[np.ndarray]  # one (bins, 2) int8 array of min/max per level, finest first
+
+    def bin_samples(self, level: int) -> int:
+        return self.samples_per_bin * self.factor ** level
+
+
+def _quantize(values: np.ndarray) -> np.ndarray:
+    return np.round(np.clip(values, -1, 1) * 127).astype(np.int8)
+
+
+def build_levels(base: np.ndarray, factor: int, levels: int) -> List[np.ndarray]:
+    """Reduces level 0 min/max pairs into coarser levels, each `factor` times fewer bins."""
+    result = [base]
+    for _ in range(1, levels):
+        previous = result[-1]
+        if len(previous) <= 1:
+            break
+        padded = np.concatenate([previous, np.repeat(previous[-1:], -len(previous) % factor, axis=0)])
+        grouped = padded.reshape(-1, factor, 2)
+        result.append(np.stack([grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)], axis=1))
+    return result
+
+
+def compute_peak_pyramid(file_path: str, samples_per_bin: int = PEAKS_SAMPLES_PER_BIN,
+                         factor: int = PEAKS_LEVEL_FACTOR, levels: int = PEAKS_LEVELS) -> PeakPyramid:
+    """Streams the file once, taking min/max per bin for level 0 and deriving the coarser levels from it."""
+    sample_rate, blocks = open_audio_stream(file_path)
+    leftover = np.zeros(0, dtype=np.float32)
+    base_parts = []
+    for block in blocks:
+        samples = np.concatenate([leftover, block])
+        whole = len(samples) - len(samples) % samples_per_bin
+        bins = samples[:whole].reshape(-1, samples_per_bin)
+        base_parts.append(np.stack([bins.min(axis=1), bins.max(axis=1)], axis=1))
+        leftover = samples[whole:]
+    if len(leftover):
+        base_parts.append(np.array([[leftover.min(), leftover.max()]], dtype=np.float32))
+    base = _quantize(np.concatenate(base_parts)) if base_parts else np.zeros((0, 2), dtype=np.int8)
+    return PeakPyramid(sample_rate, samples_per_bin, factor, build_levels(base, factor, levels))
+
+
+def encode_pyramid(pyramid: PeakPyramid) -> bytes:
+    header = _HEADER.pack(_MAGIC, pyramid.sample_rate, pyramid.samples_per_bin, pyramid.factor, len(pyramid.levels))
+    counts = struct.pack(f"<{len(pyramid.levels)}I", *(len(level) for level in pyramid.levels))
+    return header + counts + b"".join(level.tobytes() for level in pyramid.levels)
+
+
+def decode_pyramid(data: bytes) -> PeakPyramid:
+    magic, sample_rate, samples_per_bin, factor, level_count = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError("Not a waveform peaks file.")
+    counts = struct.unpack_from(f"<{level_count}I", data, _HEADER.size)
+    offset = _HEADER.size + 4 * level_count
+    levels = []
+    for count in counts:
+        levels.append(np.frombuffer(data, dtype=np.int8, count=count * 2, offset=offset).reshape(-1, 2))
+        offset += count * 2
+    return PeakPyramid(sample_rate, samples_per_bin, factor, levels)
+
+
+def peak_window(pyramid: PeakPyramid, start: float = 0.0, end: Optional[float] = None,
+                width: Optional[int] = None, level: Optional[int] = None) -> Tuple[int, int, np.ndarray]:
+    """Returns (level, first bin, min/max pairs) covering start..end seconds.
+
+    Without an explicit level, picks the coarsest one that still gives at least `width` bins,
+    so a view `width` pixels wide gets about one bin per pixel.
+    """
+    if level is None:
+        level = 0
+        if width:
+            span = ((end if end is not None else float("inf")) - start) * pyramid.sample_rate
+            if span == float("inf"):
+                span = len(pyramid.levels[0]) * pyramid.samples_per_bin
+            for candidate in range(len(pyramid.levels) - 1, -1, -1):
+                if span / pyramid.bin_samples(candidate) >= width:
+                    level = candidate
+                    break
+    level = max(0, min(level, len(pyramid.levels) - 1))
+    bin_samples = pyramid.bin_samples(level)
+    first = max(0, int(start * pyramid.sample_rate // bin_samples))
+    last = len(pyramid.levels[level]) if end is None else int(np.ceil(end * pyramid.sample_rate / bin_samples))
+    return level, first, pyramid.levels[level][first:max(first, last)]